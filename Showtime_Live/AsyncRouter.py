@@ -0,0 +1,162 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from ShowtimeBridge.Logger import Log
+from ShowtimeBridge.UDPEndpoint import UDPEndpoint
+from Showtime_Live.LiveRouter import LiveRouter
+
+
+class Task:
+    """Generator driven by a Scheduler. The generator yields how many seconds to sleep before it
+    resumes, or None to resume as soon as the work already queued has run"""
+    def __init__(self, scheduler, generator, name):
+        self.scheduler = scheduler
+        self.generator = generator
+        self.name = name
+        self.done = False
+
+    def step(self):
+        if self.done:
+            return
+        try:
+            delay = self.generator.next()
+        except StopIteration:
+            self.done = True
+            return
+        except Exception, e:
+            Log.error("Task %s failed. %s" % (self.name, e))
+            self.done = True
+            return
+
+        if delay:
+            self.scheduler.call_later(delay, self.step)
+        else:
+            self.scheduler.call_soon(self.step)
+
+    def cancel(self):
+        self.done = True
+
+
+class Scheduler:
+    """Callbacks, timers and generator tasks for a single event loop thread.
+
+    Callbacks can be queued from any thread. The loop's waker is poked when they come from
+    another thread so a blocked select returns to run them.
+    """
+    def __init__(self, waker):
+        self.waker = waker
+        self.thread = None
+        self.ready = collections.deque()
+        self.timers = []
+        self.counter = itertools.count()
+
+    def call_soon(self, callback, *args):
+        # Appending to a deque is atomic, so other threads need nothing more than the wakeup
+        self.ready.append((callback, args))
+        if threading.current_thread() is not self.thread:
+            self.waker.wake()
+
+    def call_later(self, delay, callback, *args):
+        """Run a callback after a number of seconds. Only call this from the loop thread"""
+        heapq.heappush(self.timers, (time.time() + delay, next(self.counter), callback, args))
+
+    def spawn(self, generator, name=None):
+        """Start running a generator as a task"""
+        task = Task(self, generator, name or generator.__name__)
+        self.call_soon(task.step)
+        return task
+
+    def timeout(self, maximum):
+        """Seconds the loop can wait for socket events before something here is due"""
+        if self.ready:
+            return 0
+        if self.timers:
+            return min(max(self.timers[0][0] - time.time(), 0), maximum)
+        return maximum
+
+    def run_due(self):
+        """Run every callback that was queued or came due before this call"""
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            when, count, callback, args = heapq.heappop(self.timers)
+            self.ready.append((callback, args))
+
+        # Callbacks queued while these run wait for the next pass so sockets are never starved
+        for i in xrange(len(self.ready)):
+            callback, args = self.ready.popleft()
+            try:
+                callback(*args)
+            except Exception, e:
+                Log.error("Callback %s failed. %s" % (callback, e))
+
+
+class AsyncRouter(LiveRouter):
+    """LiveRouter engine that runs everything on one event loop thread.
+
+    Socket reads and flushes, session heartbeats and telemetry drains are callbacks and generator
+    tasks on the router's selector instead of jobs on other threads. Messages from Showtime's threads
+    are handed over to the loop before they touch any endpoint, so endpoints and sessions are only
+    ever used from the loop thread.
+
+    Showtime requests block, so method registrations stay with the registrar's workers. They post
+    their completions back to the loop, which replays the messages held for each method.
+    """
+    # Seconds between checks for telemetry rings when no client has one
+    TELEMETRY_IDLE_INTERVAL = 0.25
+
+    def __init__(self, *args, **kwargs):
+        # Registrar workers are started part way through the router's setup and report back through the scheduler
+        self.scheduler = Scheduler(None)
+        LiveRouter.__init__(self, *args, **kwargs)
+        self.name = "AsyncRouter"
+        self.scheduler.waker = self.waker
+
+    def run(self):
+        self.scheduler.thread = self
+        self.scheduler.spawn(self.send_heartbeats())
+        self.scheduler.spawn(self.drain_telemetry_rings())
+        while not self.exitFlag:
+            self.handle_events(self.selector.select(self.scheduler.timeout(1)))
+            self.scheduler.run_due()
+        self.selector.close()
+        self.waker.close()
+
+    def send_heartbeats(self):
+        """Heartbeat every client and close the sessions of clients that went quiet. Endpoints limit
+        themselves to one heartbeat per heartbeat duration, so waking twice as often keeps the
+        interval from drifting"""
+        while not self.exitFlag:
+            for session in self.sessions.values():
+                if session.udp:
+                    session.udp.send_heartbeat()
+            self.expire_sessions()
+            yield UDPEndpoint.HEARTBEAT_DURATION / 2000.0
+
+    def start_heartbeats(self, session):
+        # The heartbeat task already covers every session from the loop thread
+        pass
+
+    def call_soon(self, callback, *args):
+        self.scheduler.call_soon(callback, *args)
+
+    def drain_telemetry_rings(self):
+        while not self.exitFlag:
+            draining = False
+            for session in self.sessions.values():
+                if session.telemetry:
+                    session.drain_telemetry()
+                    draining = True
+            yield LiveRouter.TELEMETRY_INTERVAL if draining else AsyncRouter.TELEMETRY_IDLE_INTERVAL
+
+    def endpoint_ready(self, endpoint):
+        if threading.current_thread() is self:
+            LiveRouter.endpoint_ready(self, endpoint)
+        else:
+            self.scheduler.call_soon(LiveRouter.endpoint_ready, self, endpoint)
+
+    def incoming(self, message):
+        # Called from Showtime's threads
+        self.scheduler.call_soon(LiveRouter.incoming, self, message)
@@ -0,0 +1,265 @@
+import errno
+import select
+import socket
+import threading
+
+from ShowtimeBridge.Logger import Log
+
+# Interest flags
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+class SelectorKey:
+    """Registration of a file object with a selector"""
+    def __init__(self, fileobj, fd, events, data):
+        self.fileobj = fileobj
+        self.fd = fd
+        self.events = events
+        self.data = data
+
+    def __repr__(self):
+        return "SelectorKey(fd=%s, events=%s, data=%s)" % (self.fd, self.events, self.data)
+
+
+class BaseSelector:
+    """Keeps persistent read/write registrations for sockets, in the style of Python 3's selectors.
+
+    Registrations are looked up by file object as well as descriptor so a socket that has already
+    been closed can still be unregistered. Registrations can be changed from other threads while
+    select() is blocked.
+    """
+    def __init__(self):
+        self.keys = {}
+        self.fdKeys = {}
+        self.lock = threading.Lock()
+
+    def register(self, fileobj, events, data=None):
+        with self.lock:
+            if fileobj in self.keys:
+                raise KeyError("%s is already registered" % fileobj)
+            key = SelectorKey(fileobj, fileobj.fileno(), events, data)
+            self.keys[fileobj] = key
+            self.fdKeys[key.fd] = key
+            self._register(key)
+            return key
+
+    def unregister(self, fileobj):
+        with self.lock:
+            key = self.keys.pop(fileobj)
+            del self.fdKeys[key.fd]
+            self._unregister(key)
+            return key
+
+    def modify(self, fileobj, events, data=None):
+        """Change the interest of a registration. Unchanged interest doesn't touch the kernel"""
+        with self.lock:
+            key = self.keys[fileobj]
+            key.data = data if data is not None else key.data
+            if events != key.events:
+                key.events = events
+                self._modify(key)
+            return key
+
+    def get_key(self, fileobj):
+        return self.keys[fileobj]
+
+    def __contains__(self, fileobj):
+        return fileobj in self.keys
+
+    def select(self, timeout=None):
+        """Wait for registered file objects to become ready
+
+        Returns:
+            List of (SelectorKey, events) tuples.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            self.keys.clear()
+            self.fdKeys.clear()
+
+    def _register(self, key):
+        pass
+
+    def _unregister(self, key):
+        pass
+
+    def _modify(self, key):
+        pass
+
+
+class SelectSelector(BaseSelector):
+    """Portable fallback built on select.select(). Interest lists are rebuilt only when they change"""
+    def __init__(self):
+        BaseSelector.__init__(self)
+        self.readers = []
+        self.writers = []
+
+    def _rebuild(self, changed):
+        self.readers = [key.fd for key in self.keys.values() if key.events & EVENT_READ]
+        self.writers = [key.fd for key in self.keys.values() if key.events & EVENT_WRITE]
+
+    _register = _unregister = _modify = _rebuild
+
+    def select(self, timeout=None):
+        readers = self.readers
+        writers = self.writers
+        try:
+            readable, writable, errored = select.select(readers, writers, readers, timeout)
+        except (select.error, socket.error, ValueError), e:
+            if isinstance(e, ValueError) or e[0] == errno.EBADF:
+                return self._find_bad_descriptors()
+            if e[0] == errno.EINTR:
+                return []
+            raise
+
+        ready = {}
+        for fd in readable + errored:
+            ready[fd] = ready.get(fd, 0) | EVENT_READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return self._keys_for(ready)
+
+    def _find_bad_descriptors(self):
+        """Report descriptors closed behind our back as readable so their owner's read fails and
+        runs its normal close path"""
+        bad = {}
+        for key in self.keys.values():
+            try:
+                select.select([key.fd], [], [], 0)
+            except (select.error, socket.error, ValueError):
+                Log.network("Descriptor %s was closed while still registered" % key.fd)
+                bad[key.fd] = EVENT_READ
+        return self._keys_for(bad)
+
+    def _keys_for(self, ready):
+        result = []
+        for fd, events in ready.items():
+            key = self.fdKeys.get(fd)
+            if key:
+                result.append((key, events & (key.events | EVENT_READ)))
+        return result
+
+
+class EpollSelector(BaseSelector):
+    """Linux selector. The kernel keeps the interest set so a wait costs nothing per registration"""
+    def __init__(self):
+        BaseSelector.__init__(self)
+        self.epoll = select.epoll()
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def _register(self, key):
+        self.epoll.register(key.fd, EpollSelector._mask(key.events))
+
+    def _unregister(self, key):
+        try:
+            self.epoll.unregister(key.fd)
+        except (IOError, OSError, ValueError):
+            # Closed descriptors drop out of the epoll set on their own
+            pass
+
+    def _modify(self, key):
+        self.epoll.modify(key.fd, EpollSelector._mask(key.events))
+
+    def select(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        try:
+            polled = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        result = []
+        for fd, mask in polled:
+            key = self.fdKeys.get(fd)
+            if not key:
+                continue
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_READ
+            if mask & (select.EPOLLOUT | select.EPOLLERR | select.EPOLLHUP):
+                events |= EVENT_WRITE
+            result.append((key, events & (key.events | EVENT_READ)))
+        return result
+
+    def close(self):
+        BaseSelector.close(self)
+        self.epoll.close()
+
+
+def socketpair():
+    """Connected pair of sockets. Windows builds of Python 2 have no socket.socketpair, so a
+    loopback TCP connection stands in for it there"""
+    if hasattr(socket, "socketpair"):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server, address = listener.accept()
+    finally:
+        listener.close()
+    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    return server, client
+
+
+class Waker:
+    """Self-pipe that lets other threads interrupt a blocked select().
+
+    The read end is registered with the selector like any other socket. Wakeups are coalesced so
+    a burst of cross-thread enqueues costs a single byte on the pipe. The pending flag and the
+    pipe change together under a lock, otherwise a wakeup landing mid-drain could have its byte
+    read while the flag stays set, and every later wakeup would be skipped.
+    """
+    def __init__(self):
+        self.reader, self.writer = socketpair()
+        self.reader.setblocking(0)
+        self.writer.setblocking(0)
+        self.pending = False
+        self.lock = threading.Lock()
+
+    def wake(self):
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+            try:
+                self.writer.send("\0")
+            except socket.error:
+                # A full pipe already has a wakeup waiting in it
+                pass
+
+    def drain(self):
+        """Clear pending wakeups. Call from the selecting thread when the read end is readable"""
+        with self.lock:
+            try:
+                while self.reader.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            self.pending = False
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+# Best selector available on this platform
+if hasattr(select, "epoll"):
+    DefaultSelector = EpollSelector
+else:
+    DefaultSelector = SelectSelector
@@ -1,41 +1,572 @@
+import collections
+import os
 import Queue
-import select
 import socket
+import tempfile
 import threading
+import time
 import uuid
+import zmq
+from Showtime.zst_method import ZstMethod
 from Showtime.zst_node import ZstNode
+from Showtime.zst_socket import ZstSocket
 from Showtime.zst_stage import ZstStage
-from ShowtimeBridge.NetworkEndpoint import SimpleMessage, NetworkPrefixes, NetworkEndpoint, NetworkErrors, ReadError
+from ShowtimeBridge.MessageCodecs import Codecs
+from ShowtimeBridge.NetworkEndpoint import SimpleMessage, NetworkPrefixes, NetworkEndpoint, ReadError
 from ShowtimeBridge.UDPEndpoint import UDPEndpoint
 from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+from ShowtimeBridge.UnixEndpoint import UnixSockets, UnixStreamEndpoint, UnixDatagramEndpoint
 from ShowtimeBridge.Logger import Log
+from ShowtimeBridge.MeterFrames import MeterDeltaDecoder
+from ShowtimeBridge.Metrics import Histogram
+from ShowtimeBridge.TelemetryRing import TelemetryRing
+from Showtime_Live.EventSelector import DefaultSelector, Waker, EVENT_READ, EVENT_WRITE
+from Showtime_Live.TimerWheel import TimerThread
 
 
-class RegistrationThread(threading.Thread):
-    """Thread dedicated to incoming registration requests so we don't break Showtime req/rep timing"""
-    def __init__(self, node):
-        threading.Thread.__init__(self)
-        self.name = "zst_registrar"
-        self.exitFlag = 0
-        self.daemon = True
+class Registrar:
+    """Registers methods with Showtime from a pool of worker threads, so registrations don't hold up
+    the router or break Showtime req/rep timing.
+
+    Requests are taken in the order they were queued, as many at a time as there are workers.
+    Every method reports its completion to a callback, and the registrar keeps track of how long
+    methods take to register and how long each batch of requests took to clear.
+
+    A req socket only allows one request in flight, so each worker talks to the stage over its own
+    socket instead of sharing the node's.
+    """
+    DEFAULT_WORKERS = 4
+
+    def __init__(self, node, completed, workers=DEFAULT_WORKERS):
+        """
+        Args:
+            node: Showtime node to register methods on
+            completed: Called from a worker with the method name and whether it registered
+            workers: Number of registrations kept in flight
+        """
         self.node = node
-        self.queued_registrations = Queue.Queue()
+        self.completed = completed
+        self.exitFlag = 0
+        self.queued = Queue.Queue()
+
+        # Methods queued or in flight, with the time they were queued
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.batchStarted = None
+        self.lastBatchTime = None
+        self.registered = 0
+        self.failed = 0
+
+        # Milliseconds from a method being queued to Showtime accepting it
+        self.registrationTime = Histogram()
+
+        self.workers = []
+        for i in xrange(workers):
+            worker = threading.Thread(target=self.work, args=(self.connect_stage("registrar%d" % i),),
+                                      name="zst_registrar%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
 
-    def add_registration_request(self, *args):
-        self.queued_registrations.put(args)
+    def connect_stage(self, name):
+        """Open a req socket to the node's stage for one worker"""
+        stagesocket = ZstSocket(self.node.ctx, zmq.REQ, self.node.incomingQueue, name)
+        stagesocket.socket.connect(self.node.stageAddress)
+        return stagesocket
+
+    def add_registration_request(self, methodname, methodaccess, methodargs, callback):
+        with self.lock:
+            if not self.pending:
+                self.batchStarted = time.time()
+            self.pending[methodname] = time.time()
+        self.submit((methodname, methodaccess, methodargs, callback))
+
+    def submit(self, req):
+        self.queued.put(req)
+
+    def registering(self, methodname):
+        return methodname in self.pending
 
     def stop(self):
         self.exitFlag = 1
+        for worker in self.workers:
+            self.queued.put(None)
 
-    def run(self):
+    def work(self, stagesocket):
         while not self.exitFlag:
-            req = self.queued_registrations.get(True)
-            self.node.request_register_method(req[0], req[1], req[2], req[3])
-        self.join(1)
+            req = self.queued.get(True)
+            if req is None:
+                break
+            self.register(req, stagesocket)
+        stagesocket.stop()
+        stagesocket.socket.close()
+
+    def register(self, req, stagesocket=None):
+        """Register a queued method with Showtime
+
+        Args:
+            req: Tuple of method name, access, args and callback
+            stagesocket: Stage socket to send the request on. Uses the node's own socket if missing
+        """
+        try:
+            self.node.request_register_method(req[0], req[1], req[2], req[3], nodesocket=stagesocket)
+            success = True
+        except Exception, e:
+            Log.error("Couldn't register %s with Showtime. %s" % (req[0], e))
+            success = False
+
+        now = time.time()
+        batchtime = None
+        with self.lock:
+            queued = self.pending.pop(req[0], now)
+            if success:
+                self.registered += 1
+                self.registrationTime.add((now - queued) * 1000.0)
+            else:
+                self.failed += 1
+            if not self.pending and self.batchStarted is not None:
+                batchtime = self.lastBatchTime = now - self.batchStarted
+                self.batchStarted = None
+        if batchtime is not None:
+            Log.network("Showtime registrations cleared in %.3fs" % batchtime)
+        self.completed(req[0], success)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": len(self.workers),
+                "pending": len(self.pending),
+                "registered": self.registered,
+                "failed": self.failed,
+                "lastBatchSeconds": self.lastBatchTime,
+                "perMethod": self.registrationTime.as_dict()
+            }
+
+
+class LayoutAssembler:
+    """Puts a song layout streamed from Live in pages back together"""
+    def __init__(self):
+        self.stream = None
+        self.expectedSeq = 0
+        self.wrappers = []
+
+    def assembling(self):
+        return self.stream is not None
+
+    def reset(self):
+        self.stream = None
+        self.expectedSeq = 0
+        self.wrappers = []
+
+    def add_page(self, page):
+        """Add a layout page
+
+        Returns:
+            Complete list of layout objects once the last page arrives, otherwise None.
+        """
+        if page["seq"] == 0:
+            if self.assembling():
+                Log.warn("Layout %s superseded by layout %s" % (self.stream, page["stream"]))
+            self.reset()
+            self.stream = page["stream"]
+        elif page["stream"] != self.stream or page["seq"] != self.expectedSeq:
+            Log.error("Layout page %s:%s out of order. Expected %s:%s" % (
+                page["stream"], page["seq"], self.stream, self.expectedSeq))
+            self.reset()
+            return None
+
+        self.wrappers.extend(page["page"])
+        self.expectedSeq += 1
+        if not page["end"]:
+            return None
+
+        layout = self.wrappers
+        self.reset()
+        return layout
+
+
+class ClientSession:
+    """State for one connected Live instance.
+
+    Every client gets its own TCP connection and its own UDP endpoint, so wire IDs, streamed
+    layouts, meter state and statistics never mix between clients. Wrapper IDs are only unique
+    within one Live set, so they're prefixed with the client's namespace before they reach Showtime.
+    """
+    # Separates the client namespace from a wrapper ID
+    NAMESPACE_DELIM = "/"
+
+    # Messages kept for method IDs we haven't learnt yet
+    UNMAPPED_MESSAGE_LIMIT = 256
+
+    def __init__(self, router, tcpendpoint):
+        self.router = router
+        self.tcp = tcpendpoint
+        self.udp = None
+        self.telemetry = None
+        self.namespace = None
+        self.connectedAt = time.time()
+
+        # Timer job sending our client its heartbeats
+        self.heartbeatTask = None
+
+        # Lets the client pick the session up again after a dropped connection
+        self.token = None
+        self.retiredAt = None
+
+        # Version of the last layout diff we passed on to Showtime
+        self.layoutVersion = 0
+
+        # Wire IDs for methods, learnt from the client's registration messages
+        self.methodNames = {}
+        self.methodIds = {}
+
+        # Datagrams and telemetry can overtake the registration sent over the stream, so messages
+        # for IDs we don't know yet wait here in the order they arrived
+        self.unmappedEvents = collections.deque()
+
+        # Streamed layouts and the layout diffs that arrive while one is being assembled
+        self.layoutAssembler = LayoutAssembler()
+        self.heldLayoutDiffs = []
+
+        # Full meter state rebuilt from the delta frames Live sends
+        self.meterDecoder = MeterDeltaDecoder()
+
+        # Time from a message being created in Live to it being handed to Showtime, per method
+        self.latency = {}
+
+        self.tcp.add_event_callback(self.event)
+        self.tcp.add_client_handshake_callback(self.handshake_received)
+
+    def handshake_received(self):
+        Log.network("Client sent handshake")
+        handshake = self.tcp.peerHandshake
+
+        # A client coming back keeps its namespace and method IDs, and only resends the layout
+        # diffs we haven't seen
+        previous = self.router.resume_session(handshake.get("session"))
+        self.namespace = self.router.claim_namespace(self, previous.namespace if previous else handshake.get("name"))
+        if previous and previous.namespace != self.namespace:
+            Log.network("Namespace %s was taken while its client was away. Starting a new session" %
+                        previous.namespace)
+            previous = None
+        if previous:
+            self.token = previous.token
+            self.methodNames = previous.methodNames
+            self.methodIds = previous.methodIds
+            self.layoutVersion = previous.layoutVersion
+        else:
+            self.token = uuid.uuid4().hex
+
+        ack = {"namespace": self.namespace, "session": self.token, "manifests": True}
+        if previous:
+            ack["resumed"] = True
+            ack["layoutVersion"] = self.layoutVersion
+
+        # Clients on this machine get a Unix datagram socket if they bound one. Everyone else listens
+        # for UDP on the port they advertised, on the same host as their stream connection
+        unixpath = handshake.get("unixpath")
+        udpport = handshake.get("udpport")
+        if unixpath and self.router.unixSockets and self.is_local():
+            self.udp = UnixDatagramEndpoint(UnixSockets.path("%s-%s" % (self.router.serverID, self.namespace)),
+                                            unixpath, True, self.router.serverID, False)
+            ack["unixpath"] = self.udp.path
+        elif udpport:
+            self.udp = UDPEndpoint(0, udpport, True, self.router.serverID, False)
+            self.udp.remoteAddr = (self.peer_host(), udpport)
+            ack["udpport"] = self.udp.socket.getsockname()[1]
+        else:
+            Log.warn("Client %s didn't advertise a UDP port. It won't receive Showtime messages" % self.namespace)
+
+        if self.udp:
+            # The client's heartbeats keep the session alive from here on
+            self.udp.lastPeerHeartbeatTime = NetworkEndpoint.current_milli_time()
+            self.udp.add_event_callback(self.event)
+            self.router.register_endpoint(self.udp, self.router.receive_udp)
+            self.router.start_heartbeats(self)
+
+        # Local clients write high rate telemetry to shared memory, which we drain on our own schedule
+        if handshake.get("telemetry") and self.router.telemetry and self.is_local():
+            path = os.path.join(tempfile.gettempdir(),
+                                "showtime-live-%s-%s.ring" % (self.router.serverID, self.namespace))
+            try:
+                self.telemetry = TelemetryRing(path, TelemetryRing.DEFAULT_CAPACITY)
+                ack["telemetry"] = path
+            except EnvironmentError, e:
+                Log.warn("Couldn't create telemetry ring for %s. %s" % (self.namespace, e))
+
+        self.tcp.send_handshake_ack(ack)
+        if self.udp:
+            # Session sockets only take the client's datagrams, so those can use the negotiated codec.
+            # The client's UDP socket also takes discovery traffic, so it's only sent the default codec
+            self.udp.connect_peer(self.tcp.codec)
+            if not isinstance(self.udp, UnixDatagramEndpoint):
+                self.udp.codec = Codecs.DEFAULT
+        self.tcp.enteringImmediate = True
+        Log.network("Client %s connected. Datagrams on %s" % (self.namespace, ack.get("unixpath", ack.get("udpport"))))
+
+    def is_local(self):
+        """Whether the client runs on this machine"""
+        return self.tcp.socket.family == socket.AF_UNIX or UnixSockets.is_local(self.peer_host())
+
+    def peer_host(self):
+        if self.tcp.socket.family == socket.AF_UNIX:
+            return "127.0.0.1"
+        return self.tcp.socket.getpeername()[0]
+
+    def close(self):
+        Log.network("Client %s closed" % self.namespace)
+        Log.network("Compression stats: %s" % self.tcp.compression_stats())
+        # Heartbeats are sent from the timer thread, so they have to stop before the socket closes
+        self.router.stop_heartbeats(self)
+        for endpoint in (self.tcp, self.udp):
+            if endpoint:
+                self.router.unregister_endpoint(endpoint)
+                endpoint.close()
+        if self.telemetry:
+            self.telemetry.close()
+            self.telemetry = None
+
+    # Namespacing
+    # -----------
+    def scoped_id(self, wrapperid):
+        if wrapperid is None:
+            return None
+        return "%s%s%s" % (self.namespace, ClientSession.NAMESPACE_DELIM, wrapperid)
+
+    def scope_wrapper(self, wrapper):
+        if isinstance(wrapper, dict):
+            if "id" in wrapper:
+                wrapper["id"] = self.scoped_id(wrapper["id"])
+            if "parent" in wrapper:
+                wrapper["parent"] = self.scoped_id(wrapper["parent"])
+
+    def scope_message(self, methodname, msg):
+        """Prefix every wrapper ID in an outgoing message with our namespace"""
+        if not isinstance(msg, dict):
+            return
+        self.scope_wrapper(msg)
+        value = msg.get("value")
+        if methodname == LiveRouter.SONG_METERS and isinstance(value, dict):
+            msg["value"] = dict((self.scoped_id(wrapperid), level) for wrapperid, level in value.iteritems())
+        elif isinstance(value, list):
+            for wrapper in value:
+                self.scope_wrapper(wrapper)
+        for wrapper in msg.get("val") or ():
+            self.scope_wrapper(wrapper)
+
+    # Live --> Showtime
+    # -----------------
+    def event(self, event):
+        # Registered methods arrive with an integer subject
+        if type(event.subject) is int:
+            try:
+                methodname = self.methodNames[event.subject]
+            except KeyError:
+                self.hold_unmapped(event)
+                return
+            self.method_event(methodname, event)
+            return
+
+        methodname = event.subject[2:]
+        msgtype = event.subject[:1]
+
+        if msgtype == NetworkPrefixes.REGISTRATION:
+            methodid = event.msg.get("methodid")
+            if methodid is not None:
+                self.methodNames[methodid] = methodname
+                self.methodIds[methodname] = methodid
+            self.router.register_method(methodname, event.msg["methodaccess"], event.msg["args"])
+            self.release_unmapped()
+        elif msgtype == NetworkPrefixes.MANIFEST:
+            self.manifest_received(event.msg)
+        elif msgtype == NetworkPrefixes.OUTGOING or msgtype == NetworkPrefixes.RESPONDER:
+            self.method_event(methodname, event)
+
+    def manifest_received(self, manifest):
+        """Learn the wire IDs of a client's whole method table and register it with Showtime"""
+        for method in manifest["methods"]:
+            self.methodNames[method["methodid"]] = method["name"]
+            self.methodIds[method["name"]] = method["methodid"]
+        self.router.register_manifest(manifest.get("hash"), manifest["methods"])
+        self.release_unmapped()
+
+    def hold_unmapped(self, event):
+        """Keep a message for a method ID we haven't learnt until its registration arrives"""
+        if not self.unmappedEvents:
+            Log.network("Holding messages from %s until method %s is registered" % (self.namespace, event.subject))
+        elif len(self.unmappedEvents) >= ClientSession.UNMAPPED_MESSAGE_LIMIT:
+            dropped = self.unmappedEvents.popleft()
+            Log.warn("Dropping message from %s for unregistered method %s" % (self.namespace, dropped.subject))
+        self.unmappedEvents.append(event)
+
+    def release_unmapped(self):
+        """Pass on the held messages whose method IDs we know now"""
+        held = self.unmappedEvents
+        self.unmappedEvents = collections.deque()
+        for event in held:
+            if event.subject in self.methodNames:
+                self.event(event)
+            else:
+                self.unmappedEvents.append(event)
+
+    def method_event(self, methodname, event):
+        if methodname == LiveRouter.LAYOUT_UPDATED and not self.accept_layout_version(event.msg.get("version")):
+            return
+
+        if methodname == LiveRouter.SONG_METERS and isinstance(event.msg.get("value"), dict) and \
+                "keyframe" in event.msg["value"]:
+            # Showtime consumers always get every track's level
+            event.msg["value"] = dict(self.meterDecoder.apply(event.msg["value"]))
+        elif methodname == LiveRouter.SONG_LAYOUT and isinstance(event.msg.get("value"), dict):
+            self.layout_page_event(event)
+            return
+        elif methodname == LiveRouter.LAYOUT_UPDATED and self.layoutAssembler.assembling():
+            # Diffs only make sense on top of the layout they follow
+            self.heldLayoutDiffs.append(event)
+            return
+        self.update_method(methodname, event)
+
+    def accept_layout_version(self, version):
+        """Whether a layout diff is new. Diffs resent after a resume can overlap ones we already have"""
+        if version is None:
+            return True
+        if version <= self.layoutVersion:
+            Log.network("Skipping layout version %s from %s. Already at %s" % (version, self.namespace,
+                                                                               self.layoutVersion))
+            return False
+        self.layoutVersion = version
+        return True
+
+    def layout_page_event(self, event):
+        layout = self.layoutAssembler.add_page(event.msg["value"])
+        if layout is None:
+            if not self.layoutAssembler.assembling():
+                self.release_layout_diffs()
+            return
+        Log.network("Layout from %s assembled with %s wrappers" % (self.namespace, len(layout)))
+        event.msg["value"] = layout
+        self.update_method(LiveRouter.SONG_LAYOUT, event)
+        self.release_layout_diffs()
+
+    def drain_telemetry(self):
+        """Hand everything Live wrote to the telemetry ring to Showtime as regular method events"""
+        frame = None
+        remaining = 0
+        for methodid, flags, wrapperid, value, timestamp in self.telemetry.records():
+            if remaining:
+                frame.msg["value"]["levels"][wrapperid] = value
+                remaining -= 1
+                if not remaining:
+                    self.event(frame)
+            elif flags & TelemetryRing.FLAG_FRAME:
+                keyframe = bool(flags & TelemetryRing.FLAG_KEYFRAME)
+                frame = SimpleMessage(methodid, {"value": {"keyframe": keyframe, "levels": {}}, "id": wrapperid}, timestamp)
+                remaining = int(value)
+                if not remaining:
+                    self.event(frame)
+            else:
+                self.event(SimpleMessage(methodid, {"value": value, "id": wrapperid}, timestamp))
+
+    def release_layout_diffs(self):
+        for diff in self.heldLayoutDiffs:
+            self.update_method(LiveRouter.LAYOUT_UPDATED, diff)
+        del self.heldLayoutDiffs[:]
+
+    def update_method(self, methodname, event):
+        self.scope_message(methodname, event.msg)
+        if self.router.update_method(methodname, event.msg):
+            self.record_latency(methodname, event)
+
+    def record_latency(self, methodname, event):
+        clock = self.udp.clock if self.udp else None
+        if event.timestamp is None or not clock or not clock.synced():
+            return
+        try:
+            histogram = self.latency[methodname]
+        except KeyError:
+            histogram = Histogram()
+            self.latency[methodname] = histogram
+        histogram.add(max(NetworkEndpoint.precise_milli_time() - clock.to_local(event.timestamp), 0.0))
+
+    # Showtime --> Live
+    # -----------------
+    def knows_method(self, methodname):
+        return methodname in self.methodIds
+
+    def send_to_live(self, message, args):
+        if not self.udp:
+            return
+        try:
+            subject = self.methodIds[message]
+        except KeyError:
+            subject = NetworkPrefixes.prefix_incoming(message)
+        return self.udp.send_msg(SimpleMessage(subject, args), True)
+
+    # Stats
+    # -----
+    def meter_levels(self):
+        return dict((self.scoped_id(wrapperid), level) for wrapperid, level in self.meterDecoder.levels.iteritems())
+
+    def latency_stats(self):
+        clock = self.udp.clock if self.udp else None
+        return {
+            "methods": dict((methodname, histogram.as_dict()) for methodname, histogram in self.latency.items()),
+            "clock": {"offset": clock.offset, "delay": clock.delay} if clock and clock.synced() else None
+        }
+
+    def stats(self):
+        """Traffic counters and message rates for this client since it connected"""
+        elapsed = max(time.time() - self.connectedAt, 0.001)
+        stats = {
+            "connectedFor": elapsed,
+            "transport": "unix" if self.tcp.socket.family == socket.AF_UNIX else "tcp",
+            "tcp": self.tcp.traffic.as_dict(),
+            "compression": self.tcp.compression_stats(),
+            "queueDelay": self.tcp.queueDelay.as_dict(),
+            "mailbox": self.tcp.outgoingMailbox.stats(),
+            "layoutVersion": self.layoutVersion
+        }
+        received = self.tcp.traffic["messagesIn"]
+        sent = self.tcp.traffic["messagesOut"]
+        if self.udp:
+            stats["udp"] = self.udp.traffic.as_dict()
+            stats["udp"].update(self.udp.sequence_stats())
+            received += self.udp.traffic["messagesIn"]
+            sent += self.udp.traffic["messagesOut"]
+        if self.telemetry:
+            stats["telemetry"] = self.telemetry.stats()
+        stats["messagesInPerSecond"] = received / elapsed
+        stats["messagesOutPerSecond"] = sent / elapsed
+        return stats
 
 
 class LiveRouter(threading.Thread):
-    def __init__(self, stageaddress):
+    # Method names the router treats specially
+    SONG_LAYOUT = "song_layout"
+    SONG_METERS = "song_meters"
+    LAYOUT_UPDATED = "layout_updated"
+
+    # Showtime method that reports message latency
+    LATENCY_STATS = "latency_stats"
+
+    # Default ports clients find the server on
+    UDP_PORT = 6001
+    TCP_PORT = 6003
+
+    # Seconds between drains of the clients' telemetry rings
+    TELEMETRY_INTERVAL = 0.01
+
+    # Milliseconds without a heartbeat from a client before its session is closed
+    SESSION_TIMEOUT = UDPEndpoint.HEARTBEAT_TIMEOUT
+
+    # Seconds a closed session can be resumed for
+    RESUME_WINDOW = 60
+
+    # Messages held for each method while Showtime registers it
+    PENDING_MESSAGE_LIMIT = 256
+
+    def __init__(self, stageaddress, udpport=UDP_PORT, tcpport=TCP_PORT, unixsockets=True, telemetry=True,
+                 timers=None, registrationworkers=Registrar.DEFAULT_WORKERS):
         threading.Thread.__init__(self)
         self.name = "LiveRouter"
         Log.set_log_network(True)
@@ -55,126 +586,290 @@ class LiveRouter(threading.Thread):
         self.node = ZstNode("LiveNode", stageaddress)
         self.node.start()
         self.node.request_register_node()
+        self.node.request_register_method(LiveRouter.LATENCY_STATS, ZstMethod.RESPONDER, None,
+                                          self.latency_stats_requested)
+
+        self.registrationWorkers = registrationworkers
+        self.registrar = self.create_registrar()
+
+        # Methods registered with Showtime on behalf of any client, and the hashes of whole method
+        # tables registered through manifests
+        self.registeredMethods = set()
+        self.registeredManifests = set()
+
+        # Messages from Live for methods Showtime is still registering, by method
+        self.pendingMessages = {}
+
+        # Persistent registrations. Write interest is only switched on while an endpoint has output queued
+        self.selector = DefaultSelector()
+        self.selectorLock = threading.Lock()
+
+        # Clients announce themselves with heartbeats on the UDP port and then connect over TCP.
+        # Once connected they get a UDP endpoint of their own
+        self.tcpEndpoint = TCPEndpoint(tcpport, -1, True, True)
+        self.udpEndpoint = UDPEndpoint(udpport, -1, True, self.serverID, False)
+        self.udpEndpoint.add_event_callback(self.discovery_event)
+        self.selector.register(self.tcpEndpoint.socket, EVENT_READ, (self.tcpEndpoint, self.accept_client))
+        self.register_endpoint(self.udpEndpoint, self.receive_udp)
+
+        # Clients on the same machine connect through a Unix socket named after our TCP port instead
+        self.unixSockets = unixsockets and UnixSockets.SUPPORTED
+        self.unixEndpoint = None
+        if self.unixSockets:
+            self.unixEndpoint = UnixStreamEndpoint(UnixSockets.path("server-%d" % tcpport), True, True)
+            self.selector.register(self.unixEndpoint.socket, EVENT_READ, (self.unixEndpoint, self.accept_client))
+
+        self.telemetry = telemetry
+        self.nextTelemetryDrain = 0
+
+        # Lets other threads cut the select wait short when they queue output or hand us a callback
+        self.waker = Waker()
+        self.selector.register(self.waker.reader, EVENT_READ, (self.waker, self.wakeup_received))
+        self.pendingCalls = collections.deque()
+
+        # Periodic jobs run on a shared timer thread. We start and stop our own if we weren't given one
+        self.timers = timers
+        self.ownsTimers = False
+        self.heartbeatTask = None
+
+        # Connected clients by TCP socket, and by namespace once they've handshaken
+        self.clients = {}
+        self.sessions = {}
+        self.clientCounter = 0
+
+        # Closed sessions by token, kept for a while in case their client comes back
+        self.retiredSessions = {}
 
-        # Create registration thread
-        self.registrar = RegistrationThread(self.node)
-        self.registrar.daemon = True
-        self.registrar.start()
-
-        # Create sockets
-        self.tcpEndpoint = TCPEndpoint(6003, 6004, True, True)
-        self.udpEndpoint = UDPEndpoint(6001, 6002, True, self.serverID)
-        self.tcpEndpoint.add_event_callback(self.event)
-        self.udpEndpoint.add_event_callback(self.event)
-        self.tcpEndpoint.add_ready_callback(self.endpoint_ready)
-        self.udpEndpoint.add_ready_callback(self.endpoint_ready)
-        self.inputSockets = {self.tcpEndpoint.socket: self.tcpEndpoint, self.udpEndpoint.socket: self.udpEndpoint}
-        self.outputSockets = {}
-
-        self.client = None
         self.clientConnected = False
         self.clientConnectedCallback = None
         self.set_client_connection_status(False)
 
     def run(self):
+        self.start_timers()
         while not self.exitFlag:
-            inputready = []
-            outputready = []
-            exceptready = []
+            self.handle_events(self.selector.select(self.select_timeout()))
+            self.drain_telemetry()
+        self.stop_timers()
+        self.selector.close()
+        self.waker.close()
+        self.join(1)
+
+    def start_timers(self):
+        if not self.timers:
+            self.timers = TimerThread()
+            self.ownsTimers = True
+            self.timers.start()
+        self.heartbeatTask = self.timers.call_every(UDPEndpoint.HEARTBEAT_DURATION / 2000.0, self.check_heartbeats,
+                                                    name="heartbeat checks")
+
+    def stop_timers(self):
+        if self.heartbeatTask:
+            self.timers.cancel(self.heartbeatTask)
+        if self.ownsTimers:
+            self.timers.stop()
+
+    def start_heartbeats(self, session):
+        """Heartbeat a client from the timer thread. Endpoints hold back heartbeats sent sooner than a
+        heartbeat duration apart, so running twice as often keeps the interval from drifting"""
+        session.heartbeatTask = self.timers.call_every(UDPEndpoint.HEARTBEAT_DURATION / 2000.0,
+                                                       session.udp.send_heartbeat,
+                                                       name="heartbeats %s" % session.namespace)
+
+    def stop_heartbeats(self, session):
+        """Cancel a client's heartbeats. Returns once a heartbeat being sent has gone out"""
+        if session.heartbeatTask:
+            self.timers.cancel(session.heartbeatTask)
+            session.heartbeatTask = None
+
+    def check_heartbeats(self):
+        """Look for clients that went quiet. Runs on the timer thread"""
+        now = NetworkEndpoint.current_milli_time()
+        for session in self.sessions.values():
+            if session.udp and now > session.udp.lastPeerHeartbeatTime + LiveRouter.SESSION_TIMEOUT:
+                self.call_soon(self.expire_sessions)
+                return
+
+    def expire_sessions(self):
+        """Close the sessions of clients we haven't heard a heartbeat from in a while"""
+        now = NetworkEndpoint.current_milli_time()
+        for session in self.sessions.values():
+            if session.udp and now > session.udp.lastPeerHeartbeatTime + LiveRouter.SESSION_TIMEOUT:
+                Log.network("No heartbeat from %s for %sms. Closing its session" % (
+                    session.namespace, now - session.udp.lastPeerHeartbeatTime))
+                self.close_client(session)
 
+    def call_soon(self, callback, *args):
+        """Run a callback on the router thread. Safe to call from any thread"""
+        self.pendingCalls.append((callback, args))
+        self.waker.wake()
+
+    def create_registrar(self):
+        return Registrar(self.node, self.registration_completed, self.registrationWorkers)
+
+    def handle_events(self, ready):
+        """Read from and flush the endpoints the selector found ready"""
+        for key, events in ready:
+            endpoint, reader = key.data
+            if events & EVENT_READ:
+                reader(endpoint)
+            if events & EVENT_WRITE and key.fileobj in self.selector:
+                self.flush_endpoint(endpoint)
+
+    # Endpoints
+    # ---------
+    def register_endpoint(self, endpoint, reader):
+        endpoint.add_ready_callback(self.endpoint_ready)
+        with self.selectorLock:
+            self.selector.register(endpoint.socket, EVENT_READ, (endpoint, reader))
+
+    def unregister_endpoint(self, endpoint):
+        # Unregister before closing so the selector never holds a dead descriptor
+        with self.selectorLock:
             try:
-                inputready, outputready, exceptready = select.select(self.inputSockets.keys(),
-                                                                     self.outputSockets.keys(), [], 1)
-            except socket.error, e:
-                if e[0] == NetworkErrors.EBADF:
-                    Log.error("Bad file descriptor! Probably a dead socket passed to select")
-                    Log.debug(self.inputSockets.keys())
-                    Log.debug(self.outputSockets.keys())
-
-            for s in inputready:
-                if s == self.tcpEndpoint.socket:
-                    if self.client:
-                        Log.error("Live instance already connected. Only one instance can be connected at a time!")
-                        return
-                    client, address = self.tcpEndpoint.socket.accept()
-                    Log.network("New client connecting. Socket is %s" % client)
-                    endpoint = TCPEndpoint(-1, -1, True, False, client)
-                    endpoint.add_event_callback(self.event)
-                    endpoint.add_client_handshake_callback(self.incoming_client_handshake)
-                    endpoint.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
-                    # endpoint.add_ready_callback(self.endpoint_ready)
-                    self.inputSockets[client] = endpoint
-                    self.outputSockets[client] = endpoint
-                    self.client = endpoint
-                    self.set_client_connection_status(True)
-                elif s == self.udpEndpoint.socket:
-                    try:
-                        self.udpEndpoint.recv_msg()
-                    except ReadError:
-                        pass
-                        # Log.network("Read failed. UDP probably closed. %s" % e)
-                    except RuntimeError, e:
-                        Log.network("Receive failed. Reason: %s" % e)
-                else:
-                    endpoint = self.inputSockets[s]
-                    try:
-                        endpoint.recv_msg()
-                    except (ReadError, RuntimeError):
-                        Log.network("Client socket closed")
-                        endpoint.close()
-                        self.set_client_connection_status(False)
-                        self.client = None
-                        try:
-                            del self.inputSockets[endpoint.socket]
-                            del self.outputSockets[endpoint.socket]
-                            try:
-                                outputready.remove(endpoint.socket)
-                            except ValueError:
-                                pass
-                        except KeyError:
-                            Log.network("Socket missing. In hangup")
-
-            for s in outputready:
-                try:
-                    endpoint = self.outputSockets[s]
-                except KeyError:
-                    continue
-
-                try:
-                    while 1:
-                        msg = endpoint.outgoingMailbox.get_nowait()
-                        endpoint.send(msg)
-                except Queue.Empty:
-                    pass
-
-                if endpoint.enteringImmediate:
-                    try:
-                        del self.outputSockets[endpoint.socket]
-                    except KeyError:
-                        pass
-                    endpoint.enteringImmediate = False
-                    endpoint.immediate = True
-
-            for s in exceptready:
-                Log.error("Socket %s in select() except list!. Check for errors." % s)
+                self.selector.unregister(endpoint.socket)
+            except KeyError:
+                Log.network("Socket missing. In hangup")
 
-        self.join(1)
+    def accept_client(self, listener):
+        client, address = listener.socket.accept()
+        Log.network("New client connecting from %s. Socket is %s" % (address, client))
+        endpoint = TCPEndpoint(-1, -1, True, False, client)
+        endpoint.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+        self.clients[client] = ClientSession(self, endpoint)
+        self.register_endpoint(endpoint, self.receive_client)
+
+    def claim_namespace(self, session, requested=None):
+        """Give a client a unique namespace for its wrapper IDs, honouring its request if it's free"""
+        if requested and requested not in self.sessions and ClientSession.NAMESPACE_DELIM not in requested:
+            namespace = requested
+        else:
+            self.clientCounter += 1
+            namespace = "live%d" % self.clientCounter
+            while namespace in self.sessions:
+                self.clientCounter += 1
+                namespace = "live%d" % self.clientCounter
+        self.sessions[namespace] = session
+        self.set_client_connection_status(True)
+        return namespace
+
+    def receive_udp(self, endpoint):
+        try:
+            endpoint.recv_msg()
+        except ReadError:
+            pass
+        except RuntimeError, e:
+            Log.network("Receive failed. Reason: %s" % e)
+
+    def receive_client(self, endpoint):
+        try:
+            endpoint.recv_msg()
+        except (ReadError, RuntimeError, socket.error):
+            self.close_client(self.clients[endpoint.socket])
+
+    def close_client(self, session):
+        session.close()
+        del self.clients[session.tcp.socket]
+        if session.namespace:
+            self.sessions.pop(session.namespace, None)
+        if session.token:
+            session.retiredAt = time.time()
+            self.retiredSessions[session.token] = session
+        self.set_client_connection_status(bool(self.sessions))
+
+    def resume_session(self, token):
+        """Take back a closed session for a client that reconnected with its token
+
+        Returns:
+            The closed ClientSession, or None if there's no session to resume.
+        """
+        now = time.time()
+        for expired in [t for t, s in self.retiredSessions.iteritems() if now - s.retiredAt > LiveRouter.RESUME_WINDOW]:
+            del self.retiredSessions[expired]
+        return self.retiredSessions.pop(token, None) if token else None
+
+    def flush_endpoint(self, endpoint):
+        """Write an endpoint's queued messages, dropping write interest once it has nothing left"""
+        if not endpoint.flush_mailbox():
+            return
+
+        if endpoint.enteringImmediate:
+            endpoint.enteringImmediate = False
+            endpoint.immediate = True
+
+        with self.selectorLock:
+            # Other threads queue messages and then call endpoint_ready, so checking the queues
+            # under the lock means a wakeup can never be lost between the flush and this point
+            if endpoint.outgoingMailbox.empty() and not endpoint.writer.pending() and \
+                    endpoint.socket in self.selector:
+                self.selector.modify(endpoint.socket, EVENT_READ)
 
     def endpoint_ready(self, endpoint):
-        Log.network("Marking output socket as having queued messages")
-        self.outputSockets[endpoint.socket] = endpoint
+        """Called from any thread once an endpoint has output waiting for the socket"""
+        with self.selectorLock:
+            if endpoint.socket not in self.selector or \
+                    self.selector.get_key(endpoint.socket).events & EVENT_WRITE:
+                return
+            self.selector.modify(endpoint.socket, EVENT_READ | EVENT_WRITE)
+        if threading.current_thread() is not self:
+            self.waker.wake()
+
+    def select_timeout(self):
+        """Wait no longer than the next telemetry drain is due"""
+        for session in self.sessions.values():
+            if session.telemetry:
+                return max(self.nextTelemetryDrain - time.time(), 0)
+        return 1
+
+    def drain_telemetry(self):
+        now = time.time()
+        if now < self.nextTelemetryDrain:
+            return
+        self.nextTelemetryDrain = now + LiveRouter.TELEMETRY_INTERVAL
+        for session in self.sessions.values():
+            if session.telemetry:
+                session.drain_telemetry()
+
+    def wakeup_received(self, waker):
+        waker.drain()
+        for i in xrange(len(self.pendingCalls)):
+            callback, args = self.pendingCalls.popleft()
+            callback(*args)
+
+    def discovery_event(self, event):
+        Log.network("Ignoring %s sent to the discovery port" % event.subject)
+
+    # Stats
+    # -----
+    def meter_levels(self):
+        """Latest level of every track of every client, rebuilt from Live's meter frames"""
+        levels = {}
+        for session in self.sessions.values():
+            levels.update(session.meter_levels())
+        return levels
+
+    def stats(self):
+        """Networking statistics, with throughput broken down per client"""
+        stats = {"messages": SimpleMessage.stats.as_dict()}
+        stats["messages"]["encodesPerMessage"] = SimpleMessage.encodes_per_message()
+        stats["clients"] = dict((session.namespace, session.stats()) for session in self.sessions.values())
+        stats["latency"] = self.latency_stats()
+        stats["timers"] = self.timers.stats() if self.timers else {}
+        stats["registration"] = self.registrar.stats()
+        return stats
+
+    def latency_stats(self):
+        """Latency percentiles in milliseconds for every method each client has sent, along with the
+        estimated offset of that client's clock from ours"""
+        return dict((session.namespace, session.latency_stats()) for session in self.sessions.values())
+
+    def latency_stats_requested(self, message):
+        return self.latency_stats()
 
     def set_client_connection_status(self, status):
         self.clientConnected = status
         if self.clientConnectedCallback:
             self.clientConnectedCallback()
 
-    def incoming_client_handshake(self):
-        Log.network("Client sent handshake")
-        if self.client:
-            self.client.send_handshake_ack()
-            self.client.enteringImmediate = True
-
     def stop(self):
         self.exitFlag = 1
 
@@ -183,22 +878,69 @@ class LiveRouter(threading.Thread):
         self.node.close()
         if hasattr(self, "stageNode"):
             self.stageNode.close()
+        for session in self.clients.values():
+            session.close()
         self.tcpEndpoint.close()
         self.udpEndpoint.close()
+        if self.unixEndpoint:
+            self.unixEndpoint.close()
 
-    def event(self, event):
-        methodname = event.subject[2:]
-        msgtype = event.subject[:1]
+    # Showtime
+    # --------
+    def register_method(self, methodname, methodaccess, methodargs):
+        """Register a client's method with Showtime. Clients share methods, so each name is only registered once"""
+        if methodname in self.registeredMethods:
+            return
+        self.registeredMethods.add(methodname)
+        self.pendingMessages[methodname] = collections.deque(maxlen=LiveRouter.PENDING_MESSAGE_LIMIT)
+        self.registrar.add_registration_request(methodname, methodaccess, methodargs, self.incoming)
 
-        if msgtype == NetworkPrefixes.REGISTRATION:
-            self.registrar.add_registration_request(methodname, event.msg["methodaccess"], event.msg["args"],
-                                                    self.incoming)
-        elif msgtype == NetworkPrefixes.OUTGOING or msgtype == NetworkPrefixes.RESPONDER:
-            Log.info("Live-->ST: " + str(event.subject) + '=' + str(event.msg))
-            if methodname in self.node.methods:
-                self.node.update_local_method_by_name(methodname, event.msg)
-            else:
-                print "Outgoing method not registered!"
+    def registration_completed(self, methodname, success):
+        # Called from the registrar
+        self.call_soon(self.method_registered, methodname, success)
+
+    def method_registered(self, methodname, success):
+        """Pass on the messages held while a method was registering. Failed methods can be registered
+        again by the next client that asks"""
+        held = self.pendingMessages.get(methodname)
+        if not success:
+            self.pendingMessages.pop(methodname, None)
+            self.registeredMethods.discard(methodname)
+            self.registeredManifests.clear()
+            if held:
+                Log.warn("Dropping %s messages for %s" % (len(held), methodname))
+            return
+
+        # The hold stays in place until it's empty, so anything sent while it flushes queues up
+        # behind the messages already waiting
+        while held:
+            self.node.update_local_method_by_name(methodname, held.popleft())
+        self.pendingMessages.pop(methodname, None)
+
+    def register_manifest(self, manifesthash, methods):
+        """Register a client's method table with Showtime, unless an identical table already was"""
+        if manifesthash and manifesthash in self.registeredManifests:
+            Log.network("Methods in manifest %s are already registered" % manifesthash)
+            return
+        for method in methods:
+            self.register_method(method["name"], method["methodaccess"], method["args"])
+        if manifesthash:
+            self.registeredManifests.add(manifesthash)
+
+    def update_method(self, methodname, msg):
+        Log.info("Live-->ST: " + str(methodname) + '=' + str(msg))
+
+        # Showtime can list a method before its registration completes here, so the hold decides
+        # first. Messages behind a hold wait for the ones before them
+        held = self.pendingMessages.get(methodname)
+        if held is not None:
+            held.append(msg)
+            return False
+        if methodname in self.node.methods:
+            self.node.update_local_method_by_name(methodname, msg)
+            return True
+        Log.warn("Outgoing method %s not registered" % methodname)
+        return False
 
     def incoming(self, message):
         Log.info("ST-->Live: " + str(message.name))
@@ -206,4 +948,27 @@ class LiveRouter(threading.Thread):
         self.send_to_live(message.name, args)
 
     def send_to_live(self, message, args):
-        return self.udpEndpoint.send_msg(SimpleMessage(NetworkPrefixes.prefix_incoming(message), args), True)
+        """Route a Showtime message to the client owning the wrapper it targets. Messages that
+        don't target a wrapper go to every client that registered the method"""
+        wrapperid = args.get("id") if isinstance(args, dict) else None
+        sessions = self.sessions.values()
+        if wrapperid is None:
+            for session in sessions:
+                if session.knows_method(message):
+                    session.send_to_live(message, args)
+            return
+
+        namespace, delim, localid = str(wrapperid).partition(ClientSession.NAMESPACE_DELIM)
+        if delim:
+            session = self.sessions.get(namespace)
+            if not session:
+                Log.warn("No client for %s" % wrapperid)
+                return
+            args = dict(args)
+            args["id"] = localid
+            return session.send_to_live(message, args)
+
+        if len(sessions) == 1:
+            # A lone client owns every ID, so unscoped IDs are still unambiguous
+            return sessions[0].send_to_live(message, args)
+        Log.warn("%s is missing a client namespace. Can't route %s" % (wrapperid, message))
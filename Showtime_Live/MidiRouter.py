@@ -1,41 +1,52 @@
 import rtmidi_python as rtmidi
-import threading
 import time
 import platform
 
+from Showtime_Live.TimerWheel import TimerThread
 
-class Clock(threading.Thread):
+
+class Clock:
     # ----
     # The clock class sends a 1ms midi CC message with an incrementing value
-    # that the Live ControlSurface can use to trigger faster event updates
+    # that the Live ControlSurface can use to trigger faster event updates.
+    # Ticks are a job on a timer thread that only runs while midi is active
     # ----
-    def __init__(self, midiport):
-        threading.Thread.__init__(self)
-        self.exitFlag = 0
-        self.setDaemon(True)
+    def __init__(self, midiport, timers):
         self.clockVal = 0
         self.rate = 0.001
         self.midi_out = midiport
+        self.timers = timers
+        self.task = None
         self.midi_active = False
 
+    def set_midi_active(self, state):
+        self.midi_active = state
+        if state and not self.task:
+            self.task = self.timers.call_every(self.rate, self.tick, name="midi clock")
+        elif not state and self.task:
+            self.timers.cancel(self.task)
+            self.task = None
+
     def stop(self):
-        self.midi_active = False
-        self.exitFlag = 1
+        self.set_midi_active(False)
 
-    def run(self):
-        while not self.exitFlag and self.midi_out:
-            self.clockVal += 1
-            self.clockVal %= 127
-            if self.midi_active:
-                self.midi_out.send_message([0xB0, 119, self.clockVal])
-            time.sleep(self.rate)
+    def tick(self):
+        self.clockVal += 1
+        self.clockVal %= 127
+        self.midi_out.send_message([0xB0, 119, self.clockVal])
 
 
 class MidiRouter:
     NOTE_ON = 0x90
     NOTE_OFF = 0x80
 
-    def __init__(self, midiportindex):
+    def __init__(self, midiportindex, timers=None):
+        # The clock runs on a shared timer thread. We start and stop our own if we weren't given one
+        self.ownsTimers = timers is None
+        self.timers = TimerThread() if self.ownsTimers else timers
+        if self.ownsTimers:
+            self.timers.start()
+
         # Setup midi port 
         self.midiportindex = midiportindex
         self.midi_active = False
@@ -45,9 +56,8 @@ class MidiRouter:
             return
 
         # Set up midi clock
-        self.clock = Clock(self.midi_out)
-        self.clock.start()
-        self.clock.midi_active = self.midi_active
+        self.clock = Clock(self.midi_out, self.timers)
+        self.clock.set_midi_active(self.midi_active)
 
         # Note tracking
         self.activeNotes = {}
@@ -58,7 +68,7 @@ class MidiRouter:
         self.midi_active = state
         if hasattr(self, "clock"):
             print "Clock found!"
-            self.clock.midi_active = state
+            self.clock.set_midi_active(state)
 
     def is_midi_active(self):
         return self.midi_active
@@ -88,6 +98,8 @@ class MidiRouter:
     def close(self):
         self.clock.stop()
         self.midi_out.close_port()
+        if self.ownsTimers:
+            self.timers.stop()
 
     def play_midi_note(self, message):
         trigger = MidiRouter.NOTE_ON
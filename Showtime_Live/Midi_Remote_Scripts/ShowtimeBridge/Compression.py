@@ -0,0 +1,75 @@
+try:
+    import zlib
+except ImportError:
+    zlib = None
+
+from Metrics import Counters
+
+
+class Compression:
+    """Negotiation helpers for per-connection payload compression"""
+    def __init__(self):
+        pass
+
+    ZLIB = "zlib"
+
+    # Payloads smaller than this aren't worth the compressor's time
+    DEFAULT_THRESHOLD = 2048
+
+    @staticmethod
+    def supported():
+        """Compression schemes this interpreter can offer"""
+        return [Compression.ZLIB] if zlib else []
+
+    @staticmethod
+    def negotiate(offered):
+        """Pick a compression scheme offered by a peer, or None"""
+        if offered:
+            for name in offered:
+                if name in Compression.supported():
+                    return name
+        return None
+
+
+class Compressor:
+    """Compresses large outgoing payloads into one zlib stream per connection.
+
+    Each compressed frame is sync flushed so the receiver can inflate it on arrival, while the
+    stream keeps its dictionary between frames so repeated layouts and notes compress well.
+    """
+    def __init__(self, threshold=Compression.DEFAULT_THRESHOLD, level=6):
+        self.threshold = threshold
+        self.stream = zlib.compressobj(level)
+        self.stats = Counters("frames", "bytesIn", "bytesOut")
+
+    def compress(self, payload):
+        data = self.stream.compress(payload) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        self.stats.increment("frames")
+        self.stats.increment("bytesIn", len(payload))
+        self.stats.increment("bytesOut", len(data))
+        return data
+
+    def ratio(self):
+        """Compressed size as a fraction of the original size"""
+        return float(self.stats["bytesOut"]) / self.stats["bytesIn"] if self.stats["bytesIn"] else 1.0
+
+
+class Decompressor:
+    """Inflates the compressed frames of a connection as one continuous zlib stream"""
+    def __init__(self):
+        self.stream = zlib.decompressobj()
+        self.stats = Counters("frames", "bytesIn", "bytesOut")
+
+    def decompress(self, data):
+        try:
+            payload = self.stream.decompress(data)
+        except zlib.error, e:
+            raise RuntimeError("Compressed stream corrupted. %s" % e)
+        self.stats.increment("frames")
+        self.stats.increment("bytesIn", len(data))
+        self.stats.increment("bytesOut", len(payload))
+        return payload
+
+    def ratio(self):
+        """Compressed size as a fraction of the inflated size"""
+        return float(self.stats["bytesIn"]) / self.stats["bytesOut"] if self.stats["bytesOut"] else 1.0
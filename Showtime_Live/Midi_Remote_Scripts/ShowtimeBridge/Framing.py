@@ -0,0 +1,226 @@
+import errno
+import socket
+import struct
+
+from Logger import Log
+
+# Error codes for a non-blocking socket that can't take any more data right now
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+
+
+class FrameReader:
+    """Reassembles length prefixed frames in a reusable receive buffer.
+
+    Sockets are read with recv_into straight into a preallocated bytearray, pulling everything
+    the socket has available in one call. Every complete frame in the buffer is then handed out
+    from a memoryview, so a single select wakeup can drain many messages without building
+    intermediate strings.
+    """
+    HEADER = struct.Struct("!I")
+    HEADER_SIZE = HEADER.size
+    INITIAL_SIZE = 65536
+    MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+    # The top bit of the length header marks a compressed payload
+    FLAG_COMPRESSED = 0x80000000
+    LENGTH_MASK = 0x7fffffff
+
+    def __init__(self, size=INITIAL_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.decompressor = None
+
+    def pending(self):
+        """Number of buffered bytes that haven't been handed out as frames yet"""
+        return self.end - self.start
+
+    def read_stream(self, sock):
+        """Append all available bytes from a stream socket to the buffer
+
+        Returns:
+            Number of bytes read. Zero if the socket had nothing to read.
+        """
+        self._reserve()
+        count = sock.recv_into(self.view[self.end:])
+        if count == 0:
+            raise RuntimeError("Socket returned empty string. Connection broken")
+        self.end += count
+        return count
+
+    def read_datagram(self, sock):
+        """Read a single datagram into the buffer. Datagrams always carry whole frames so any
+        unfinished frame left over from a previous datagram is discarded
+
+        Returns:
+            Tuple of number of bytes read and the sender address.
+        """
+        if self.start != self.end:
+            Log.warn("Discarding %d bytes of truncated datagram" % (self.end - self.start))
+        self.start = self.end = 0
+        count, address = sock.recvfrom_into(self.view)
+        self.end = count
+        return count, address
+
+    def read_prefix(self, header):
+        """Unpack a fixed size struct from the front of the buffered data and consume it"""
+        values = header.unpack_from(self.buffer, self.start)
+        self.start += header.size
+        return values
+
+    def skip(self, count):
+        """Discard buffered bytes"""
+        self.start = min(self.start + count, self.end)
+
+    def frames(self):
+        """Yield the payload of every complete frame in the buffer"""
+        unpack = FrameReader.HEADER.unpack_from
+        while self.end - self.start >= FrameReader.HEADER_SIZE:
+            header = unpack(self.buffer, self.start)[0]
+            framestart = self.start + FrameReader.HEADER_SIZE
+            frameend = framestart + (header & FrameReader.LENGTH_MASK)
+            if frameend > self.end:
+                break
+            self.start = frameend
+            if header & FrameReader.FLAG_COMPRESSED:
+                if not self.decompressor:
+                    raise RuntimeError("Received a compressed frame without negotiating compression")
+                yield self.decompressor.decompress(self.view[framestart:frameend].tobytes())
+            else:
+                yield self.view[framestart:frameend].tobytes()
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _reserve(self):
+        """Make room at the end of the buffer for the next read"""
+        pending = self.end - self.start
+        needed = FrameReader.HEADER_SIZE
+        if pending >= FrameReader.HEADER_SIZE:
+            needed = FrameReader.HEADER_SIZE + \
+                (FrameReader.HEADER.unpack_from(self.buffer, self.start)[0] & FrameReader.LENGTH_MASK)
+            if needed > FrameReader.MAX_FRAME_SIZE:
+                raise RuntimeError("Incoming frame of %d bytes exceeds the frame size limit" % needed)
+
+        # Slide the unfinished frame back to the front of the buffer once the tail runs low
+        if self.start > 0 and len(self.buffer) - self.end < max(needed - pending, len(self.buffer) / 4):
+            self.buffer[0:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+        # Frames bigger than the buffer grow it. The view has to be released before resizing
+        if needed > len(self.buffer):
+            self.view = None
+            self.buffer.extend(bytearray(needed - len(self.buffer)))
+            self.view = memoryview(self.buffer)
+
+
+class FrameWriter:
+    """Coalesces outgoing frames so a flush costs one send call.
+
+    Frames are queued as header/payload pairs and packed into a single buffer when flushed.
+    Whatever a non-blocking socket doesn't accept is kept along with the write offset and
+    retried on the next flush instead of spinning until the socket drains.
+    """
+    def __init__(self):
+        self.frames = []
+        self.buffer = ""
+        self.offset = 0
+        self.compressor = None
+
+    @staticmethod
+    def frame(payload):
+        """Prefix a payload with its length header"""
+        return FrameReader.HEADER.pack(len(payload)) + payload
+
+    def append(self, payload):
+        """Queue a payload to go out on the next flush. Large payloads are compressed if negotiated"""
+        if self.compressor and len(payload) >= self.compressor.threshold:
+            payload = self.compressor.compress(payload)
+            self.frames.append(FrameReader.HEADER.pack(len(payload) | FrameReader.FLAG_COMPRESSED))
+        else:
+            self.frames.append(FrameReader.HEADER.pack(len(payload)))
+        self.frames.append(payload)
+
+    def append_message(self, msg, endpoint):
+        """Queue a message, reusing its cached framed bytes unless it needs compressing"""
+        if self.compressor:
+            payload = endpoint.encode(msg)
+            if len(payload) >= self.compressor.threshold:
+                self.append(payload)
+                return
+        self.frames.append(endpoint.frame(msg))
+
+    def pending(self):
+        """Number of bytes waiting to be written"""
+        return len(self.buffer) - self.offset + sum(len(part) for part in self.frames)
+
+    def flush(self, sock):
+        """Write queued frames to the socket
+
+        Returns:
+            True if everything was written, False if the socket would block.
+        """
+        if self.frames:
+            if self.offset < len(self.buffer):
+                self.frames.insert(0, self.buffer[self.offset:])
+            self.buffer = "".join(self.frames)
+            self.offset = 0
+            del self.frames[:]
+
+        view = memoryview(self.buffer)
+        while self.offset < len(self.buffer):
+            try:
+                self.offset += sock.send(view[self.offset:])
+            except socket.error, e:
+                if e[0] in WOULD_BLOCK:
+                    return False
+                raise
+        self.buffer = ""
+        self.offset = 0
+        return True
+
+
+class DatagramPacker:
+    """Packs frames queued during a tick into as few datagrams as possible.
+
+    Frames keep their length headers so a receiving FrameReader splits a packed datagram
+    back into messages. Datagrams are capped at the path MTU so they're never fragmented,
+    except for a single frame that is bigger than the cap on its own.
+    """
+    # Ethernet MTU minus IP and UDP headers, with room to spare for tunnels
+    MAX_DATAGRAM_SIZE = 1400
+
+    def __init__(self, maxsize=MAX_DATAGRAM_SIZE):
+        self.maxsize = maxsize
+        self.frames = []
+
+    def append_frame(self, frame):
+        """Queue a payload that already has its length header"""
+        self.frames.append(frame)
+
+    def pending(self):
+        """Number of frames waiting to be packed"""
+        return len(self.frames)
+
+    def pack(self):
+        """Pack all queued frames into datagrams and clear the queue
+
+        Returns:
+            List of datagram strings in send order.
+        """
+        datagrams = []
+        current = []
+        size = 0
+        for frame in self.frames:
+            if current and size + len(frame) > self.maxsize:
+                datagrams.append("".join(current))
+                current = []
+                size = 0
+            current.append(frame)
+            size += len(frame)
+        if current:
+            datagrams.append("".join(current))
+        del self.frames[:]
+        return datagrams
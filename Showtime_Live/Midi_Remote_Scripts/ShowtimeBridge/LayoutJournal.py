@@ -0,0 +1,57 @@
+import collections
+
+
+class LayoutJournal:
+    """Numbered history of the layout diffs sent to the server.
+
+    Every diff gets the next layout version. The server remembers the last version it applied for
+    a session, so a client that reconnects only resends the diffs after that version instead of
+    its whole layout. The journal is bounded. A server that fell further behind than the journal
+    reaches gets the full layout again.
+    """
+    DEFAULT_CAPACITY = 512
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.version = 0
+        self.entries = collections.deque()
+
+    def record(self, diffs):
+        """Add a diff to the journal
+
+        Args:
+            diffs: List of layout diff items
+
+        Returns:
+            Layout version of the diff.
+        """
+        self.version += 1
+        self.entries.append((self.version, diffs))
+        if len(self.entries) > self.capacity:
+            self.entries.popleft()
+        return self.version
+
+    def since(self, version):
+        """Diffs recorded after a version, and forget everything up to it
+
+        Args:
+            version: Last layout version the server applied
+
+        Returns:
+            List of (version, diffs) tuples oldest first, or None if the journal no longer reaches
+            back to the version.
+        """
+        if version > self.version:
+            return None
+        while self.entries and self.entries[0][0] <= version:
+            self.entries.popleft()
+        if version < self.version and (not self.entries or self.entries[0][0] != version + 1):
+            return None
+        return list(self.entries)
+
+    def stats(self):
+        return {
+            "version": self.version,
+            "entries": len(self.entries),
+            "oldest": self.entries[0][0] if self.entries else None
+        }
@@ -1,23 +1,74 @@
-import Queue
+import collections
+import os
 import select
 import socket
+import sys
+import time
+
+try:
+    import hashlib
+except ImportError:
+    hashlib = None
 
 from LiveWrappers.LiveWrapper import LiveWrapper
 from LiveWrappers.LiveSong import LiveSong
+from LayoutJournal import LayoutJournal
 from Logger import Log
-from NetworkEndpoint import SimpleMessage, NetworkPrefixes, NetworkErrors, NetworkEndpoint, ReadError
+from Mailbox import MessageClasses
+from MessageCodecs import Codecs
+from Metrics import Counters, Histogram
+from NetworkEndpoint import SimpleMessage, NetworkPrefixes, NetworkErrors, NetworkEndpoint, ReadError, Backoff
 from TCPEndpoint import TCPEndpoint
+from TelemetryRing import TelemetryRing
 from UDPEndpoint import UDPEndpoint
+from UnixEndpoint import UnixSockets, UnixStreamEndpoint, UnixDatagramEndpoint
+
+# Windows' wall clock only moves every few milliseconds, too coarse for timing a tick
+default_timer = time.clock if sys.platform == "win32" else time.time
 
 
 class LiveNetworkEndpoint:
+    # Where to find the server. Rigs running several copies of Live can point each one at its server
+    # through the environment
+    SERVER_HOST = os.environ.get("SHOWTIME_LIVE_HOST", "127.0.0.1")
+    SERVER_UDP_PORT = int(os.environ.get("SHOWTIME_LIVE_UDP_PORT", 6001))
+    SERVER_TCP_PORT = int(os.environ.get("SHOWTIME_LIVE_TCP_PORT", 6003))
+
+    # How a backed up stream connection treats our messages. Other responses are dropped once it's full
+    MESSAGE_CLASSES = {
+        LiveWrapper.LAYOUT_UPDATED: MessageClasses.LAYOUT_DIFF,
+        LiveSong.SONG_LAYOUT: MessageClasses.LAYOUT
+    }
+
+    # Bytes each endpoint's mailbox may send per tick. Whatever doesn't fit waits for the next
+    # tick, highest priority first
+    OUTPUT_BYTES_PER_TICK = 65536
+
+    # Microseconds of Live's main thread each poll may spend reading and handling incoming
+    # messages. Messages that don't fit are handled first thing next tick
+    POLL_BUDGET_US = int(os.environ.get("SHOWTIME_LIVE_POLL_BUDGET_US", 2000))
+
+    # Messages that can wait for a later tick. Past this the stream socket is left unread so TCP
+    # pushes back on the server, and datagrams are dropped
+    MAX_CARRY_OVER = 1024
+
+    # Seconds between failed stream connects, doubling up to the maximum
+    RECONNECT_BACKOFF_MIN = 0.25
+    RECONNECT_BACKOFF_MAX = 8
+
     def __init__(self):
         self.getsong = None
-        self.requestLock = True
         self.incomingActions = {}
-        self.udpEndpoint = UDPEndpoint(6002, 6001, False)
-        self.tcpEndpoint = TCPEndpoint(6004, 6003, False, False)
-        self.udpEndpoint.add_event_callback(self.event_received)
+        self.methodIds = {}
+        self.methodPriorities = {}
+
+        # Local ports are picked by the OS so several instances of Live can share a machine
+        self.discoveryAddr = (LiveNetworkEndpoint.SERVER_HOST, LiveNetworkEndpoint.SERVER_UDP_PORT)
+        self.udpEndpoint = UDPEndpoint(0, LiveNetworkEndpoint.SERVER_UDP_PORT, False)
+        self.udpEndpoint.remoteAddr = self.discoveryAddr
+        self.tcpEndpoint = TCPEndpoint(0, LiveNetworkEndpoint.SERVER_TCP_PORT, False, False)
+        self.tcpEndpoint.remoteAddr = (LiveNetworkEndpoint.SERVER_HOST, LiveNetworkEndpoint.SERVER_TCP_PORT)
+        self.udpEndpoint.add_event_callback(self.datagram_received)
         self.tcpEndpoint.add_event_callback(self.event_received)
         self.tcpEndpoint.add_handshake_ack_callback(self.handshake_complete)
         self.udpEndpoint.add_ready_callback(self.endpoint_ready)
@@ -25,12 +76,52 @@ class LiveNetworkEndpoint:
         self.inputSockets = {self.udpEndpoint.socket: self.udpEndpoint}
         self.outputSockets = {}
 
+        # Messages read from the sockets but not handled yet, and what each poll got through
+        self.pollBudget = LiveNetworkEndpoint.POLL_BUDGET_US
+        self.incomingEvents = collections.deque()
+        self.pollCounters = Counters("ticks", "messages", "overBudget", "streamPaused", "droppedDatagrams")
+        self.pollTime = Histogram()
+        self.pollMessages = Histogram()
+        self.pollCarryOver = Histogram()
+
+        # A server on this machine is reached through Unix sockets instead, skipping the loopback
+        # network stack. TCP and UDP stay in place for remote servers and for servers without them
+        self.unixStreamEndpoint = None
+        self.unixDatagramEndpoint = None
+        if UnixSockets.SUPPORTED and UnixSockets.is_local(LiveNetworkEndpoint.SERVER_HOST):
+            self.unixStreamEndpoint = UnixStreamEndpoint(
+                UnixSockets.path("server-%d" % LiveNetworkEndpoint.SERVER_TCP_PORT), False, False)
+            self.unixStreamEndpoint.add_event_callback(self.event_received)
+            self.unixStreamEndpoint.add_handshake_ack_callback(self.handshake_complete)
+
+        # Paces stream connects to a server that answers heartbeats but won't take the connection
+        self.reconnectBackoff = Backoff(LiveNetworkEndpoint.RECONNECT_BACKOFF_MIN,
+                                        LiveNetworkEndpoint.RECONNECT_BACKOFF_MAX)
+
+        # Endpoints currently carrying the session
+        self.streamEndpoint = self.tcpEndpoint
+        self.datagramEndpoint = self.udpEndpoint
+
+        # Shared memory ring for high rate telemetry, given to us by a server on this machine
+        self.telemetry = None
+        self.telemetryMethods = set()
+
+        # The wrapper tree outlives connections. A server that still holds our session gets the
+        # layout diffs it missed instead of everything again
+        self.song = None
+        self.sessionToken = None
+        self.layoutJournal = LayoutJournal()
+
     def set_song_root_accessor(self, songgetter):
         self.getsong = songgetter
 
     def close(self):
         self.udpEndpoint.close()
         self.tcpEndpoint.close()
+        for endpoint in (self.unixStreamEndpoint, self.unixDatagramEndpoint):
+            if endpoint:
+                endpoint.close()
+        self.close_telemetry()
 
     def sync_actions(self):
         # Register methods to the showtimebridge server
@@ -38,128 +129,324 @@ class LiveNetworkEndpoint:
         wrapperclasses.append(LiveWrapper)
         for cls in wrapperclasses:
             cls.register_methods()
+        self.incomingActions.clear()
+        self.methodIds.clear()
+        self.telemetryMethods.clear()
+        self.methodPriorities.clear()
+        methods = []
         for action in LiveWrapper.incoming_methods().values():
             Log.network("Adding %s to incoming callbacks" % action.methodName)
             self.add_incoming_action(action.methodName, action.callback)
-            self.register_to_showtime(action.methodName, action.methodAccess, action.methodArgs)
+            methods.append((action.methodName, action.methodAccess, action.methodArgs))
+            self.methodPriorities[action.methodName] = action.priority
         for action in LiveWrapper.outgoing_methods().values():
             Log.network("Adding %s to outgoing callbacks" % action.methodName)
-            self.register_to_showtime(action.methodName, action.methodAccess)
+            methods.append((action.methodName, action.methodAccess, None))
+            self.methodPriorities[action.methodName] = action.priority
+            if action.telemetry:
+                self.telemetryMethods.add(self.method_id(action.methodName))
+
+        if self.streamEndpoint.peerHandshake.get("manifests"):
+            self.send_manifest(methods)
+        else:
+            # Servers that predate manifests take one registration per method
+            for methodname, methodaccess, methodargs in methods:
+                self.register_to_showtime(methodname, methodaccess, methodargs)
+
+    def method_id(self, methodname):
+        """Get the wire ID for a method, allocating one the first time the method is seen.
+        A method name shares one ID in both directions so responders can reply on their own ID
+        """
+        try:
+            return self.methodIds[methodname]
+        except KeyError:
+            methodid = len(self.methodIds)
+            self.methodIds[methodname] = methodid
+            return methodid
 
     def add_incoming_action(self, action, callback):
+        # Servers that don't know our method IDs yet still address us with prefixed names
+        self.incomingActions[self.method_id(action)] = callback
         self.incomingActions[NetworkPrefixes.prefix_incoming(action)] = callback
 
     def send_to_showtime(self, message, args, responding=False):
         ret = None
+        try:
+            subject = self.methodIds[message]
+        except KeyError:
+            subject = NetworkPrefixes.prefix_outgoing(message)
+
+        # Stamped so the server can measure how long the message takes to reach Showtime
+        created = NetworkEndpoint.precise_milli_time()
+        priority = self.methodPriorities.get(message)
+        if message == LiveWrapper.LAYOUT_UPDATED:
+            # Journaled even while disconnected so the diff can be resent when we resume
+            args["version"] = self.layoutJournal.record(args["val"])
         if responding:
-            if self.tcpEndpoint.connectionStatus == NetworkEndpoint.HANDSHAKE_COMPLETE:
-                msg = str(SimpleMessage(NetworkPrefixes.prefix_outgoing(message), args))
-                ret = self.tcpEndpoint.send_msg(msg)
+            if self.streamEndpoint.connectionStatus == NetworkEndpoint.HANDSHAKE_COMPLETE:
+                msg = SimpleMessage(subject, args, created, LiveNetworkEndpoint.MESSAGE_CLASSES.get(
+                    message, MessageClasses.RESPONSE), priority)
+                # Encode before queueing so later changes to args can't leak into the queued message
+                self.streamEndpoint.encode(msg)
+                ret = self.streamEndpoint.send_msg(msg)
         else:
-            msg = SimpleMessage(NetworkPrefixes.prefix_outgoing(message), args)
-            ret = self.udpEndpoint.send_msg(msg, True)
+            if self.telemetry and subject in self.telemetryMethods and self.send_telemetry(subject, args, created):
+                return ret
+            # Packed into datagrams and sent when the tick is flushed
+            messageclass = MessageClasses.TELEMETRY if subject in self.telemetryMethods else MessageClasses.RESPONSE
+            ret = self.datagramEndpoint.queue_msg(SimpleMessage(subject, args, created, messageclass, priority))
         return ret
 
+    def send_telemetry(self, methodid, args, created):
+        """Write a telemetry message to the shared memory ring
+
+        Returns:
+            False if the message doesn't fit the ring's records and has to go over the socket.
+        """
+        value = args.get("value")
+        if isinstance(value, dict) and "levels" in value:
+            # Meter frames keep their keyframe flag so the server can drop tracks that went away
+            return self.telemetry.append_frame(methodid, args.get("id"), value["levels"], created, value["keyframe"])
+        return self.telemetry.append(methodid, args.get("id"), value, created)
+
+    def flush(self):
+        """Send what this tick's budget allows of the messages queued for Showtime"""
+        self.datagramEndpoint.flush_mailbox()
+        if self.telemetry:
+            self.telemetry.commit()
+
+    def outbox_stats(self):
+        """Sizes, drops and per priority queue latency of the mailboxes carrying the session"""
+        return {
+            "stream": self.streamEndpoint.outgoingMailbox.stats(),
+            "datagram": self.datagramEndpoint.outgoingMailbox.stats()
+        }
+
     def register_to_showtime(self, message, methodaccess, methodargs=None):
-        return self.tcpEndpoint.send_msg(SimpleMessage(
+        return self.streamEndpoint.send_msg(SimpleMessage(
                 NetworkPrefixes.prefix_registration(message),
-                {"args": methodargs, "methodaccess": methodaccess}), True)
+                {"args": methodargs, "methodaccess": methodaccess, "methodid": self.method_id(message)}), True)
+
+    def send_manifest(self, methods):
+        """Register our whole method table with one message. The content hash lets the server skip
+        tables it has already registered with Showtime
+
+        Args:
+            methods: List of (name, access, args) tuples
+        """
+        entries = [{"name": methodname, "methodaccess": methodaccess, "args": methodargs,
+                    "methodid": self.method_id(methodname)} for methodname, methodaccess, methodargs in methods]
+        manifest = {"methods": entries, "hash": LiveNetworkEndpoint.manifest_hash(methods)}
+        Log.network("Registering %s methods with manifest %s" % (len(entries), manifest["hash"]))
+        return self.streamEndpoint.send_msg(SimpleMessage(NetworkPrefixes.prefix_manifest("methods"), manifest), True)
+
+    @staticmethod
+    def manifest_hash(methods):
+        """Hash of the names, access types and arguments of a method table. Wire IDs aren't part of
+        it since they only mean something to one connection"""
+        if not hashlib:
+            return None
+        table = sorted((methodname, methodaccess, sorted(methodargs.keys()) if methodargs else None)
+                       for methodname, methodaccess, methodargs in methods)
+        return hashlib.sha1(repr(table)).hexdigest()
 
     def poll(self):
         self.ensure_server_available()
+        self.streamEndpoint.reset_budget(LiveNetworkEndpoint.OUTPUT_BYTES_PER_TICK)
+        self.datagramEndpoint.reset_budget(LiveNetworkEndpoint.OUTPUT_BYTES_PER_TICK)
 
-        # Loop through all messages in the socket till it's empty
-        # If the lock is active, then the queue is not empty
-        requestcounter = 0
-        while self.requestLock:
-            self.requestLock = False
-            badsockets = []
-            inputready = None
-            outputready = None
+        # The sockets are read and flushed every tick, so heartbeats and queued output keep moving
+        # however much is waiting. Reading counts against the budget along with handling messages.
+        # Messages carried over from earlier ticks go first so they keep their order
+        started = default_timer()
+        deadline = started + self.pollBudget / 1000000.0
+        self.read_sockets()
+        processed = 0
+        while self.incomingEvents:
+            # Always get through one message so a tiny budget still makes progress
+            if processed and default_timer() >= deadline:
+                break
+            self.dispatch_event(self.incomingEvents.popleft())
+            processed += 1
+            if not self.incomingEvents and default_timer() < deadline:
+                self.read_sockets()
+        self.record_poll((default_timer() - started) * 1000000.0, processed)
 
-            try:
-                inputready, outputready, exceptready = select.select(
-                        self.inputSockets.keys(),
-                        self.outputSockets.keys(),
-                        badsockets, 0)
-            except socket.error, e:
-                if e[0] == NetworkErrors.EBADF:
-                    Log.error("Bad file descriptor! Probably a dead socket passed to select")
-                    Log.debug(self.inputSockets.keys())
-                    Log.debug(self.outputSockets.keys())
+    def read_sockets(self):
+        """Read whatever the sockets have for us and flush the ones that can take more output. The
+        stream socket is skipped while too many messages are waiting to be handled"""
+        badsockets = []
+        inputready = None
+        outputready = None
+
+        inputsockets = self.inputSockets.keys()
+        if len(self.incomingEvents) >= LiveNetworkEndpoint.MAX_CARRY_OVER:
+            self.pollCounters.increment("streamPaused")
+            inputsockets = [s for s in inputsockets if not isinstance(self.inputSockets[s], TCPEndpoint)]
+
+        try:
+            inputready, outputready, exceptready = select.select(
+                    inputsockets,
+                    self.outputSockets.keys(),
+                    badsockets, 0)
+        except socket.error, e:
+            if e[0] == NetworkErrors.EBADF:
+                Log.error("Bad file descriptor! Probably a dead socket passed to select")
+                Log.debug(self.inputSockets.keys())
+                Log.debug(self.outputSockets.keys())
 
-            if badsockets:
-                Log.error("Bad sockets: %s" % badsockets)
+        if badsockets:
+            Log.error("Bad sockets: %s" % badsockets)
 
-            if inputready:
-                for s in inputready:
-                    endpoint = self.inputSockets[s]
+        if inputready:
+            for s in inputready:
+                endpoint = self.inputSockets[s]
+                try:
+                    endpoint.recv_msg()
+                except (ReadError, RuntimeError), e:
+                    Log.error("Socket receive error! Closing %s. Reason: %s" % (endpoint, e))
+                    endpoint.close()
                     try:
-                        endpoint.recv_msg()
-                    except (ReadError, RuntimeError), e:
-                        Log.error("Socket receive error! Closing %s. Reason: %s" % (endpoint, e))
-                        endpoint.close()
+                        del self.inputSockets[endpoint.socket]
+                        del self.outputSockets[endpoint.socket]
                         try:
-                            del self.inputSockets[endpoint.socket]
-                            del self.outputSockets[endpoint.socket]
-                            try:
-                                outputready.remove(endpoint.socket)
-                            except ValueError:
-                                pass
-                        except KeyError:
-                            Log.network("Socket missing. In input hangup")
-                        continue
-
-            if outputready:
-                for s in outputready:
-                    endpoint = self.outputSockets[s]
-                    try:
-                        while 1:
-                            msg = endpoint.outgoingMailbox.get_nowait()
-                            endpoint.send(msg)
-                    except Queue.Empty:
-                        pass
-                        # Remove output socket from select once it's done sending
-                        # del self.outputSockets[endpoint.socket]
-
-            requestcounter += 1
-        self.requestLock = True
-        if requestcounter > 10:
-            Log.warn(str(requestcounter) + " loops to clear queue")
+                            outputready.remove(endpoint.socket)
+                        except ValueError:
+                            pass
+                    except KeyError:
+                        Log.network("Socket missing. In input hangup")
+                    continue
 
-    def ensure_server_available(self):
-        udpactive = self.udpEndpoint.check_heartbeat()
-        if udpactive and self.tcpEndpoint.connectionStatus is NetworkEndpoint.PIPE_DISCONNECTED and not \
-                self.tcpEndpoint.hangup:
-            Log.network("Heartbeat found! Reconnecting TCP to " + str(self.tcpEndpoint.remoteAddr))
+        if outputready:
+            for s in outputready:
+                endpoint = self.outputSockets[s]
+                endpoint.flush_mailbox()
+
+    def record_poll(self, elapsed, processed):
+        self.pollCounters.increment("ticks")
+        self.pollCounters.increment("messages", processed)
+        if elapsed > self.pollBudget:
+            self.pollCounters.increment("overBudget")
+        self.pollTime.add(elapsed)
+        self.pollMessages.add(processed)
+        self.pollCarryOver.add(len(self.incomingEvents))
 
-            if self.tcpEndpoint.connect():
-                self.inputSockets[self.tcpEndpoint.socket] = self.tcpEndpoint
-                self.outputSockets[self.tcpEndpoint.socket] = self.tcpEndpoint
-                Log.network("TCP connection established. Socket is %s" % self.tcpEndpoint.socket)
-            else:
-                Log.warn("TCP not up yet!")
+    def poll_stats(self):
+        """Microseconds spent, messages handled and messages carried over per poll"""
+        stats = self.pollCounters.as_dict()
+        stats.update({
+            "budgetMicros": self.pollBudget,
+            "carriedOver": len(self.incomingEvents),
+            "tickMicros": self.pollTime.as_dict(),
+            "messagesPerTick": self.pollMessages.as_dict(),
+            "carryOverDepth": self.pollCarryOver.as_dict()
+        })
+        return stats
 
-        if not udpactive and self.tcpEndpoint.connectionStatus >= NetworkEndpoint.PIPE_CONNECTED:
-            Log.network("Heartbeat lost. Closing TCP")
+    def ensure_server_available(self):
+        # Our heartbeats announce us to the server, which echoes them back
+        self.datagramEndpoint.send_heartbeat()
+        udpactive = self.datagramEndpoint.check_heartbeat()
+        if udpactive and self.streamEndpoint.connectionStatus is NetworkEndpoint.PIPE_DISCONNECTED and not \
+                self.streamEndpoint.hangup:
+            if self.connect_stream():
+                self.inputSockets[self.streamEndpoint.socket] = self.streamEndpoint
+                self.outputSockets[self.streamEndpoint.socket] = self.streamEndpoint
+                Log.network("Stream connection established. Socket is %s" % self.streamEndpoint.socket)
+
+        if not udpactive and self.tcpEndpoint.connecting():
+            Log.network("Heartbeat lost. Abandoning TCP connect")
             self.tcpEndpoint.close()
+            self.tcpEndpoint.hangup = False
+
+        if not udpactive and self.streamEndpoint.connectionStatus >= NetworkEndpoint.PIPE_CONNECTED:
+            Log.network("Heartbeat lost. Closing stream connection")
+            self.streamEndpoint.close()
             try:
-                del self.inputSockets[self.tcpEndpoint.socket]
-                del self.outputSockets[self.tcpEndpoint.socket]
+                del self.inputSockets[self.streamEndpoint.socket]
+                del self.outputSockets[self.streamEndpoint.socket]
             except KeyError:
-                Log.error("TCP already removed from pollable sockets")
+                Log.error("Stream connection already removed from pollable sockets")
+
+        if self.streamEndpoint.connectionStatus == NetworkEndpoint.PIPE_CONNECTED:
+            handshake = {"udpport": self.udpEndpoint.socket.getsockname()[1]}
+            unixpath = self.unix_datagram_path()
+            if unixpath:
+                handshake["unixpath"] = unixpath
+            if UnixSockets.is_local(LiveNetworkEndpoint.SERVER_HOST):
+                handshake["telemetry"] = True
+            if self.sessionToken:
+                handshake["session"] = self.sessionToken
+            self.streamEndpoint.send_handshake(handshake)
+
+    def connect_stream(self):
+        """Connect to the server over its Unix socket if it has one on this machine, otherwise over TCP.
+
+        TCP connects are non-blocking and take as many ticks as the server needs to accept them.
+        Failed attempts back off exponentially, so a server that answers heartbeats but refuses
+        connections isn't hammered from Live's main thread.
+
+        Returns:
+            Connection status of the endpoint now carrying the session.
+        """
+        if not self.tcpEndpoint.connecting():
+            if not self.reconnectBackoff.ready():
+                return NetworkEndpoint.PIPE_DISCONNECTED
 
-        if self.tcpEndpoint.connectionStatus == NetworkEndpoint.PIPE_CONNECTED:
-            self.tcpEndpoint.send_handshake()
+            if self.unixStreamEndpoint:
+                Log.network("Heartbeat found! Connecting to " + str(self.unixStreamEndpoint.remoteAddr))
+                if self.unixStreamEndpoint.connect():
+                    self.streamEndpoint = self.unixStreamEndpoint
+                    self.reconnectBackoff.reset()
+                    return self.streamEndpoint.connectionStatus
+
+            Log.network("Heartbeat found! Reconnecting TCP to " + str(self.tcpEndpoint.remoteAddr))
+            self.streamEndpoint = self.tcpEndpoint
+
+        status = self.tcpEndpoint.connect()
+        if status:
+            self.reconnectBackoff.reset()
+        elif not self.tcpEndpoint.connecting():
+            Log.warn("TCP not up yet! Retrying in %.2f seconds" % self.reconnectBackoff.failed())
+        return status
+
+    def unix_datagram_path(self):
+        """Socket file the server can send our datagrams to, bound the first time it's needed"""
+        if not self.unixStreamEndpoint:
+            return None
+        if not self.unixDatagramEndpoint:
+            try:
+                self.unixDatagramEndpoint = UnixDatagramEndpoint(
+                    UnixSockets.path("bridge-%d-%x" % (os.getpid(), id(self))), None, False)
+            except socket.error, e:
+                Log.warn("Can't bind a Unix datagram socket. Staying on UDP. %s" % e)
+                self.unixStreamEndpoint = None
+                return None
+            self.unixDatagramEndpoint.add_event_callback(self.datagram_received)
+            self.unixDatagramEndpoint.add_ready_callback(self.endpoint_ready)
+            self.unixDatagramEndpoint.add_closing_callback(self.heartbeat_lost)
+            self.inputSockets[self.unixDatagramEndpoint.socket] = self.unixDatagramEndpoint
+        return self.unixDatagramEndpoint.path
 
     def event_received(self, event):
-        self.requestLock = True  # Lock the request loop
-        Log.info("Received method " + event.subject[2:])
+        # Handled by the poll loop as its budget allows
+        self.incomingEvents.append(event)
+
+    def datagram_received(self, event):
+        # Datagrams can't be pushed back on, and are still read while the stream is paused so
+        # heartbeats get through. What the carry-over has no room for is lost like any datagram
+        if len(self.incomingEvents) >= LiveNetworkEndpoint.MAX_CARRY_OVER:
+            self.pollCounters.increment("droppedDatagrams")
+            return
+        self.incomingEvents.append(event)
+
+    def dispatch_event(self, event):
+        Log.info("Received method %s" % event.subject)
         Log.info("Args are:" + str(event.msg))
         try:
             self.incomingActions[event.subject](event.msg)
         except KeyError:
-            Log.error("Nothing registered for incoming action " + event.subject)
+            Log.error("Nothing registered for incoming action %s" % event.subject)
 
     # Socket Callbacks
     # ---------
@@ -168,10 +455,72 @@ class LiveNetworkEndpoint:
 
     def handshake_complete(self):
         Log.network("Handshake completed")
+        ack = self.streamEndpoint.peerHandshake
+
+        # The server gives every client its own datagram endpoint, over a Unix socket if it picked one
+        if ack.get("unixpath") and self.unixDatagramEndpoint:
+            self.unixDatagramEndpoint.remoteAddr = ack["unixpath"]
+            self.unixDatagramEndpoint.take_over_heartbeat(self.datagramEndpoint)
+            self.unixDatagramEndpoint.connect_peer(self.streamEndpoint.codec)
+            self.datagramEndpoint = self.unixDatagramEndpoint
+            Log.network("Session is %s on %s" % (ack.get("namespace"), ack["unixpath"]))
+        elif ack.get("udpport"):
+            # The server's session socket only takes our datagrams, but ours also hears discovery
+            # replies, so we keep decoding the default codec
+            self.udpEndpoint.remoteAddr = (LiveNetworkEndpoint.SERVER_HOST, ack["udpport"])
+            self.udpEndpoint.codec = self.streamEndpoint.codec
+            Log.network("Session is %s on UDP port %s" % (ack.get("namespace"), ack["udpport"]))
+
+        self.close_telemetry()
+        if ack.get("telemetry"):
+            try:
+                self.telemetry = TelemetryRing(ack["telemetry"])
+                Log.network("Sending telemetry through %s" % ack["telemetry"])
+            except (EnvironmentError, ValueError), e:
+                Log.warn("Can't open telemetry ring. Sending telemetry over the network. %s" % e)
+
+        # A resumed session still has our method registrations and the layout up to the version it acked
+        resumed = ack.get("resumed") and ack.get("session") == self.sessionToken and self.song
+        self.sessionToken = ack.get("session")
+        if resumed:
+            Log.network("Resumed session at layout version %s of %s" % (
+                ack.get("layoutVersion"), self.layoutJournal.version))
+            self.resend_layout_diffs(ack.get("layoutVersion", 0))
+            return
+
         self.sync_actions()
+        if self.song:
+            LiveWrapper.queue_layout_snapshot()
+        else:
+            # Add wrappers to Live objects
+            self.song = LiveSong.add_instance(LiveSong(self.getsong()))
 
-        # Add wrappers to Live objects
-        LiveSong.add_instance(LiveSong(self.getsong()))
+    def resend_layout_diffs(self, version):
+        """Send the journaled layout diffs after a version, or the whole layout if the journal doesn't
+        reach back that far"""
+        entries = self.layoutJournal.since(version)
+        if entries is None:
+            Log.network("Layout journal doesn't reach version %s. Resending the whole layout" % version)
+            LiveWrapper.queue_layout_snapshot()
+            return
+        for diffversion, diffs in entries:
+            msg = SimpleMessage(self.method_id(LiveWrapper.LAYOUT_UPDATED), {"val": diffs, "version": diffversion},
+                                NetworkEndpoint.precise_milli_time(), MessageClasses.LAYOUT_DIFF,
+                                self.methodPriorities.get(LiveWrapper.LAYOUT_UPDATED))
+            self.streamEndpoint.encode(msg)
+            self.streamEndpoint.send_msg(msg)
 
     def heartbeat_lost(self):
-        self.tcpEndpoint.hangup = False
+        self.streamEndpoint.hangup = False
+        # Go back to announcing ourselves to the server until it gives us a new session
+        self.datagramEndpoint = self.udpEndpoint
+        self.udpEndpoint.remoteAddr = self.discoveryAddr
+        self.udpEndpoint.codec = Codecs.DEFAULT
+        if self.unixDatagramEndpoint:
+            self.unixDatagramEndpoint.disconnect_peer()
+        self.close_telemetry()
+
+    def close_telemetry(self):
+        if self.telemetry:
+            self.telemetry.close()
+            self.telemetry = None
@@ -1,5 +1,4 @@
 from LiveWrapper import *
-from ..Utils import Utils
 
 
 class LiveClip(LiveWrapper):
@@ -38,9 +37,9 @@ class LiveClip(LiveWrapper):
 
     @classmethod
     def register_methods(cls):
-        cls.add_outgoing_method(LiveClip.CLIP_STATUS)
+        cls.add_outgoing_method(LiveClip.CLIP_STATUS, priority=MessagePriorities.REALTIME)
         cls.add_outgoing_method(LiveClip.CLIP_NOTES_UPDATED)
-        cls.add_outgoing_method(LiveClip.CLIP_PLAYING_POSITION)
+        cls.add_outgoing_method(LiveClip.CLIP_PLAYING_POSITION, True)
         cls.add_incoming_method(LiveClip.CLIP_TRIGGER, ["id"], LiveClip.queue_clip_trigger)
         cls.add_incoming_method(LiveClip.CLIP_NOTES_SET, ["id"], LiveClip.queue_clip_notes_set)
         cls.add_incoming_method(LiveClip.CLIP_BROADCAST_PLAYING_POSITION, ["id"], LiveClip.queue_broadcast_playing_pos)
@@ -63,7 +62,7 @@ class LiveClip(LiveWrapper):
         self.respond(LiveClip.CLIP_NOTES_UPDATED, self.handle().get_notes(0.0, 0, self.handle().length, 127))
 
     def playing_position(self):
-        self.update(LiveClip.CLIP_PLAYING_POSITION, Utils.truncate_float(self.handle().playing_position, 4))
+        self.update(LiveClip.CLIP_PLAYING_POSITION, round(self.handle().playing_position, 4))
 
     # --------
     # Incoming
@@ -28,7 +28,7 @@ class LiveDeviceParameter(LiveWrapper):
 
     @classmethod
     def register_methods(cls):
-        cls.add_outgoing_method(LiveDeviceParameter.PARAM_UPDATED)
+        cls.add_outgoing_method(LiveDeviceParameter.PARAM_UPDATED, True)
         cls.add_incoming_method(
             LiveDeviceParameter.PARAM_SET, ["id", "value"],
             LiveDeviceParameter.queue_param_value)
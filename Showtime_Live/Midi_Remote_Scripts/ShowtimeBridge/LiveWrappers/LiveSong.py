@@ -1,7 +1,7 @@
 from LiveWrapper import *
 from LiveTrack import LiveTrack
 import itertools
-from ..Utils import Utils
+from ..MeterFrames import MeterDeltaEncoder
 
 
 class LiveSong(LiveWrapper):
@@ -11,6 +11,15 @@ class LiveSong(LiveWrapper):
     SONG_METERS = "song_meters"
     SONG_LOGGING_LEVEL = "log_level"
     SONG_NETWORK_LOGGING = "log_network"
+    SONG_METER_EPSILON = "meter_epsilon"
+    SONG_POLL_BUDGET = "poll_budget"
+    SONG_BRIDGE_STATS = "bridge_stats"
+
+    def __init__(self, handle, handleindex=None, parent=None):
+        self.layoutPager = None
+        self.layoutStreamCounter = 0
+        self.meterEncoder = MeterDeltaEncoder()
+        LiveWrapper.__init__(self, handle, handleindex, parent)
 
     def create_handle_id(self):
         return "song"
@@ -38,11 +47,15 @@ class LiveSong(LiveWrapper):
 
     @classmethod
     def register_methods(cls):
-        cls.add_outgoing_method(LiveSong.SONG_METERS)
+        cls.add_outgoing_method(LiveSong.SONG_METERS, True)
         cls.add_outgoing_method(LiveSong.SONG_TRACKS_UPDATED)
-        cls.add_incoming_method(LiveSong.SONG_LAYOUT, None, LiveSong.build_song_layout, True)
+        cls.add_incoming_method(LiveSong.SONG_LAYOUT, None, LiveSong.build_song_layout, True,
+                                MessagePriorities.BULK)
         cls.add_incoming_method(LiveSong.SONG_LOGGING_LEVEL, ["log_level"], LiveSong.set_log_level)
         cls.add_incoming_method(LiveSong.SONG_NETWORK_LOGGING, ["status"], LiveSong.set_network_logging)
+        cls.add_incoming_method(LiveSong.SONG_METER_EPSILON, ["epsilon"], LiveSong.set_meter_epsilon)
+        cls.add_incoming_method(LiveSong.SONG_POLL_BUDGET, ["microseconds"], LiveSong.set_poll_budget)
+        cls.add_incoming_method(LiveSong.SONG_BRIDGE_STATS, None, LiveSong.send_bridge_stats, True)
 
     # --------
     # Outgoing
@@ -54,11 +67,17 @@ class LiveSong(LiveWrapper):
             if track:
                 # Batch track meters into one message
                 if track.handle():
-                    if track.handle().has_midi_output:
-                        Utils.truncate_float(track.handle().output_meter_level, 4)
-                    else:
-                        meterLevels[track.id()] = Utils.truncate_float(((track.handle().output_meter_left + track.handle().output_meter_right) * 0.5), 4)
-        self.update(LiveSong.SONG_METERS, meterLevels)
+                    if not track.handle().has_midi_output:
+                        meterLevels[track.id()] = (track.handle().output_meter_left + track.handle().output_meter_right) * 0.5
+
+        # Only tracks whose level moved are sent, apart from periodic keyframes
+        frame = self.meterEncoder.encode(meterLevels)
+        if frame:
+            keyframe, levels = frame
+            # Kept as floats so the frame still fits the telemetry ring's records
+            for trackid, level in levels.iteritems():
+                levels[trackid] = round(level, 4)
+            self.update(LiveSong.SONG_METERS, {"keyframe": keyframe, "levels": levels})
 
     # --------
     # Incoming
@@ -73,6 +92,29 @@ class LiveSong(LiveWrapper):
         status = int(args["status"])
         Log.set_log_network(status)
 
+    @staticmethod
+    def set_meter_epsilon(args):
+        epsilon = float(args["epsilon"])
+        for song in LiveSong.instances():
+            song.meterEncoder.epsilon = epsilon
+
+    @staticmethod
+    def set_poll_budget(args):
+        LiveWrapper._endpoint.pollBudget = max(int(args["microseconds"]), 0)
+
+    @staticmethod
+    def send_bridge_stats(args):
+        """Respond with how the bridge's polls and outgoing mailboxes are keeping up"""
+        try:
+            song = LiveSong.instances()[0]
+        except IndexError:
+            Log.warn("Couldn't get song wrapper to send bridge stats")
+            return
+        song.respond(LiveSong.SONG_BRIDGE_STATS, {
+            "poll": LiveWrapper._endpoint.poll_stats(),
+            "outbox": LiveWrapper._endpoint.outbox_stats()
+        })
+
     @staticmethod
     def build_song_layout(args):
         Log.info("Returning song layout")
@@ -82,14 +124,24 @@ class LiveSong(LiveWrapper):
             song = LiveSong.instances()[0]
         except Exception, e:
             Log.warn("Couldn't get song wrapper. " + str(e))
+            return
 
+        # Snapshot the wrappers now and convert them a page at a time over the next ticks
         wrappers = []
         for cls in LiveWrapper.__subclasses__():
-            Log.info("Converting %s instances to objects" % cls.__name__)
-            for instance in cls.instances():
-                wrappers.append(instance.to_object())
+            wrappers.extend(cls.instances())
 
-        song.respond(LiveSong.SONG_LAYOUT, wrappers)
+        song.layoutStreamCounter += 1
+        song.layoutPager = LayoutPager(wrappers, song.layoutStreamCounter)
+        Log.info("Streaming %s wrappers as layout %s" % (len(wrappers), song.layoutStreamCounter))
+        song.send_layout_page()
+
+    def send_layout_page(self):
+        """Send the next page of a streamed layout"""
+        page = self.layoutPager.next_page()
+        if self.layoutPager.finished():
+            self.layoutPager = None
+        self.respond(LiveSong.SONG_LAYOUT, page)
 
     # ---------
     # Hierarchy
@@ -104,4 +156,40 @@ class LiveSong(LiveWrapper):
     # ---------
     def tick(self):
         for track in LiveTrack.instances():
-            track.tick()
\ No newline at end of file
+            track.tick()
+        if self.layoutPager:
+            self.send_layout_page()
+
+
+class LayoutPager:
+    """Converts a snapshot of wrappers to layout objects a bounded page at a time.
+
+    Each page carries the stream ID, its sequence number and whether it is the last page, so the
+    server can put the whole layout back together. Wrappers destroyed before their page is
+    built are skipped.
+    """
+    PAGE_SIZE = 128
+
+    def __init__(self, wrappers, streamid, pagesize=PAGE_SIZE):
+        self.wrappers = wrappers
+        self.streamid = streamid
+        self.pagesize = pagesize
+        self.position = 0
+        self.seq = 0
+
+    def finished(self):
+        return self.position >= len(self.wrappers)
+
+    def next_page(self):
+        end = min(self.position + self.pagesize, len(self.wrappers))
+        page = []
+        for wrapper in self.wrappers[self.position:end]:
+            try:
+                page.append(wrapper.to_object())
+            except (RuntimeError, AttributeError), e:
+                Log.warn("Skipping wrapper %s in layout. %s" % (wrapper.id(), e))
+        self.position = end
+
+        msg = {"stream": self.streamid, "seq": self.seq, "page": page, "end": self.finished()}
+        self.seq += 1
+        return msg
\ No newline at end of file
@@ -46,7 +46,7 @@ class LiveTrack(LiveWrapper):
     def register_methods(cls):
         cls.add_outgoing_method(LiveTrack.TRACK_METER)
         cls.add_outgoing_method(LiveTrack.TRACK_MIXER_SENDS_UPDATED)
-        cls.add_outgoing_method(LiveTrack.TRACK_PLAYING_NOTES)
+        cls.add_outgoing_method(LiveTrack.TRACK_PLAYING_NOTES, priority=MessagePriorities.REALTIME)
         cls.add_incoming_method(LiveTrack.TRACK_STOP, ["id"], LiveTrack.stop_track)
 
     def to_object(self):
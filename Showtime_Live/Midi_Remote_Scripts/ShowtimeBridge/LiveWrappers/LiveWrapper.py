@@ -1,5 +1,6 @@
 import re
 from ..Logger import Log
+from ..Mailbox import MessagePriorities
 
 
 class LiveWrapper(object):
@@ -218,13 +219,25 @@ class LiveWrapper(object):
         return None
 
     @classmethod
-    def add_outgoing_method(cls, methodname):
-        """Registers a method for this wrapper that will publish to the network"""
-        cls._outgoing_methods[methodname] = LiveMethodDef(methodname, LiveWrapper.METHOD_READ)
+    def add_outgoing_method(cls, methodname, telemetry=False, priority=None):
+        """Registers a method for this wrapper that will publish to the network
+
+        Args:
+            telemetry: High rate numeric values that can go through the telemetry ring when the
+                server shares our host
+            priority: MessagePriorities class the method's messages are sent with when the
+                network is backed up. Defaults to normal
+        """
+        cls._outgoing_methods[methodname] = LiveMethodDef(methodname, LiveWrapper.METHOD_READ, telemetry=telemetry,
+                                                          priority=priority)
 
     @classmethod
-    def add_incoming_method(cls, methodname, methodargs, callback, isResponder=False):
-        """Registers method for this wrapper that will receive events from the network"""
+    def add_incoming_method(cls, methodname, methodargs, callback, isResponder=False, priority=None):
+        """Registers method for this wrapper that will receive events from the network
+
+        Args:
+            priority: MessagePriorities class of a responder's replies
+        """
         # !!!STOPGAP!!!
         # Convert method arg arrays to key/value pairs. Needs to be fixed in Showtime instead of here!
         methodargkeys = {}
@@ -233,7 +246,8 @@ class LiveWrapper(object):
                 methodargkeys[key] = None
 
         accessType = LiveWrapper.METHOD_RESPOND if isResponder else LiveWrapper.METHOD_WRITE
-        cls._incoming_methods[methodname] = LiveMethodDef(methodname, accessType, methodargkeys, callback)
+        cls._incoming_methods[methodname] = LiveMethodDef(methodname, accessType, methodargkeys, callback,
+                                                          priority=priority)
 
     # Network
     # -------
@@ -248,7 +262,7 @@ class LiveWrapper(object):
         Register base methods for all classes.
         Subclasses can override this to add their own methods
         """
-        LiveWrapper.add_outgoing_method(LiveWrapper.LAYOUT_UPDATED)
+        LiveWrapper.add_outgoing_method(LiveWrapper.LAYOUT_UPDATED, priority=MessagePriorities.BULK)
 
     @classmethod
     def incoming_methods(cls):
@@ -378,16 +392,27 @@ class LiveWrapper(object):
         LiveWrapper._layout_updates.append(diffItem)
         LiveWrapper._deferred_actions[LiveWrapper.send_layout_diff] = (None, None)
 
+    @staticmethod
+    def queue_layout_snapshot():
+        """Queues an added diff for every wrapper, for a server that has lost our layout"""
+        for cls in LiveWrapper.__subclasses__():
+            for instance in cls.instances():
+                diff_status = {"status": LiveWrapper.LAYOUT_ADDED}
+                diff_status.update(instance.to_object())
+                LiveWrapper.queue_layout_diff(diff_status)
+
     @staticmethod
     def send_layout_diff(args):
         """Sends accumulated layout diff to server"""
         LiveWrapper._endpoint.send_to_showtime(LiveWrapper.LAYOUT_UPDATED, {"val": LiveWrapper._layout_updates}, True)
-        LiveWrapper._layout_updates[:] = []
+        LiveWrapper._layout_updates = []
 
 
 class LiveMethodDef:
-    def __init__(self, methodname, methodAccess, methodargs=None, callback=None):
+    def __init__(self, methodname, methodAccess, methodargs=None, callback=None, telemetry=False, priority=None):
         self.methodName = methodname
         self.methodAccess = methodAccess
         self.methodArgs = methodargs if methodargs else {}
         self.callback = callback
+        self.telemetry = telemetry
+        self.priority = priority
@@ -0,0 +1,206 @@
+import collections
+import threading
+
+from Metrics import Counters, Histogram
+
+
+class MessageClasses:
+    """Kinds of queued message, each with its own policy for when a mailbox is full"""
+    def __init__(self):
+        pass
+
+    CONTROL = "control"
+    REGISTRATION = "registration"
+    LAYOUT = "layout"
+    LAYOUT_DIFF = "layoutDiff"
+    TELEMETRY = "telemetry"
+    RESPONSE = "response"
+
+    ALL = (CONTROL, REGISTRATION, LAYOUT, LAYOUT_DIFF, TELEMETRY, RESPONSE)
+
+
+class MessagePriorities:
+    """Order queued messages are sent in. Lower numbers go first"""
+    def __init__(self):
+        pass
+
+    CONTROL = 0
+    REALTIME = 1
+    NORMAL = 2
+    BULK = 3
+
+    NAMES = ("control", "realtime", "normal", "bulk")
+
+    # Priority of a message that doesn't ask for one
+    DEFAULTS = {
+        MessageClasses.CONTROL: CONTROL,
+        MessageClasses.REGISTRATION: CONTROL,
+        MessageClasses.LAYOUT: BULK,
+        MessageClasses.LAYOUT_DIFF: BULK,
+        MessageClasses.TELEMETRY: NORMAL,
+        MessageClasses.RESPONSE: NORMAL
+    }
+
+
+class MailboxPolicies:
+    def __init__(self):
+        pass
+
+    # Always queued, even past the mailbox's capacity
+    KEEP = "keep"
+
+    # Merged with the queued messages of its class into one message at the back of the mailbox
+    COALESCE = "coalesce"
+
+    # Pushes out the oldest queued message of its class
+    DROP_OLDEST = "dropOldest"
+
+    # Dropped itself
+    DROP_NEWEST = "dropNewest"
+
+
+class Mailbox:
+    """Bounded, prioritised queue of outgoing messages.
+
+    Messages come out highest priority first and in queue order within a priority, so a backlog
+    of layout diffs can't hold up a clip status or a responder's reply. The time messages spend
+    queued is measured per priority.
+
+    A peer that stops reading shouldn't make us buffer without limit, but what can be lost
+    depends on the message. Handshakes, registrations and streamed layout pages are always kept,
+    layout diffs are folded together, stale telemetry makes way for new values and anything else
+    is turned away. Every message class counts what it lost.
+    """
+    DEFAULT_CAPACITY = 1024
+
+    POLICIES = {
+        MessageClasses.CONTROL: MailboxPolicies.KEEP,
+        MessageClasses.REGISTRATION: MailboxPolicies.KEEP,
+        MessageClasses.LAYOUT: MailboxPolicies.KEEP,
+        MessageClasses.LAYOUT_DIFF: MailboxPolicies.COALESCE,
+        MessageClasses.TELEMETRY: MailboxPolicies.DROP_OLDEST,
+        MessageClasses.RESPONSE: MailboxPolicies.DROP_NEWEST
+    }
+
+    def __init__(self, classify, prioritise, coalesce=None, capacity=DEFAULT_CAPACITY):
+        """
+        Args:
+            classify: Returns the message class of a message
+            prioritise: Returns the priority of a message given the message and its class
+            coalesce: Merges a list of messages of a coalescing class, oldest first, into one
+            capacity: Number of messages held before policies kick in
+        """
+        self.classify = classify
+        self.prioritise = prioritise
+        self.coalesce = coalesce
+        self.capacity = capacity
+        self.queues = [collections.deque() for priority in MessagePriorities.NAMES]
+        self.size = 0
+        self.classCounts = dict((messageclass, 0) for messageclass in MessageClasses.ALL)
+        self.highWaterMark = 0
+        self.dropped = Counters(*MessageClasses.ALL)
+        self.coalesced = Counters(*MessageClasses.ALL)
+        self.latency = [Histogram() for priority in MessagePriorities.NAMES]
+
+        # Other threads can queue messages while the owner drains them
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def empty(self):
+        return not self.size
+
+    def put(self, queued, msg):
+        """Queue a message, applying its class's policy if the mailbox is full
+
+        Args:
+            queued: Time the message was queued
+            msg: Message to queue
+
+        Returns:
+            False if the message was dropped.
+        """
+        messageclass = self.classify(msg)
+        with self.lock:
+            if self.size >= self.capacity:
+                policy = Mailbox.POLICIES.get(messageclass, MailboxPolicies.DROP_NEWEST)
+                if policy == MailboxPolicies.DROP_NEWEST:
+                    self.dropped.increment(messageclass)
+                    return False
+                elif policy == MailboxPolicies.DROP_OLDEST:
+                    self.dropped.increment(messageclass)
+                    if not self._remove_oldest(messageclass):
+                        return False
+                elif policy == MailboxPolicies.COALESCE and self.coalesce and self.classCounts[messageclass]:
+                    queued, msg = self._coalesce(messageclass, queued, msg)
+
+            self.queues[self.prioritise(msg, messageclass)].append((queued, messageclass, msg))
+            self.classCounts[messageclass] += 1
+            self.size += 1
+            if self.size > self.highWaterMark:
+                self.highWaterMark = self.size
+        return True
+
+    def pop(self, now=None):
+        """Take the oldest message of the highest priority waiting
+
+        Args:
+            now: Current time, to measure how long the message was queued for
+
+        Returns:
+            (queued time, message) tuple, or None if the mailbox is empty.
+        """
+        with self.lock:
+            for priority, queue in enumerate(self.queues):
+                if queue:
+                    queued, messageclass, msg = queue.popleft()
+                    self.classCounts[messageclass] -= 1
+                    self.size -= 1
+                    if now is not None:
+                        self.latency[priority].add(now - queued)
+                    return queued, msg
+        return None
+
+    def _remove_oldest(self, messageclass):
+        if not self.classCounts[messageclass]:
+            return False
+        oldest = None
+        for queue in self.queues:
+            for entry in queue:
+                if entry[1] == messageclass:
+                    if oldest is None or entry[0] < oldest[1][0]:
+                        oldest = (queue, entry)
+                    break
+        oldest[0].remove(oldest[1])
+        self.classCounts[messageclass] -= 1
+        self.size -= 1
+        return True
+
+    def _coalesce(self, messageclass, queued, msg):
+        # The merged message keeps the queue time of the oldest part so queue delays stay honest
+        merging = []
+        for index, queue in enumerate(self.queues):
+            kept = collections.deque()
+            for entry in queue:
+                if entry[1] == messageclass:
+                    merging.append(entry)
+                else:
+                    kept.append(entry)
+            self.queues[index] = kept
+        merging.sort(key=lambda entry: entry[0])
+        self.size -= len(merging)
+        self.classCounts[messageclass] = 0
+        self.coalesced.increment(messageclass, len(merging))
+        return merging[0][0], self.coalesce([entry[2] for entry in merging] + [msg])
+
+    def stats(self):
+        return {
+            "capacity": self.capacity,
+            "size": self.size,
+            "highWaterMark": self.highWaterMark,
+            "dropped": self.dropped.as_dict(),
+            "coalesced": self.coalesced.as_dict(),
+            "latency": dict((MessagePriorities.NAMES[priority], histogram.as_dict())
+                            for priority, histogram in enumerate(self.latency))
+        }
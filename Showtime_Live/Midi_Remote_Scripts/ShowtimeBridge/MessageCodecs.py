@@ -0,0 +1,134 @@
+import marshal
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+class CodecError(Exception):
+    """Exception for payloads that can't be encoded or decoded by a codec"""
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class JSONCodec:
+    """Encodes messages as a JSON [subject, msg] array, with the creation time appended when the
+    message is timestamped. Fallback codec when a peer can't negotiate"""
+    def __init__(self):
+        pass
+
+    NAME = "json"
+
+    # Safe to decode from anyone
+    LOCAL_ONLY = False
+
+    @staticmethod
+    def encode(subject, msg, timestamp=None):
+        if timestamp is None:
+            return json.dumps([subject, msg])
+        return json.dumps([subject, msg, timestamp])
+
+    @staticmethod
+    def decode(data):
+        try:
+            parsed = json.loads(data)
+            return parsed[0], parsed[1], parsed[2] if len(parsed) > 2 else None
+        except (ValueError, IndexError, TypeError), e:
+            raise CodecError("Malformed JSON payload. %s" % e)
+
+
+class BinaryCodec:
+    """Encodes messages in the interpreter's marshal format.
+
+    Marshal writes every value as a type tag followed by its fixed width or length prefixed body,
+    so ints and floats keep their type and strings are copied as-is instead of being escaped. The
+    encoder and decoder are both implemented in C, which matters inside Live's tick. The codec name
+    carries the marshal version so peers running mismatched interpreters fall back to JSON.
+
+    Malformed marshal data can crash the interpreter, so the codec is only negotiated with peers on
+    the same machine. Remote peers, and anything on a socket anyone can send to, stay on JSON.
+    """
+    def __init__(self):
+        pass
+
+    VERSION = 2
+    NAME = "marshal%d" % VERSION
+
+    # Only negotiated over Unix sockets and loopback connections
+    LOCAL_ONLY = True
+
+    # First byte of every binary payload, checked before anything is unmarshalled
+    MAGIC = "\xb1"
+
+    @staticmethod
+    def encode(subject, msg, timestamp=None):
+        try:
+            if timestamp is None:
+                return BinaryCodec.MAGIC + marshal.dumps((subject, msg), BinaryCodec.VERSION)
+            return BinaryCodec.MAGIC + marshal.dumps((subject, msg, timestamp), BinaryCodec.VERSION)
+        except ValueError, e:
+            raise CodecError("Can't encode message %s. %s" % (subject, e))
+
+    @staticmethod
+    def decode(data):
+        if data[:1] != BinaryCodec.MAGIC:
+            raise CodecError("Payload is not binary encoded")
+        try:
+            parsed = marshal.loads(data[1:])
+            return parsed[0], parsed[1], parsed[2] if len(parsed) > 2 else None
+        except (EOFError, ValueError, TypeError, IndexError), e:
+            raise CodecError("Malformed binary payload. %s" % e)
+
+
+class Codecs:
+    """Registry of the payload codecs an endpoint can negotiate.
+
+    Payloads don't say which codec encoded them. Endpoints decode with the codec they negotiated
+    with their peer, and with the default codec on sockets anyone can send to. Codecs that can't
+    take untrusted input are left out of everything unless the peer is on this machine.
+    """
+    def __init__(self):
+        pass
+
+    # Preferred codecs first
+    _codecs = [BinaryCodec, JSONCodec]
+
+    DEFAULT = JSONCodec
+
+    @staticmethod
+    def available(local):
+        """Codecs we can use with a peer, depending on whether it's on this machine"""
+        return [codec for codec in Codecs._codecs if local or not codec.LOCAL_ONLY]
+
+    @staticmethod
+    def supported(local=False):
+        """Names of the codecs we can use with a peer in order of preference
+
+        Args:
+            local: Whether the peer is on this machine
+        """
+        return [codec.NAME for codec in Codecs.available(local)]
+
+    @staticmethod
+    def get(name, local=False):
+        """Find a codec by name. Unknown names, and local only codecs for a remote peer, fall back
+        to the default codec"""
+        for codec in Codecs.available(local):
+            if codec.NAME == name:
+                return codec
+        return Codecs.DEFAULT
+
+    @staticmethod
+    def negotiate(offered, local=False):
+        """Pick the first codec offered by a peer that we can also use with it"""
+        if offered:
+            codecs = Codecs.available(local)
+            for name in offered:
+                for codec in codecs:
+                    if codec.NAME == name:
+                        return codec
+        return Codecs.DEFAULT
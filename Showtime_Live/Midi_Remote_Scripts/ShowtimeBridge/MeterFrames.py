@@ -0,0 +1,62 @@
+class MeterDeltaEncoder:
+    """Turns full meter snapshots into frames that only carry the levels that changed.
+
+    The last level sent for each track is remembered and a track is only included again once it
+    moves by more than epsilon. Every keyframe interval the whole snapshot is sent so a receiver
+    that lost a frame, or just joined, converges on the real state.
+    """
+    DEFAULT_EPSILON = 0.0005
+    DEFAULT_KEYFRAME_INTERVAL = 64
+
+    def __init__(self, epsilon=DEFAULT_EPSILON, keyframeinterval=DEFAULT_KEYFRAME_INTERVAL):
+        self.epsilon = epsilon
+        self.keyframeInterval = keyframeinterval
+        self.lastSent = {}
+        self.framesSinceKeyframe = keyframeinterval
+
+    def reset(self):
+        """Forget what was sent so the next frame is a keyframe"""
+        self.lastSent = {}
+        self.framesSinceKeyframe = self.keyframeInterval
+
+    def encode(self, levels):
+        """Work out which levels need sending
+
+        Args:
+            levels: Dict of track ID to current level.
+
+        Returns:
+            Tuple of (keyframe, dict of levels to send), or None if nothing needs sending.
+        """
+        self.framesSinceKeyframe += 1
+        if self.framesSinceKeyframe >= self.keyframeInterval:
+            self.framesSinceKeyframe = 0
+            self.lastSent = dict(levels)
+            return True, dict(levels)
+
+        changed = {}
+        for trackid, level in levels.iteritems():
+            last = self.lastSent.get(trackid)
+            if last is None or abs(level - last) > self.epsilon:
+                changed[trackid] = level
+                self.lastSent[trackid] = level
+        if not changed:
+            return None
+        return False, changed
+
+
+class MeterDeltaDecoder:
+    """Rebuilds the full meter state from keyframes and delta frames"""
+    def __init__(self):
+        self.levels = {}
+
+    def reset(self):
+        self.levels = {}
+
+    def apply(self, frame):
+        """Apply a meter frame and return the reconstructed levels for every track"""
+        if frame["keyframe"]:
+            self.levels = dict(frame["levels"])
+        else:
+            self.levels.update(frame["levels"])
+        return self.levels
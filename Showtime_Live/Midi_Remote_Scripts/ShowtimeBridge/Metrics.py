@@ -0,0 +1,227 @@
+import math
+
+
+class Counters:
+    """Named counters for networking statistics"""
+    def __init__(self, *names):
+        self.values = dict((name, 0) for name in names)
+
+    def increment(self, name, amount=1):
+        self.values[name] = self.values.get(name, 0) + amount
+
+    def set_max(self, name, value):
+        """Keep the largest value seen for a counter"""
+        if value > self.values.get(name, 0):
+            self.values[name] = value
+
+    def __getitem__(self, name):
+        return self.values.get(name, 0)
+
+    def as_dict(self):
+        return dict(self.values)
+
+    def reset(self):
+        for name in self.values:
+            self.values[name] = 0
+
+
+class SequenceStats:
+    """Tracks loss, duplication and reordering of a sequence numbered datagram stream.
+
+    Missing sequence numbers are remembered for a window so a datagram that turns up late is
+    counted as reordered rather than lost. A sequence number far behind the window means the
+    sender restarted, so tracking starts over from it.
+
+    Lost counts every datagram missing right now. A run of missing datagrams only counts as a
+    burst once the stream has moved a window past it, or the sender restarted, since late arrivals
+    can still shrink it or split it in two until then.
+    """
+    WINDOW = 1024
+    SEQUENCE_MASK = 0xffffffff
+    HALF_RANGE = 0x80000000
+
+    # Upper bounds of the burst length buckets. Longer bursts land in the last bucket
+    BURST_BUCKETS = (1, 2, 4, 8, 16, 64)
+
+    def __init__(self):
+        self.highest = None
+        self.missing = set()
+        # Runs of missing sequence numbers not declared lost yet, oldest first, as (newest, length)
+        self.gaps = []
+        self.counters = Counters("received", "lost", "duplicates", "reordered", "bursts", "maxBurst", "restarts")
+        self.burstLengths = [0] * (len(SequenceStats.BURST_BUCKETS) + 1)
+
+    def add(self, seq):
+        """Record the arrival of a sequence number"""
+        self.counters.increment("received")
+        if self.highest is None:
+            self.highest = seq
+            return
+
+        distance = (seq - self.highest) & SequenceStats.SEQUENCE_MASK
+        if distance == 0:
+            self.counters.increment("duplicates")
+        elif distance < SequenceStats.HALF_RANGE:
+            if distance > 1:
+                self._gap(distance - 1)
+            self.highest = seq
+            self._expire()
+        elif seq in self.missing:
+            self.missing.discard(seq)
+            self._fill(seq)
+            self.counters.increment("reordered")
+            self.counters.increment("lost", -1)
+        elif SequenceStats.SEQUENCE_MASK + 1 - distance > SequenceStats.WINDOW:
+            self.counters.increment("restarts")
+            for newest, length in self.gaps:
+                self._declare_lost(newest, length)
+            del self.gaps[:]
+            self.missing.clear()
+            self.highest = seq
+        else:
+            self.counters.increment("duplicates")
+
+    def _gap(self, length):
+        self.counters.increment("lost", length)
+        newest = (self.highest + length) & SequenceStats.SEQUENCE_MASK
+        self.gaps.append((newest, length))
+
+        # Remember the holes inside the window so late arrivals can be told apart from duplicates
+        for offset in xrange(min(length, SequenceStats.WINDOW)):
+            self.missing.add((newest - offset) & SequenceStats.SEQUENCE_MASK)
+
+    def _fill(self, seq):
+        """Split the run a late arrival belonged to around it"""
+        for i, (newest, length) in enumerate(self.gaps):
+            offset = (newest - seq) & SequenceStats.SEQUENCE_MASK
+            if offset < length:
+                parts = []
+                if length - offset - 1:
+                    parts.append(((seq - 1) & SequenceStats.SEQUENCE_MASK, length - offset - 1))
+                if offset:
+                    parts.append((newest, offset))
+                self.gaps[i:i + 1] = parts
+                return
+
+    def _expire(self):
+        """Declare runs a whole window behind the newest sequence number lost"""
+        while self.gaps and (self.highest - self.gaps[0][0]) & SequenceStats.SEQUENCE_MASK >= SequenceStats.WINDOW:
+            self._declare_lost(*self.gaps.pop(0))
+
+    def _declare_lost(self, newest, length):
+        for offset in xrange(min(length, SequenceStats.WINDOW)):
+            self.missing.discard((newest - offset) & SequenceStats.SEQUENCE_MASK)
+        self.counters.increment("bursts")
+        self.counters.set_max("maxBurst", length)
+        bucket = 0
+        while bucket < len(SequenceStats.BURST_BUCKETS) and length > SequenceStats.BURST_BUCKETS[bucket]:
+            bucket += 1
+        self.burstLengths[bucket] += 1
+
+    def loss_rate(self):
+        """Fraction of datagrams sent by the peer that never arrived"""
+        expected = self.counters["received"] - self.counters["duplicates"] + self.counters["lost"]
+        return float(self.counters["lost"]) / expected if expected > 0 else 0.0
+
+    def as_dict(self):
+        stats = self.counters.as_dict()
+        stats["lossRate"] = self.loss_rate()
+        labels = []
+        lower = 1
+        for upper in SequenceStats.BURST_BUCKETS:
+            labels.append(str(upper) if upper == lower else "%d-%d" % (lower, upper))
+            lower = upper + 1
+        labels.append("%d+" % lower)
+        stats["burstLengths"] = dict(zip(labels, self.burstLengths))
+        return stats
+
+
+class Histogram:
+    """Histogram of positive values with logarithmic buckets.
+
+    Every bucket is a fixed ratio wider than the one below it, so percentiles keep the same
+    relative precision from fractions of a millisecond up to seconds while memory stays bounded.
+    """
+    def __init__(self, precision=0.05, minimum=0.01):
+        self.minimum = minimum
+        self.growth = math.log(1.0 + precision)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        index = 0
+        if value > self.minimum:
+            index = int(math.log(value / self.minimum) / self.growth) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile. Never more than the largest value"""
+        if not self.count:
+            return 0.0
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.minimum * math.exp(index * self.growth), self.maximum)
+        return self.maximum
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.maximum
+        }
+
+    def reset(self):
+        self.buckets.clear()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+
+class ClockOffset:
+    """Estimates the offset between a peer's clock and ours from timestamp echoes.
+
+    Each echo carries the time we sent a probe, the time the peer received it, the time the peer
+    replied and the time the reply reached us. Like NTP, the sample with the shortest round trip
+    out of the most recent few is trusted, since queueing delay is what skews the estimate.
+    """
+    SAMPLES = 8
+
+    def __init__(self):
+        self.samples = []
+        self.offset = None
+        self.delay = None
+
+    def add_sample(self, sent, received, replied, arrived):
+        """Add a probe round trip. The first and last times are ours, the middle two are the peer's"""
+        delay = (arrived - sent) - (replied - received)
+        offset = ((received - sent) + (replied - arrived)) / 2.0
+        self.samples.append((max(delay, 0.0), offset))
+        if len(self.samples) > ClockOffset.SAMPLES:
+            del self.samples[0]
+        self.delay, self.offset = min(self.samples)
+
+    def synced(self):
+        return self.offset is not None
+
+    def to_local(self, peertime):
+        """Convert a time from the peer's clock to ours"""
+        return peertime - self.offset
+
+    def reset(self):
+        del self.samples[:]
+        self.offset = None
+        self.delay = None
@@ -1,13 +1,12 @@
-import Queue
+import random
 import socket
-import struct
 import time
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+from Framing import FrameReader, FrameWriter
 from Logger import Log
+from Mailbox import Mailbox, MessageClasses, MessagePriorities
+from MessageCodecs import Codecs, CodecError
+from Metrics import Counters, Histogram
 
 
 class NetworkErrors:
@@ -20,12 +19,55 @@ class NetworkErrors:
         EAGAIN = errno.WSAEWOULDBLOCK
         ECONNRESET = errno.WSAECONNRESET
         EISCONN = errno.WSAEISCONN
+        ECONNREFUSED = errno.WSAECONNREFUSED
+        ENOTCONN = errno.WSAENOTCONN
         EBADF = errno.EBADF
+        # A non-blocking connect that is still in progress
+        CONNECT_PENDING = (errno.WSAEWOULDBLOCK, errno.WSAEINPROGRESS, errno.WSAEALREADY)
     else:
         EAGAIN = errno.EAGAIN
         ECONNRESET = errno.ECONNRESET
         EISCONN = errno.EISCONN
+        ECONNREFUSED = errno.ECONNREFUSED
+        ENOTCONN = errno.ENOTCONN
         EBADF = errno.EBADF
+        CONNECT_PENDING = (errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class Backoff:
+    """Exponential backoff with jitter between attempts at something that keeps failing.
+    The jitter stops several clients that lost the same server from retrying in lockstep"""
+    def __init__(self, initial, maximum, jitter=0.5):
+        """
+        Args:
+            initial: Seconds to wait after the first failure
+            maximum: Longest wait in seconds, however many attempts failed
+            jitter: Fraction of each wait that is randomised
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.jitter = jitter
+        self.failures = 0
+        self.nextAttempt = 0
+
+    def ready(self):
+        return time.time() >= self.nextAttempt
+
+    def failed(self):
+        """Push the next attempt back
+
+        Returns:
+            Seconds until the next attempt.
+        """
+        delay = min(self.initial * (2 ** self.failures), self.maximum)
+        delay *= 1.0 - self.jitter * random.random()
+        self.failures += 1
+        self.nextAttempt = time.time() + delay
+        return delay
+
+    def reset(self):
+        self.failures = 0
+        self.nextAttempt = 0
 
 
 class NetworkPrefixes:
@@ -36,11 +78,16 @@ class NetworkPrefixes:
     OUTGOING = "O"
     RESPONDER = "L"
     REGISTRATION = "R"
+    MANIFEST = "M"
     DELIMITER = "_"
     HEARTBEAT = "HB"
+    HEARTBEAT_ECHO = "HE"
     HANDSHAKE = "HS"
     HANDSHAKE_ACK = "HSACK"
 
+    # Subjects that keep the connection itself going
+    CONTROL = (HEARTBEAT, HEARTBEAT_ECHO, HANDSHAKE, HANDSHAKE_ACK)
+
     @staticmethod
     def prefix_outgoing(name):
         return NetworkPrefixes.OUTGOING + NetworkPrefixes.prefix_name(name)
@@ -57,31 +104,77 @@ class NetworkPrefixes:
     def prefix_registration(name):
         return NetworkPrefixes.REGISTRATION + NetworkPrefixes.prefix_name(name)
 
+    @staticmethod
+    def prefix_manifest(name):
+        return NetworkPrefixes.MANIFEST + NetworkPrefixes.prefix_name(name)
+
     @staticmethod
     def prefix_name(name):
         return NetworkPrefixes.DELIMITER + name
 
 
 class SimpleMessage:
-    def __init__(self, subject, message):
+    """A subject/message pair that is encoded at most once per codec.
+
+    The encoded payload and the framed bytes are cached the first time they're needed, so a
+    message can be measured, queued and sent to several endpoints without re-encoding. Messages
+    must not be modified once they have been encoded.
+    """
+    # Encode calls against distinct messages encoded, so repeated encodes show up
+    stats = Counters("encoded", "encodes")
+
+    def __init__(self, subject, message, timestamp=None, messageclass=None, priority=None):
         self.subject = subject
         self.msg = message if message else {}
+        self.timestamp = timestamp
+        # What a full mailbox is allowed to do with this message. Worked out from the subject if not given
+        self.messageClass = messageclass
+        # How soon it leaves a mailbox. Defaults to the usual priority of its class
+        self.priority = priority
+        self._payloads = {}
+        self._frames = {}
 
     def __str__(self):
-        return json.dumps([self.subject, self.msg])
+        return self.encode(Codecs.DEFAULT)
 
     def __len__(self):
         return len(str(self))
 
+    def encode(self, codec):
+        """Encode this message into a payload using the given codec"""
+        try:
+            return self._payloads[codec.NAME]
+        except KeyError:
+            if not self._payloads:
+                SimpleMessage.stats.increment("encoded")
+            SimpleMessage.stats.increment("encodes")
+            payload = codec.encode(self.subject, self.msg, self.timestamp)
+            self._payloads[codec.NAME] = payload
+            return payload
+
+    def frame(self, codec):
+        """Encoded payload with its length header attached, ready to be written to a socket"""
+        try:
+            return self._frames[codec.NAME]
+        except KeyError:
+            framed = FrameWriter.frame(self.encode(codec))
+            self._frames[codec.NAME] = framed
+            return framed
+
     @staticmethod
-    def parse(msg):
-        parsed = json.loads(msg)
-        return SimpleMessage(parsed[0], parsed[1])
+    def encodes_per_message():
+        """Average encode calls per encoded message. Anything above 1.0 is wasted work"""
+        encoded = SimpleMessage.stats["encoded"]
+        return float(SimpleMessage.stats["encodes"]) / encoded if encoded else 0.0
 
+    @staticmethod
+    def parse(msg, codec=Codecs.DEFAULT):
+        """Decode a payload with the codec its sender used"""
+        subject, message, timestamp = codec.decode(msg)
+        return SimpleMessage(subject, message, timestamp)
 
-class NetworkEndpoint:
-    MAX_MSG_SIZE = 1024
 
+class NetworkEndpoint:
     # Connection statuses
     PIPE_DISCONNECTED = 0
     PIPE_CONNECTED = 1
@@ -95,10 +188,20 @@ class NetworkEndpoint:
         self.eventCallbacks = set()
         self.readyCallbacks = set()
         self.closingCallbacks = set()
-        self.outgoingMailbox = Queue.Queue()
+        self.outgoingMailbox = Mailbox(NetworkEndpoint.message_class, NetworkEndpoint.message_priority,
+                                       NetworkEndpoint.coalesce)
+        # Bytes the mailbox can still send this tick. None means no limit
+        self.tickBudget = None
+        self.queueDelay = Histogram()
+        self.traffic = Counters("messagesIn", "bytesIn", "messagesOut", "bytesOut")
         self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
         self.enteringImmediate = False
         self.immediate = False
+        # Codecs our payloads are encoded with and the peer's are decoded with. Incoming payloads
+        # stay on the default codec until we know who is sending them
+        self.codec = Codecs.DEFAULT
+        self.peerCodec = Codecs.DEFAULT
+        self.reset_streams()
         if not hasattr(self, "socket"):
             self.create_socket()
 
@@ -110,75 +213,158 @@ class NetworkEndpoint:
             self.socket.close()
             self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
 
+    def reset_streams(self):
+        """Drop buffered frames and stream state left over from a previous connection"""
+        self.reader = FrameReader()
+        self.writer = FrameWriter()
+
     @staticmethod
     def current_milli_time():
         return int(round(time.time() * 1000))
 
+    @staticmethod
+    def precise_milli_time():
+        """Wall clock time in milliseconds with sub-millisecond precision, for latency stamps"""
+        return time.time() * 1000.0
+
     # Send/Receive
     # ------------
     def recv_msg(self):
         self.recv()
 
     def recv(self):
-        size = self._msg_length()
-        data = self._read(size)
-        frmt = "!%ds" % size
-        msg = None
-        if data:
-            msg = struct.unpack(frmt, data)
-        if msg:
-            self.event(SimpleMessage.parse(msg[0]))
-
-    def _msg_length(self):
-        d = self._read(4)
-        s = struct.unpack('!I', d)
-        return s[0]
-
-    def _read(self, size):
-        data = ''
-        while len(data) < size:
-            retries = 10
-            while retries > 0:
-                try:
-                    tempdata = self.socket.recv(min(size-len(data), NetworkEndpoint.MAX_MSG_SIZE))
-                    data += tempdata
-                    retries = 0
-                    if tempdata == '':
-                        raise RuntimeError("Socket returned empty string. Connection broken")
-                except socket.error, e:
-                    if e[0] == NetworkErrors.EAGAIN:
-                        Log.warn("Socket busy. Trying again")
-                        retries -= 1
-                    elif e[0] == NetworkErrors.ECONNRESET:
-                        raise ReadError("Connection reset when reading or destination port closed.")
-                    else:
-                        raise RuntimeError("Socket connection broken. %s" % e)
-        return data
+        try:
+            self.traffic.increment("bytesIn", self._fill())
+        except socket.error, e:
+            if e[0] == NetworkErrors.EAGAIN:
+                return
+            elif e[0] == NetworkErrors.ECONNRESET:
+                raise ReadError("Connection reset when reading or destination port closed.")
+            raise RuntimeError("Socket connection broken. %s" % e)
+
+        for payload in self.reader.frames():
+            try:
+                event = SimpleMessage.parse(payload, self.peerCodec)
+            except CodecError, e:
+                Log.error("Dropping undecodable message. %s" % e)
+                continue
+            self.traffic.increment("messagesIn")
+            self.event(event)
+
+    def _fill(self):
+        """Pull every available byte from the socket into the frame reader
+
+        Returns:
+            Number of bytes read.
+        """
+        return self.reader.read_stream(self.socket)
 
     def send_msg(self, msg, immediate=False, address=None):
         if self.socket:
             if immediate or self.immediate:
                 self.send(msg, address)
             else:
-                self.outgoingMailbox.put(msg)
+                if not self.outgoingMailbox.put(NetworkEndpoint.precise_milli_time(), msg):
+                    return False
                 for callback in self.readyCallbacks:
                     callback(self)
+            return True
+
+    @staticmethod
+    def message_class(msg):
+        if isinstance(msg, SimpleMessage):
+            if msg.messageClass:
+                return msg.messageClass
+            if msg.subject in NetworkPrefixes.CONTROL:
+                return MessageClasses.CONTROL
+            if isinstance(msg.subject, basestring) and msg.subject[:2] in (
+                    NetworkPrefixes.REGISTRATION + NetworkPrefixes.DELIMITER,
+                    NetworkPrefixes.MANIFEST + NetworkPrefixes.DELIMITER):
+                return MessageClasses.REGISTRATION
+        return MessageClasses.RESPONSE
+
+    @staticmethod
+    def message_priority(msg, messageclass):
+        priority = getattr(msg, "priority", None)
+        return MessagePriorities.DEFAULTS[messageclass] if priority is None else priority
+
+    @staticmethod
+    def coalesce(messages):
+        """Merge layout diffs into one diff holding every item, oldest first. The merged diff takes
+        the layout version of the newest"""
+        items = []
+        for msg in messages:
+            items.extend(msg.msg.get("val", []))
+        merged = {"val": items}
+        if "version" in messages[-1].msg:
+            merged["version"] = messages[-1].msg["version"]
+        return SimpleMessage(messages[-1].subject, merged, messages[0].timestamp, MessageClasses.LAYOUT_DIFF,
+                             messages[-1].priority)
+
+    def encode(self, msg):
+        """Encode a message into a payload with the negotiated codec"""
+        return msg.encode(self.codec) if isinstance(msg, SimpleMessage) else str(msg)
+
+    def frame(self, msg):
+        """Encode a message into a payload with its length header attached"""
+        return msg.frame(self.codec) if isinstance(msg, SimpleMessage) else FrameWriter.frame(str(msg))
 
     def send(self, msg, address=None):
-        msg = str(msg)
-        frmt = "!%ds" % len(msg)
-        packedmsg = struct.pack(frmt, msg)
-        packedheader = struct.pack('!I', len(packedmsg))
-        self._send(packedheader, address)
-        self._send(packedmsg, address)
-
-    def _send(self, msg, address=None):
-        sent = 0
-        while sent < len(msg):
-            if address is None:
-                sent += self.socket.send(msg[sent:])
-            else:
-                sent += self.socket.sendto(msg[sent:], address)
+        self.writer.append_message(msg, self)
+        self.traffic.increment("messagesOut")
+        if not self.flush():
+            # Let the owner poll us for writability so the rest goes out later
+            for callback in self.readyCallbacks:
+                callback(self)
+
+    def flush_mailbox(self):
+        """Pack queued mailbox messages into one write, within this tick's budget. Messages stay in
+        the mailbox while the socket still has an earlier write to finish, so a stalled peer is
+        held back by the mailbox's limits instead of an unbounded write buffer
+
+        Returns:
+            True once the endpoint has nothing left to write.
+        """
+        if self.writer.pending() and not self.flush():
+            return False
+
+        for msg in self.drain_mailbox():
+            self.writer.append_message(msg, self)
+            self.traffic.increment("messagesOut")
+        return self.flush() and self.outgoingMailbox.empty()
+
+    def drain_mailbox(self):
+        """Take queued messages, highest priority first, until the mailbox is empty or this tick's
+        budget is spent. The message that crosses the budget still goes, so a message bigger than
+        the budget can't get stuck
+
+        Returns:
+            List of messages in send order.
+        """
+        now = NetworkEndpoint.precise_milli_time()
+        messages = []
+        while self.tickBudget is None or self.tickBudget > 0:
+            entry = self.outgoingMailbox.pop(now)
+            if not entry:
+                break
+            queued, msg = entry
+            self.queueDelay.add(now - queued)
+            if self.tickBudget is not None:
+                self.tickBudget -= len(self.frame(msg))
+            messages.append(msg)
+        return messages
+
+    def reset_budget(self, budget):
+        """Start a new tick with a number of bytes the mailbox may send. None removes the limit"""
+        self.tickBudget = budget
+
+    def flush(self):
+        """Write out buffered frames. Returns False if the socket couldn't take all of them"""
+        pending = self.writer.pending()
+        try:
+            return self.writer.flush(self.socket)
+        finally:
+            self.traffic.increment("bytesOut", pending - self.writer.pending())
 
     def event(self, event):
         for callback in self.eventCallbacks:
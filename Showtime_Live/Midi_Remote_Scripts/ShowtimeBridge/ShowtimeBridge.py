@@ -70,3 +70,4 @@ class ShowtimeBridge(ControlSurface):
         if len(LiveSong.instances()) > 0:
             LiveSong.instances()[0].tick()
         LiveWrapper.process_deferred_actions()
+        self.endpoint.flush()
@@ -1,22 +1,36 @@
+import errno
+import select
 import socket
+import time
 
 from Logger import Log
+from Compression import Compression, Compressor, Decompressor
+from MessageCodecs import Codecs
 from NetworkEndpoint import NetworkEndpoint, NetworkPrefixes, NetworkErrors, SimpleMessage
 
 
 class TCPEndpoint(NetworkEndpoint):
     """Network endpoint using TCP"""
+    # Seconds a connect can stay in progress before it counts as failed
+    CONNECT_TIMEOUT = 5
+
     def __init__(self, localport, remoteport, threaded=True, isserversocket=True, existingsocket=None):
         self.serverSocket = isserversocket
         self.hangup = False
         self.clientHandshakeCallbacks = set()
         self.handshakeAckCallbacks = set()
+        self.peerCodecs = None
+        self.peerCompression = None
+        self.peerCompressionThreshold = Compression.DEFAULT_THRESHOLD
+        self.peerHandshake = {}
+        self.connectStarted = None
         if existingsocket:
             self.socket = existingsocket
         NetworkEndpoint.__init__(self, localport, remoteport, threaded)
 
     def close(self):
         self.hangup = True
+        self.connectStarted = None
         NetworkEndpoint.close(self)
 
     def create_socket(self):
@@ -28,7 +42,7 @@ class TCPEndpoint(NetworkEndpoint):
 
         if self.serverSocket:
             self.socket.bind(self.localAddr)
-            self.socket.listen(2)
+            self.socket.listen(8)
 
         if not self.threaded:
             self.socket.setblocking(0)
@@ -36,34 +50,67 @@ class TCPEndpoint(NetworkEndpoint):
             self.socket.setblocking(1)
 
     def connect(self):
+        """Start connecting to the remote address, or check on a connect that is already under way.
+
+        Unthreaded endpoints never block here. The first call starts a non-blocking connect and
+        later calls poll it, so a caller on a UI thread calls this once per tick until the status
+        changes. Each call costs at most one socket call and a zero timeout select.
+
+        Returns:
+            PIPE_CONNECTED once connected. PIPE_DISCONNECTED while the connect is in progress or
+            after it failed, which connecting tells apart.
+        """
+        if self.connecting():
+            return self.check_connect()
+
         self.create_socket()
-        status = 0
-        retries = 5
-        while retries > 0:
-            try:
-                status = self.socket.connect(self.remoteAddr)
-            except socket.error, e:
-                if e[0] == NetworkErrors.EISCONN:
-                    Log.network("...TCP connected!")
-                    self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
-                    break
-                elif e[0] == NetworkErrors.EAGAIN:
-                    Log.network("TCP connecting...")
-                    retries -= 1
-                elif e[0] == socket.timeout:
-                    Log.error("Timed out")
-                    self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
-                else:
-                    Log.error("Connection failed!")
-                    Log.error("Reason: " + str(e))
-                    self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
-                    break
-
-        if status == 0:
-            self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
-        else:
-            Log.error("Connection failed with error %s" % status)
-        
+        self.reset_streams()
+        self.codec = self.peerCodec = Codecs.DEFAULT
+        try:
+            status = self.socket.connect_ex(self.remoteAddr)
+        except socket.error, e:
+            status = e[0]
+
+        if status == 0 or status == NetworkErrors.EISCONN:
+            return self.connected()
+        elif status in NetworkErrors.CONNECT_PENDING:
+            Log.network("TCP connecting...")
+            self.connectStarted = time.time()
+            return self.connectionStatus
+        return self.connect_failed(status)
+
+    def connecting(self):
+        return self.connectStarted is not None
+
+    def check_connect(self):
+        try:
+            inputready, outputready, exceptready = select.select([], [self.socket], [self.socket], 0)
+        except (select.error, socket.error), e:
+            return self.connect_failed(e[0])
+
+        # A finished connect shows up as writable. Windows reports failed ones as exceptional instead
+        if outputready or exceptready:
+            status = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if status == 0:
+                return self.connected()
+            return self.connect_failed(status)
+
+        if time.time() - self.connectStarted > TCPEndpoint.CONNECT_TIMEOUT:
+            Log.error("Timed out")
+            return self.connect_failed(errno.ETIMEDOUT)
+        return self.connectionStatus
+
+    def connected(self):
+        Log.network("...TCP connected!")
+        self.connectStarted = None
+        self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+        return self.connectionStatus
+
+    def connect_failed(self, status):
+        Log.error("Connection failed with error %s (%s)" % (status, errno.errorcode.get(status, "unknown")))
+        self.connectStarted = None
+        self.socket.close()
+        self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
         return self.connectionStatus
 
     def event(self, event):
@@ -71,25 +118,99 @@ class TCPEndpoint(NetworkEndpoint):
             Log.network("TCP handshake received. Socket is %s" % self.socket)
             if self.connectionStatus == NetworkEndpoint.PIPE_CONNECTED:
                 self.connectionStatus = NetworkEndpoint.HANDSHAKING
+                if event.msg:
+                    self.peerHandshake = event.msg
+                    self.peerCodecs = event.msg.get("codecs")
+                    self.peerCompression = event.msg.get("compression")
+                    self.peerCompressionThreshold = event.msg.get("threshold", Compression.DEFAULT_THRESHOLD)
                 for callback in self.clientHandshakeCallbacks:
                     callback()
             return
         elif event.subject == NetworkPrefixes.HANDSHAKE_ACK:
             Log.network("TCP handshake ACK received")
+            self.peerHandshake = event.msg if event.msg else {}
+            # Everything the server sends after its ACK uses the codec it picked
+            self.codec = self.peerCodec = Codecs.get(event.msg.get("codec") if event.msg else None,
+                                                     self.peer_is_local())
+            Log.network("Using %s codec" % self.codec.NAME)
+            if event.msg and event.msg.get("compression") == Compression.ZLIB:
+                Log.network("Compressing payloads over %s bytes" % event.msg["threshold"])
+                self.writer.compressor = Compressor(event.msg["threshold"])
             self.connectionStatus = NetworkEndpoint.HANDSHAKE_COMPLETE
             for callback in self.handshakeAckCallbacks:
                 callback()
             return
         NetworkEndpoint.event(self, event)
 
-    def send_handshake(self):
+    def send_handshake(self, extra=None):
+        """Offer our codecs and compression to the server
+
+        Args:
+            extra: Additional fields for the server, like the port our UDP endpoint listens on
+        """
         Log.network("Sending TCP handshake")
-        self.send_msg(SimpleMessage(NetworkPrefixes.HANDSHAKE, None))
+        # Be ready to inflate as soon as we offer compression so the peer can start right after its ACK
+        compression = Compression.supported()
+        self.reader.decompressor = Decompressor() if compression else None
+        handshake = dict(extra) if extra else {}
+        handshake.update({
+            "codecs": Codecs.supported(self.peer_is_local()),
+            "compression": compression,
+            "threshold": Compression.DEFAULT_THRESHOLD
+        })
+        self.send_msg(SimpleMessage(NetworkPrefixes.HANDSHAKE, handshake))
         self.connectionStatus = NetworkEndpoint.HANDSHAKING
 
-    def send_handshake_ack(self):
+    def send_handshake_ack(self, extra=None):
+        """Answer a client handshake with the codec and compression we picked
+
+        Args:
+            extra: Additional fields for the client, like the UDP port of its session
+        """
         Log.network("Sending TCP handshake ACK on %s" % self.socket)
-        self.send_msg(SimpleMessage(NetworkPrefixes.HANDSHAKE_ACK, None))
+        codec = Codecs.negotiate(self.peerCodecs, self.peer_is_local())
+        Log.network("Using %s codec" % codec.NAME)
+        compression = Compression.negotiate(self.peerCompression)
+        if compression:
+            # The peer only compresses once it has our ACK, so the decompressor is in place first.
+            # The peer could inflate from the moment it offered compression so we can start right away
+            self.reader.decompressor = Decompressor()
+            self.writer.compressor = Compressor(self.peerCompressionThreshold)
+        ack = dict(extra) if extra else {}
+        ack.update({
+            "codec": codec.NAME,
+            "compression": compression,
+            "threshold": self.peerCompressionThreshold
+        })
+
+        # The peer reads the ACK with the default codec and switches once it has it. The ACK is
+        # encoded before we switch, and the handshake was the last payload in the default codec
+        self.send_msg(SimpleMessage(NetworkPrefixes.HANDSHAKE_ACK, ack), True)
+        self.codec = self.peerCodec = codec
+
+    def peer_is_local(self):
+        """Whether the other end of the connection is on this machine, which decides the codecs we
+        can use with it"""
+        if not self.socket:
+            return False
+        if self.socket.family == getattr(socket, "AF_UNIX", None):
+            return True
+        try:
+            host = self.socket.getpeername()[0]
+        except socket.error:
+            return False
+        return host.startswith("127.") or host in ("::1", "::ffff:127.0.0.1")
+
+    def compression_stats(self):
+        """Counters and achieved ratios for both directions of this connection"""
+        stats = {}
+        if self.writer.compressor:
+            stats["sent"] = self.writer.compressor.stats.as_dict()
+            stats["sent"]["ratio"] = self.writer.compressor.ratio()
+        if self.reader.decompressor:
+            stats["received"] = self.reader.decompressor.stats.as_dict()
+            stats["received"]["ratio"] = self.reader.decompressor.ratio()
+        return stats
 
     # Callback management
     # -------------------
@@ -0,0 +1,203 @@
+import mmap
+import os
+import struct
+
+from Logger import Log
+
+
+class TelemetryRing:
+    """Single producer, single consumer ring of fixed size records in a memory mapped file.
+
+    High rate telemetry like meter levels and playing positions is written here by the bridge
+    instead of going through a socket, and the router drains it on its own schedule. Each side
+    only ever writes its own index: the producer publishes its write index once per tick, after
+    the records, and the consumer publishes its read index once it has copied them out.
+    Indices count records from the start and never wrap, so a full ring is write - read == capacity.
+
+    Telemetry is superseded by the next value anyway, so a full ring drops records instead of
+    blocking. Dropped records are counted in the header for the consumer to report.
+
+    Python has no memory barriers, so nothing stops a CPU with weak memory ordering from making the
+    published write index visible before the records it covers. Each record ends with the low bits
+    of its own index, and the consumer leaves a record for its next drain until that matches. This
+    catches records that aren't visible yet, but can't promise the fields before the sequence
+    number landed first. x86 keeps stores in order, so there the check never fires.
+    """
+    MAGIC = "STR2"
+    DEFAULT_CAPACITY = 8192
+
+    # Magic, capacity in records and record size
+    HEADER = struct.Struct("<4sII")
+    INDEX = struct.Struct("<Q")
+
+    # The producer and consumer indices live on separate cache lines
+    WRITE_OFFSET = 64
+    DROPPED_OFFSET = 72
+    READ_OFFSET = 128
+    RECORDS_OFFSET = 192
+
+    # Method ID, flags, wrapper ID length, wrapper ID, value, creation timestamp, sequence number
+    RECORD = struct.Struct("<HBB24sddI")
+    MAX_ID_LENGTH = 24
+    SEQUENCE_MASK = 0xFFFFFFFF
+
+    # Record flags. A frame record heads a dict valued message, and its value is the number of
+    # id/value records that follow it
+    FLAG_FRAME = 1
+    FLAG_KEYFRAME = 2
+
+    def __init__(self, path, capacity=None):
+        """Create a ring, or open an existing one if no capacity is given
+
+        Args:
+            path: Backing file. Both sides map the same file. A new ring's file must not exist yet
+            capacity: Number of records the ring holds
+        """
+        self.path = path
+        self.owner = capacity is not None
+        if self.owner:
+            # Creating the file ourselves means nobody else planted it or can read it
+            size = TelemetryRing.RECORDS_OFFSET + capacity * TelemetryRing.RECORD.size
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0600)
+            self.file = os.fdopen(fd, "r+b")
+            self.file.write("\0" * size)
+            self.file.flush()
+        else:
+            self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        if self.owner:
+            TelemetryRing.HEADER.pack_into(self.map, 0, TelemetryRing.MAGIC, capacity, TelemetryRing.RECORD.size)
+        magic, self.capacity, recordsize = TelemetryRing.HEADER.unpack_from(self.map, 0)
+        if magic != TelemetryRing.MAGIC or recordsize != TelemetryRing.RECORD.size:
+            self.close()
+            raise ValueError("%s is not a telemetry ring this version understands" % path)
+
+        # The producer's index stays private until commit publishes it
+        self.writeIndex = self._load(TelemetryRing.WRITE_OFFSET)
+        self.droppedRecords = self._load(TelemetryRing.DROPPED_OFFSET)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+        if self.owner:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _load(self, offset):
+        # Python doesn't promise an atomic 8 byte read, so read until two reads agree
+        value = TelemetryRing.INDEX.unpack_from(self.map, offset)[0]
+        while 1:
+            again = TelemetryRing.INDEX.unpack_from(self.map, offset)[0]
+            if again == value:
+                return value
+            value = again
+
+    def _store(self, offset, value):
+        TelemetryRing.INDEX.pack_into(self.map, offset, value)
+
+    # Producer
+    # --------
+    @staticmethod
+    def representable(wrapperid, value):
+        return type(value) in (int, long, float) and isinstance(wrapperid, basestring) and \
+            len(wrapperid) <= TelemetryRing.MAX_ID_LENGTH
+
+    def reserve(self, count):
+        """Check there's room for a number of records, counting a drop if there isn't"""
+        if self.writeIndex + count - self._load(TelemetryRing.READ_OFFSET) <= self.capacity:
+            return True
+        self.droppedRecords += count
+        return False
+
+    def _write(self, methodid, flags, wrapperid, value, timestamp):
+        offset = TelemetryRing.RECORDS_OFFSET + (self.writeIndex % self.capacity) * TelemetryRing.RECORD.size
+        wrapperid = str(wrapperid)
+        TelemetryRing.RECORD.pack_into(self.map, offset, methodid, flags, len(wrapperid), wrapperid,
+                                       value, timestamp, self.writeIndex & TelemetryRing.SEQUENCE_MASK)
+        self.writeIndex += 1
+
+    def append(self, methodid, wrapperid, value, timestamp):
+        """Write a single id/value record
+
+        Returns:
+            False if the record can't be represented and has to be sent some other way.
+        """
+        if not TelemetryRing.representable(wrapperid, value):
+            return False
+        if self.reserve(1):
+            self._write(methodid, 0, wrapperid, value, timestamp)
+        return True
+
+    def append_frame(self, methodid, frameid, values, timestamp, keyframe=False):
+        """Write a dict of id/value pairs as a frame record followed by one record per pair.
+        Frames are written whole or dropped whole
+
+        Returns:
+            False if the frame can't be represented and has to be sent some other way.
+        """
+        if not isinstance(frameid, basestring) or len(frameid) > TelemetryRing.MAX_ID_LENGTH:
+            return False
+        for wrapperid, value in values.iteritems():
+            if not TelemetryRing.representable(wrapperid, value):
+                return False
+        if self.reserve(len(values) + 1):
+            flags = TelemetryRing.FLAG_FRAME | (TelemetryRing.FLAG_KEYFRAME if keyframe else 0)
+            self._write(methodid, flags, frameid, len(values), timestamp)
+            for wrapperid, value in values.iteritems():
+                self._write(methodid, 0, wrapperid, value, timestamp)
+        return True
+
+    def commit(self):
+        """Make everything written since the last commit visible to the consumer"""
+        self._store(TelemetryRing.DROPPED_OFFSET, self.droppedRecords)
+        self._store(TelemetryRing.WRITE_OFFSET, self.writeIndex)
+
+    # Consumer
+    # --------
+    def pending(self):
+        return self._load(TelemetryRing.WRITE_OFFSET) - self._load(TelemetryRing.READ_OFFSET)
+
+    def dropped(self):
+        return self._load(TelemetryRing.DROPPED_OFFSET)
+
+    def records(self):
+        """Copy out every committed record and hand the space back to the producer
+
+        Returns:
+            List of (methodid, flags, wrapperid, value, timestamp) tuples in write order.
+        """
+        readindex = self._load(TelemetryRing.READ_OFFSET)
+        writeindex = self._load(TelemetryRing.WRITE_OFFSET)
+        if writeindex - readindex > self.capacity:
+            Log.error("Telemetry ring indices out of range. Skipping to the newest records")
+            readindex = writeindex - self.capacity
+
+        records = []
+        unpack = TelemetryRing.RECORD.unpack_from
+        framestart = None
+        remaining = 0
+        for index in xrange(readindex, writeindex):
+            offset = TelemetryRing.RECORDS_OFFSET + (index % self.capacity) * TelemetryRing.RECORD.size
+            methodid, flags, idlength, wrapperid, value, timestamp, sequence = unpack(self.map, offset)
+            if sequence != index & TelemetryRing.SEQUENCE_MASK:
+                # Published but not visible to us yet. It's picked up next drain, along with the
+                # rest of its frame
+                if remaining:
+                    del records[framestart - readindex:]
+                    index = framestart
+                writeindex = index
+                break
+            if remaining:
+                remaining -= 1
+            elif flags & TelemetryRing.FLAG_FRAME:
+                framestart = index
+                remaining = int(value)
+            records.append((methodid, flags, wrapperid[:idlength], value, timestamp))
+        self._store(TelemetryRing.READ_OFFSET, writeindex)
+        return records
+
+    def stats(self):
+        return {"capacity": self.capacity, "pending": self.pending(), "dropped": self.dropped()}
@@ -1,6 +1,10 @@
-from NetworkEndpoint import NetworkEndpoint, SimpleMessage, NetworkPrefixes
+from Framing import DatagramPacker
+from MessageCodecs import Codecs
+from Metrics import SequenceStats, ClockOffset
+from NetworkEndpoint import NetworkEndpoint, SimpleMessage, NetworkPrefixes, NetworkErrors
 import threading
 import socket
+import struct
 import time
 from Logger import Log
 
@@ -20,9 +24,11 @@ class HeartbeatThread(threading.Thread):
     def run(self):
         while not self.exitFlag:
             time.sleep(1)
+            # The endpoint may have been closed while we slept
+            if self.exitFlag:
+                break
             self.endpoint.send_heartbeat()
             # self.endpoint.check_heartbeat()
-        self.join(2)
 
 
 class UDPEndpoint(NetworkEndpoint):
@@ -30,13 +36,24 @@ class UDPEndpoint(NetworkEndpoint):
     HEARTBEAT_DURATION = 2000
     HEARTBEAT_TIMEOUT = HEARTBEAT_DURATION * 2
 
-    def __init__(self, localport, remoteport, threaded=True, heartbeatid=None):
+    # Every datagram starts with the sender's sequence number
+    SEQUENCE = struct.Struct("!I")
+
+    def __init__(self, localport, remoteport, threaded=True, heartbeatid=None, sendheartbeats=True):
+        self.sendHeartbeats = sendheartbeats
+        self.lastAddress = None
+        self.peerConnected = False
+        self.txSequence = 0
+        self.txLock = threading.Lock()
+        self.sequenceStats = SequenceStats()
+        self.heartbeatThread = None
         NetworkEndpoint.__init__(self, localport, remoteport, threaded)
         self.lastPeerHeartbeatTime = 0
         self.lastTransmittedHeartbeatTime = 0
         self.heartbeatID = heartbeatid
         self.lastReceivedHeartbeatID = None
-        self.heartbeatThread = None
+        self.clock = ClockOffset()
+        self.packer = DatagramPacker(DatagramPacker.MAX_DATAGRAM_SIZE - UDPEndpoint.SEQUENCE.size)
 
     def create_socket(self):
         """Create the UDP socket for this endpoint"""
@@ -46,23 +63,71 @@ class UDPEndpoint(NetworkEndpoint):
         self.socket.settimeout(5)
         self.socket.bind(self.localAddr)
 
-        if self.threaded:
-            self.heartbeatThread = HeartbeatThread(self)
-            self.heartbeatThread.start()
-        else:
+        if not self.threaded:
             self.socket.setblocking(0)
+        elif self.sendHeartbeats:
+            self.start_heartbeats()
+
+    def connect_peer(self, codec):
+        """Only take datagrams from the remote address from now on, so they can be decoded with a
+        negotiated codec. Unconnected sockets take datagrams from anyone and stay on the default codec
+
+        Args:
+            codec: Codec negotiated with the peer
+
+        Returns:
+            True if the socket is connected to the peer.
+        """
+        try:
+            self.socket.connect(self.remoteAddr)
+        except socket.error, e:
+            Log.warn("Can't connect datagram socket to %s. Staying on the default codec. %s" % (self.remoteAddr, e))
+            return False
+        self.peerConnected = True
+        self.codec = self.peerCodec = codec
+        return True
+
+    def disconnect_peer(self):
+        """Go back to the default codec once the socket may take datagrams from anyone again"""
+        self.peerConnected = False
+        self.codec = self.peerCodec = Codecs.DEFAULT
+
+    def start_heartbeats(self):
+        self.heartbeatThread = HeartbeatThread(self)
+        self.heartbeatThread.start()
 
     def close(self):
         """Destroy this socket"""
-        if hasattr(self, "heartbeatThread"):
-            if self.heartbeatThread:
-                self.heartbeatThread.stop()
+        if self.heartbeatThread:
+            self.heartbeatThread.stop()
         NetworkEndpoint.close(self)
 
     def send_heartbeat(self):
-        """Send heartbeat message"""
-        if NetworkEndpoint.current_milli_time() > self.lastTransmittedHeartbeatTime + UDPEndpoint.HEARTBEAT_DURATION:
-            self.send_msg(SimpleMessage(NetworkPrefixes.HEARTBEAT, self.heartbeatID), True, self.remoteAddr)
+        """Send heartbeat message. The send time lets the peer echo it back for clock syncing"""
+        now = NetworkEndpoint.current_milli_time()
+        if now > self.lastTransmittedHeartbeatTime + UDPEndpoint.HEARTBEAT_DURATION:
+            self.lastTransmittedHeartbeatTime = now
+            self.send_msg(SimpleMessage(NetworkPrefixes.HEARTBEAT, {
+                "id": self.heartbeatID,
+                "sent": NetworkEndpoint.precise_milli_time()
+            }), True, self.remoteAddr)
+
+    def echo_heartbeat(self, sent, received, address):
+        """Reply to a heartbeat with its send time plus our receive and reply times. The echo
+        carries our heartbeat ID so it also tells the sender we're alive"""
+        self.send_msg(SimpleMessage(NetworkPrefixes.HEARTBEAT_ECHO, {
+            "id": self.heartbeatID,
+            "sent": sent,
+            "received": received,
+            "replied": NetworkEndpoint.precise_milli_time()
+        }), True, address)
+
+    def take_over_heartbeat(self, endpoint):
+        """Carry the peer's liveness over from another endpoint, so moving a session to a new
+        channel doesn't look like a heartbeat timeout"""
+        self.lastPeerHeartbeatTime = endpoint.lastPeerHeartbeatTime
+        self.lastReceivedHeartbeatID = self.heartbeatID = endpoint.lastReceivedHeartbeatID
+        self.connectionStatus = endpoint.connectionStatus
 
     def check_heartbeat(self):
         """Check if we've received a UDP heartbeat from a remote UDP endpoint"""
@@ -91,16 +156,98 @@ class UDPEndpoint(NetworkEndpoint):
             event: SimpleMessage object containing event subject and msg
         """
         if event.subject == NetworkPrefixes.HEARTBEAT:
+            received = NetworkEndpoint.precise_milli_time()
+            self.lastPeerHeartbeatTime = NetworkEndpoint.current_milli_time()
+            self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+            if isinstance(event.msg, dict):
+                self.lastReceivedHeartbeatID = event.msg.get("id")
+                if "sent" in event.msg:
+                    self.echo_heartbeat(event.msg["sent"], received, self.lastAddress)
+            else:
+                self.lastReceivedHeartbeatID = event.msg
+            return
+        elif event.subject == NetworkPrefixes.HEARTBEAT_ECHO:
             self.lastPeerHeartbeatTime = NetworkEndpoint.current_milli_time()
-            self.lastReceivedHeartbeatID = event.msg
+            self.lastReceivedHeartbeatID = event.msg.get("id")
             self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+            self.clock.add_sample(event.msg["sent"], event.msg["received"], event.msg["replied"],
+                                  NetworkEndpoint.precise_milli_time())
             return
         NetworkEndpoint.event(self, event)
 
+    def _fill(self):
+        """Read a single datagram. Each one holds a sequence number followed by whole frames"""
+        try:
+            count, address = self.reader.read_datagram(self.socket)
+        except socket.error, e:
+            # Windows reports a port unreachable answer to an earlier send as a reset, and connected
+            # sockets report it as a refusal. There is no connection to lose over UDP, so the next
+            # heartbeat simply tries again
+            if e[0] in (NetworkErrors.ECONNRESET, NetworkErrors.ECONNREFUSED):
+                return 0
+            raise
+        self.lastAddress = address
+        if count < UDPEndpoint.SEQUENCE.size:
+            self.reader.skip(count)
+            return count
+        self.sequenceStats.add(self.reader.read_prefix(UDPEndpoint.SEQUENCE)[0])
+        return count
+
     def send(self, msg, address=None):
-        """Send a message
+        """Send a message as a single datagram
 
         Args:
-            address: Destination address of message
+            address: Destination address of message. Defaults to the remote address
+        """
+        self._send_datagram(self.frame(msg), address)
+        self.traffic.increment("messagesOut")
+
+    def _send_datagram(self, frames, address=None):
+        # The heartbeat thread sends too, so sequence numbers are handed out under a lock
+        with self.txLock:
+            datagram = UDPEndpoint.SEQUENCE.pack(self.txSequence) + frames
+            self.txSequence = (self.txSequence + 1) & SequenceStats.SEQUENCE_MASK
+            if self.peerConnected:
+                # Some platforms refuse an address on a connected socket, which only reaches its peer anyway
+                try:
+                    self.socket.send(datagram)
+                except socket.error, e:
+                    if e[0] == NetworkErrors.ENOTCONN:
+                        # The peer closed its socket, which leaves ours open to anyone
+                        self.disconnect_peer()
+                    elif e[0] != NetworkErrors.ECONNREFUSED:
+                        raise
+                    Log.network("Dropped datagram to %s. %s" % (self.remoteAddr, e))
+            else:
+                self.socket.sendto(datagram, address or self.remoteAddr)
+        self.traffic.increment("bytesOut", len(datagram))
+
+    def queue_msg(self, msg):
+        """Queue a message to be packed with others into the datagrams of the next mailbox flush
+
+        Returns:
+            False if the mailbox is full and its policy dropped the message.
         """
-        NetworkEndpoint.send(self, msg, self.remoteAddr)
+        return self.outgoingMailbox.put(NetworkEndpoint.precise_milli_time(), msg)
+
+    def flush_mailbox(self):
+        """Pack queued mailbox messages into datagrams and send them, within this tick's budget"""
+        for msg in self.drain_mailbox():
+            self.packer.append_frame(self.frame(msg))
+            self.traffic.increment("messagesOut")
+        return self.flush() and self.outgoingMailbox.empty()
+
+    def flush(self):
+        """Send all packed datagrams. Datagrams the socket refuses are dropped"""
+        for datagram in self.packer.pack():
+            try:
+                self._send_datagram(datagram)
+            except socket.error, e:
+                Log.network("Dropped %d byte datagram. %s" % (len(datagram), e))
+        return True
+
+    def sequence_stats(self):
+        """Loss, duplicate and reordering statistics for datagrams received from the peer"""
+        stats = self.sequenceStats.as_dict()
+        stats["sent"] = self.txSequence
+        return stats
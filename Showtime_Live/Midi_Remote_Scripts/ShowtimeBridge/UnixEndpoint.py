@@ -0,0 +1,124 @@
+import errno
+import os
+import socket
+import tempfile
+
+from Logger import Log
+from MessageCodecs import Codecs
+from NetworkEndpoint import NetworkEndpoint
+from TCPEndpoint import TCPEndpoint
+from UDPEndpoint import UDPEndpoint
+
+
+class UnixSockets:
+    """Socket file locations for endpoints that share a host with their peer"""
+    def __init__(self):
+        pass
+
+    # Windows builds of Python 2 have no AF_UNIX. Those clients stay on TCP and UDP
+    SUPPORTED = hasattr(socket, "AF_UNIX")
+
+    # Hosts that mean the peer is on this machine
+    LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+    @staticmethod
+    def path(name):
+        """Socket file for a name. Kept short since macOS caps socket paths at 104 bytes"""
+        return os.path.join(tempfile.gettempdir(), "showtime-live-%s.sock" % name)
+
+    @staticmethod
+    def is_local(host):
+        return host in UnixSockets.LOCAL_HOSTS
+
+    @staticmethod
+    def unlink(path):
+        """Remove a socket file, such as one left behind by a process that crashed"""
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class UnixStreamEndpoint(TCPEndpoint):
+    """TCPEndpoint over an AF_UNIX stream socket. Handshakes and framing are identical to TCP,
+    but messages skip the loopback network stack"""
+    def __init__(self, path, threaded=True, isserversocket=True, existingsocket=None):
+        self.path = path
+        TCPEndpoint.__init__(self, -1, -1, threaded, isserversocket, existingsocket)
+        self.localAddr = self.remoteAddr = path
+
+    def create_socket(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.settimeout(5)
+
+        if self.serverSocket:
+            UnixSockets.unlink(self.path)
+            self.socket.bind(self.path)
+            self.socket.listen(8)
+
+        if not self.threaded:
+            self.socket.setblocking(0)
+        else:
+            self.socket.setblocking(1)
+
+    def connect(self):
+        """Connect to a listening Unix socket. Local connects either succeed or fail straight away,
+        so a missing server can be reported without waiting for a retry"""
+        self.create_socket()
+        self.reset_streams()
+        self.codec = self.peerCodec = Codecs.DEFAULT
+        try:
+            self.socket.connect(self.remoteAddr)
+        except socket.error, e:
+            Log.network("Unix socket %s unavailable. %s" % (self.remoteAddr, e))
+            self.socket.close()
+            self.connectionStatus = NetworkEndpoint.PIPE_DISCONNECTED
+            return self.connectionStatus
+
+        Log.network("Connected to %s" % self.remoteAddr)
+        self.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+        return self.connectionStatus
+
+    def close(self):
+        TCPEndpoint.close(self)
+        if self.serverSocket:
+            UnixSockets.unlink(self.path)
+
+
+class UnixDatagramEndpoint(UDPEndpoint):
+    """UDPEndpoint over an AF_UNIX datagram socket bound to a socket file.
+
+    Datagrams keep their sequence numbers and heartbeats, so loss tracking, liveness and clock
+    syncing behave exactly as they do over UDP.
+    """
+    def __init__(self, path, remotepath, threaded=True, heartbeatid=None, sendheartbeats=True):
+        self.path = path
+        UDPEndpoint.__init__(self, -1, -1, threaded, heartbeatid, sendheartbeats)
+        self.localAddr = path
+        self.remoteAddr = remotepath
+
+    def create_socket(self):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.settimeout(5)
+        UnixSockets.unlink(self.path)
+        self.socket.bind(self.path)
+
+        if not self.threaded:
+            self.socket.setblocking(0)
+        elif self.sendHeartbeats:
+            self.start_heartbeats()
+
+    def _send_datagram(self, frames, address=None):
+        try:
+            UDPEndpoint._send_datagram(self, frames, address)
+        except socket.error, e:
+            # Unlike UDP, sending to a socket file nobody is bound to fails right away, as does
+            # sending to one still connected to an earlier peer. The datagram is lost either way and
+            # the heartbeat timeout notices a peer that went away
+            if e[0] not in (errno.ECONNREFUSED, errno.ENOENT, errno.EPERM):
+                raise
+            Log.network("Dropped datagram to %s. %s" % (address or self.remoteAddr, e))
+
+    def close(self):
+        UDPEndpoint.close(self)
+        UnixSockets.unlink(self.path)
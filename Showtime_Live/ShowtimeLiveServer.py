@@ -13,8 +13,10 @@ from shutil import copytree, rmtree, ignore_patterns
 import zmq
 from Showtime.zst_method import ZstMethod
 
-from Showtime_Live.LiveRouter import LiveRouter
+from Showtime_Live.LiveRouter import LiveRouter, Registrar
+from Showtime_Live.AsyncRouter import AsyncRouter
 from Showtime_Live.MidiRouter import MidiRouter
+from Showtime_Live.TimerWheel import TimerThread
 from Showtime_Live.Midi_Remote_Scripts.ShowtimeBridge.Logger import Log
 
 
@@ -123,6 +125,10 @@ class Display(Frame):
                                           Log.titles[Log.LOG_ERRORS])
         self.logLevelOptions.grid(row=13, column=0, sticky=(S, E, W), padx=2, pady=2)
 
+        # Latency report
+        self.latencyBtn = Button(self, text="Print message latency", command=self.print_latency)
+        self.latencyBtn.grid(row=14, column=0, sticky=(S, E, W), padx=2, pady=2)
+
         # Midi UI
         self.midiPortVar = None
         self.midiPortOptions = None
@@ -147,7 +153,9 @@ class Display(Frame):
         self.midiPortOptions.grid(row=3, column=1, sticky=(N, W), padx=2, pady=2)
 
     def connectionstatus_changed(self, *args):
-        text = "Connected" if self.showtimeRouter.clientConnected else "Disconnected"
+        clients = len(self.showtimeRouter.sessions)
+        text = "Connected (%d instance%s)" % (clients, "" if clients == 1 else "s") \
+            if self.showtimeRouter.clientConnected else "Disconnected"
         print("\nAbleton Live connection status: %s\n\n" % text)
         self.connectionStatusLabel.set(text)
 
@@ -157,7 +165,7 @@ class Display(Frame):
             if len(ports) > 0:
                 portindex = int(ports.index(self.midiPortVar.get()))
                 self.midiRouter.close()
-                self.midiRouter = MidiRouter(portindex)
+                self.midiRouter = MidiRouter(portindex, self.midiRouter.timers)
 
     def logtype_changed(self, *args):
         Log.set_log_level(Log.log_level_from_name(self.logTypeVar.get()))
@@ -168,6 +176,26 @@ class Display(Frame):
     def logshowtime_changed(self, *args):
         pass
 
+    def print_latency(self):
+        if not self.showtimeRouter:
+            return
+        latency = self.showtimeRouter.latency_stats()
+        if not latency:
+            print("\nNo Live instances connected")
+        for namespace in sorted(latency):
+            stats = latency[namespace]
+            clock = stats["clock"]
+            print("\n%s: Live-->Showtime latency in ms" % namespace)
+            if clock:
+                print("Clock offset %.3f, round trip %.3f" % (clock["offset"], clock["delay"]))
+            else:
+                print("Waiting for clock sync")
+            print("%-32s %8s %8s %8s %8s" % ("Method", "Count", "p50", "p99", "Max"))
+            for methodname in sorted(stats["methods"]):
+                histogram = stats["methods"][methodname]
+                print("%-32s %8d %8.2f %8.2f %8.2f" % (methodname, histogram["count"], histogram["p50"],
+                                                       histogram["p99"], histogram["max"]))
+
     def open_custom_install_dialog(self):
         LiveScriptInstallDialog(self)
 
@@ -241,6 +269,20 @@ class ShowtimeLiveServer:
                           help="IP address of the Showtime stage.", default=None)
         parser.add_option("-p", "--stageport", action="store", dest="stageport", type="string",
                           help="Port of the Showtime stage", default="6000")
+        parser.add_option("--udpport", action="store", dest="udpport", type="int",
+                          help="UDP port Live instances announce themselves on.", default=LiveRouter.UDP_PORT)
+        parser.add_option("--tcpport", action="store", dest="tcpport", type="int",
+                          help="TCP port Live instances connect to.", default=LiveRouter.TCP_PORT)
+        parser.add_option("--nounix", action="store_false", dest="unixsockets",
+                          help="Don't offer Unix sockets to Live instances on this machine.", default=True)
+        parser.add_option("--notelemetry", action="store_false", dest="telemetry",
+                          help="Don't give Live instances on this machine a shared memory telemetry ring.", default=True)
+        parser.add_option("--eventloop", action="store_true", dest="eventloop",
+                          help="Run the router on a single event loop thread instead of a thread per job.",
+                          default=False)
+        parser.add_option("--registration-workers", action="store", dest="registrationWorkers", type="int",
+                          help="Method registrations kept in flight with the stage. Each one gets its own stage "
+                               "socket.", default=Registrar.DEFAULT_WORKERS)
         parser.add_option("-m", "--midiportindex", action="store", dest="midiportindex", type="int",
                           help="Midi loopback port to use. Windows only, make sure loopMidi is running first!",
                           default=None)
@@ -293,16 +335,20 @@ class ShowtimeLiveServer:
         if not options.useCLI:
             gui.update()
 
+        # Heartbeats, the MIDI clock and other periodic jobs share one timer thread
+        self.timers = TimerThread()
+        self.timers.start()
+
         # Set up MIDI router
         print("\n-------------------------------------")
         print("Starting MIDI clock")
-        self.midiRouter = MidiRouter(options.midiportindex)
+        self.midiRouter = MidiRouter(options.midiportindex, self.timers)
 
         if platform.system() == "Windows":
             gui.create_midi_loopback_options(self.midiRouter)
 
         if options.listmidiports:
-            midirouter = MidiRouter(None)
+            midirouter = MidiRouter(None, self.timers)
             print("\n-------------------------------------")
             print("Available MIDI ports:")
             midirouter.list_midi_ports()
@@ -320,7 +366,9 @@ class ShowtimeLiveServer:
 
         self.showtimeRouter = None
         try:
-            self.showtimeRouter = LiveRouter(stageaddress)
+            engine = AsyncRouter if options.eventloop else LiveRouter
+            self.showtimeRouter = engine(stageaddress, options.udpport, options.tcpport, options.unixsockets,
+                                         options.telemetry, self.timers, options.registrationWorkers)
             if not options.useCLI:
                 gui.set_showtime_router(self.showtimeRouter)
 
@@ -363,6 +411,7 @@ class ShowtimeLiveServer:
             if self.showtimeRouter:
                 self.showtimeRouter.stop()
             self.midiRouter.close()
+            self.timers.stop()
 
 
 def main():
@@ -0,0 +1,271 @@
+import math
+import select
+import threading
+import time
+
+from ShowtimeBridge.Logger import Log
+from ShowtimeBridge.Metrics import Histogram
+from Showtime_Live.EventSelector import Waker
+
+
+class TimerTask:
+    """Callback the wheel runs once, or every interval seconds"""
+    def __init__(self, callback, args, due, interval=None, name=None):
+        self.callback = callback
+        self.args = args
+        self.due = due
+        self.interval = interval
+        self.name = name or getattr(callback, "__name__", "timer")
+        self.dueTick = 0
+        self.cancelled = False
+
+        # Milliseconds between when the task was due and when it ran
+        self.lateness = Histogram()
+        self.runs = 0
+        self.skipped = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        stats = self.lateness.as_dict()
+        stats["runs"] = self.runs
+        stats["skipped"] = self.skipped
+        return stats
+
+
+class TimerWheel:
+    """Hierarchical timing wheel.
+
+    The first level has a slot per tick. Each level above covers the whole of the level below in
+    each of its slots, and its timers cascade down a level whenever the level below wraps around,
+    so adding, cancelling and expiring a timer cost the same however many are waiting. Timers
+    further away than the top level can reach wait in an overflow list.
+
+    Not thread safe. TimerThread serialises access to its wheel.
+    """
+    # Seconds per tick
+    TICK = 0.001
+
+    # Slots per level as powers of two. Reaches 256ms, 16s, 17 minutes and 18 hours
+    LEVEL_BITS = (8, 6, 6, 6)
+
+    def __init__(self, tick=TICK, now=None):
+        self.tick = tick
+        self.origin = time.time() if now is None else now
+        self.currentTick = 0
+        self.levels = [[[] for slot in xrange(1 << bits)] for bits in TimerWheel.LEVEL_BITS]
+        self.levelCounts = [0] * len(TimerWheel.LEVEL_BITS)
+        self.overflow = []
+
+        # Tick bit each level's slot index starts at
+        self.shifts = []
+        shift = 0
+        for bits in TimerWheel.LEVEL_BITS:
+            self.shifts.append(shift)
+            shift += bits
+        self.reach = 1 << shift
+
+    def __len__(self):
+        return sum(self.levelCounts) + len(self.overflow)
+
+    def tick_of(self, when):
+        return int(math.ceil((when - self.origin) / self.tick))
+
+    def time_of(self, tick):
+        return self.origin + tick * self.tick
+
+    def add(self, task):
+        task.dueTick = max(self.tick_of(task.due), self.currentTick + 1)
+        self._insert(task)
+
+    def _insert(self, task):
+        delta = task.dueTick - self.currentTick
+        for level, bits in enumerate(TimerWheel.LEVEL_BITS):
+            if delta < 1 << (self.shifts[level] + bits):
+                slot = (task.dueTick >> self.shifts[level]) & ((1 << bits) - 1)
+                self.levels[level][slot].append(task)
+                self.levelCounts[level] += 1
+                return
+        self.overflow.append(task)
+
+    def _cascade(self, level):
+        """Move the timers in a level's current slot down to the levels below"""
+        slot = (self.currentTick >> self.shifts[level]) & ((1 << TimerWheel.LEVEL_BITS[level]) - 1)
+        tasks = self.levels[level][slot]
+        if tasks:
+            self.levels[level][slot] = []
+            self.levelCounts[level] -= len(tasks)
+            for task in tasks:
+                self._insert(task)
+
+    def advance(self, now):
+        """Move the wheel up to a time
+
+        Returns:
+            Timers that came due, cancelled ones included.
+        """
+        target = self.tick_of(now)
+        if now < self.time_of(target):
+            target -= 1
+        due = []
+        while self.currentTick < target:
+            # Ticks below the lowest occupied level can't have anything due, so skip straight to
+            # where that level next cascades
+            lowest = 0
+            while lowest < len(self.levels) and not self.levelCounts[lowest]:
+                lowest += 1
+            if lowest:
+                span = 1 << self.shifts[lowest] if lowest < len(self.levels) else self.reach
+                boundary = (self.currentTick // span + 1) * span
+                if boundary > target or lowest == len(self.levels) and not self.overflow:
+                    self.currentTick = target
+                    break
+                self.currentTick = boundary - 1
+            self.currentTick += 1
+
+            if not self.currentTick & (self.reach - 1) and self.overflow:
+                waiting = self.overflow
+                self.overflow = []
+                for task in waiting:
+                    self._insert(task)
+
+            # Cascade from the top so timers fall all the way down to this tick's slot
+            level = 1
+            while level < len(self.levels) and not self.currentTick & ((1 << self.shifts[level]) - 1):
+                level += 1
+            for upper in xrange(level - 1, 0, -1):
+                self._cascade(upper)
+
+            slot = self.currentTick & ((1 << TimerWheel.LEVEL_BITS[0]) - 1)
+            if self.levels[0][slot]:
+                due.extend(self.levels[0][slot])
+                self.levelCounts[0] -= len(self.levels[0][slot])
+                self.levels[0][slot] = []
+        return due
+
+    def next_wakeup(self):
+        """Time the wheel next has to be advanced to, either for a timer or to cascade some down.
+        None if nothing is waiting"""
+        wakeup = None
+        for level, bits in enumerate(TimerWheel.LEVEL_BITS):
+            if not self.levelCounts[level]:
+                continue
+            shift = self.shifts[level]
+            slots = 1 << bits
+            current = self.currentTick >> shift
+            for offset in xrange(1, slots + 1):
+                if self.levels[level][(current + offset) & (slots - 1)]:
+                    tick = (current + offset) << shift
+                    if wakeup is None or tick < wakeup:
+                        wakeup = tick
+                    break
+        if self.overflow:
+            tick = (self.currentTick // self.reach + 1) * self.reach
+            if wakeup is None or tick < wakeup:
+                wakeup = tick
+        return None if wakeup is None else self.time_of(wakeup)
+
+
+class TimerThread(threading.Thread):
+    """Runs one-off and periodic jobs on a single thread.
+
+    The thread sleeps until the next timer is due instead of waking on a fixed period, and a
+    waker cuts the sleep short when another thread adds an earlier timer. Periodic jobs are
+    rescheduled from when they were due rather than when they ran, so their period doesn't drift.
+    A job that falls more than a period behind skips the runs it missed instead of bunching them up.
+    Each job keeps statistics on how late it runs.
+    """
+    def __init__(self, tick=TimerWheel.TICK):
+        threading.Thread.__init__(self)
+        self.name = "TimerThread"
+        self.daemon = True
+        self.exitFlag = 0
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        self.waker = Waker()
+        self.tasks = set()
+
+        # Job being run right now, so cancelling it can wait for the run to finish
+        self.running = None
+        self.finished = threading.Condition(self.lock)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Run a callback once after a number of seconds"""
+        return self.schedule(TimerTask(callback, args, time.time() + delay, None, kwargs.get("name")))
+
+    def call_every(self, interval, callback, *args, **kwargs):
+        """Run a callback every interval seconds, starting one interval from now"""
+        return self.schedule(TimerTask(callback, args, time.time() + interval, interval, kwargs.get("name")))
+
+    def schedule(self, task):
+        with self.lock:
+            wakeup = self.wheel.next_wakeup()
+            self.wheel.add(task)
+            self.tasks.add(task)
+        if threading.current_thread() is not self and (wakeup is None or task.due < wakeup):
+            self.waker.wake()
+        return task
+
+    def cancel(self, task):
+        """Stop a job. From another thread this waits out a run already under way, so whatever the
+        job uses can be torn down as soon as this returns"""
+        # Cancelled timers stay in the wheel until their slot comes round
+        with self.lock:
+            task.cancel()
+            self.tasks.discard(task)
+            while self.running is task and threading.current_thread() is not self:
+                self.finished.wait()
+
+    def stop(self):
+        self.exitFlag = 1
+        self.waker.wake()
+
+    def run(self):
+        while not self.exitFlag:
+            with self.lock:
+                wakeup = self.wheel.next_wakeup()
+            timeout = None if wakeup is None else max(wakeup - time.time(), 0)
+            if timeout is None or timeout > 0:
+                ready = select.select([self.waker.reader], [], [], timeout)[0]
+                if ready:
+                    self.waker.drain()
+            self.run_due()
+        self.waker.close()
+
+    def run_due(self):
+        now = time.time()
+        with self.lock:
+            due = self.wheel.advance(now)
+        for task in due:
+            with self.lock:
+                if task.cancelled:
+                    continue
+                self.running = task
+            task.lateness.add(max(now - task.due, 0.0) * 1000.0)
+            task.runs += 1
+            try:
+                task.callback(*task.args)
+            except Exception, e:
+                Log.error("Timer %s failed. %s" % (task.name, e))
+            with self.lock:
+                self.running = None
+                self.finished.notify_all()
+
+            if task.interval and not task.cancelled:
+                task.due += task.interval
+                if task.due <= now:
+                    missed = int((now - task.due) / task.interval) + 1
+                    task.skipped += missed
+                    task.due += missed * task.interval
+                with self.lock:
+                    self.wheel.add(task)
+            else:
+                with self.lock:
+                    self.tasks.discard(task)
+
+    def stats(self):
+        """Lateness in milliseconds, runs and skipped runs of every scheduled job, by name"""
+        with self.lock:
+            tasks = list(self.tasks)
+        return dict((task.name, task.stats()) for task in tasks)
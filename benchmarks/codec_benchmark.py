@@ -0,0 +1,81 @@
+#!python
+"""Compares the JSON and binary wire codecs on payloads shaped like real Showtime-Live traffic.
+
+Usage: python benchmarks/codec_benchmark.py [-n iterations]
+"""
+import os
+import random
+import sys
+import timeit
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live", "Midi_Remote_Scripts"))
+from ShowtimeBridge.MessageCodecs import JSONCodec, BinaryCodec
+
+
+def meter_frame(tracks=32):
+    levels = dict((str(i), "%.4f" % random.random()) for i in xrange(tracks))
+    return "O_song_meters", {"value": levels, "id": "song"}
+
+
+def param_update():
+    return "O_param_updated", {"value": random.random(), "id": "12d3p7"}
+
+
+def clip_position():
+    return "O_clip_playing_pos", {"value": "%.4f" % (random.random() * 16), "id": "4cs2cl0"}
+
+
+def clip_notes(notes=256):
+    return "O_clip_notes_updated", {
+        "value": [(random.randint(0, 127), i * 0.25, 0.25, random.randint(1, 127), False) for i in xrange(notes)],
+        "id": "4cs2cl0"}
+
+
+def song_layout(wrappers=2000):
+    layout = []
+    for i in xrange(wrappers):
+        layout.append({
+            "id": "%dd%dp%d" % (i / 100, (i / 10) % 10, i % 10),
+            "type": "LiveDeviceParameter",
+            "name": u"Parameter \u00e9 %d" % i,
+            "parent": "%dd%d" % (i / 100, (i / 10) % 10),
+            "index": i % 10,
+            "value": random.random(),
+            "min": 0.0,
+            "max": 1.0
+        })
+    return "O_song_layout", {"value": layout, "id": "song"}
+
+
+PAYLOADS = [
+    ("meter frame", meter_frame()),
+    ("param update", param_update()),
+    ("clip position", clip_position()),
+    ("clip notes", clip_notes()),
+    ("song layout", song_layout())
+]
+
+CODECS = [JSONCodec, BinaryCodec]
+
+
+def run(iterations):
+    print("%-14s %-9s %10s %14s %14s" % ("payload", "codec", "bytes", "encode (us)", "decode (us)"))
+    for name, (subject, msg) in PAYLOADS:
+        # Big payloads are slow enough that fewer runs still give a stable figure
+        runs = max(1, iterations / 100) if name in ("song layout", "clip notes") else iterations
+        for codec in CODECS:
+            data = codec.encode(subject, msg)
+            encodetime = timeit.timeit(lambda: codec.encode(subject, msg), number=runs)
+            decodetime = timeit.timeit(lambda: codec.decode(data), number=runs)
+            print("%-14s %-9s %10d %14.2f %14.2f" % (
+                name, codec.NAME, len(data), encodetime / runs * 1e6, decodetime / runs * 1e6))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--iterations", action="store", dest="iterations", type="int", default=10000,
+                      help="Number of encode/decode runs for small payloads.")
+    (options, args) = parser.parse_args()
+    random.seed(0)
+    run(options.iterations)
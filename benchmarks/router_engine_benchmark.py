@@ -0,0 +1,189 @@
+#!python
+"""Compares the threaded LiveRouter with the single threaded AsyncRouter.
+
+Each engine runs in a child process with a number of connected clients. The child reports its
+own context switches for an idle period, where only heartbeats are flowing, and for a load
+period where clients ping their session endpoints as fast as the router answers. Round trip
+times of those pings show how quickly each engine gets to a ready socket.
+
+Needs the Showtime package, like the server itself.
+
+Usage: python benchmarks/router_engine_benchmark.py [-c clients] [-s idleseconds] [-n pings]
+"""
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+from optparse import OptionParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, "Showtime_Live", "Midi_Remote_Scripts"))
+from ShowtimeBridge.Logger import Log
+from ShowtimeBridge.Metrics import Histogram
+from ShowtimeBridge.NetworkEndpoint import NetworkEndpoint, NetworkPrefixes, SimpleMessage
+from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+from ShowtimeBridge.UDPEndpoint import UDPEndpoint
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENGINES = ["threaded", "eventloop"]
+UDP_PORT = 16101
+TCP_PORT = 16103
+
+
+# Child process
+# -------------
+def usage():
+    """Context switches and CPU seconds used by this process so far"""
+    if not resource:
+        return 0, 0, 0.0
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    return ru.ru_nvcsw, ru.ru_nivcsw, ru.ru_utime + ru.ru_stime
+
+
+def run_child(engine, stageaddress):
+    from Showtime_Live.LiveRouter import LiveRouter
+    from Showtime_Live.AsyncRouter import AsyncRouter
+
+    cls = AsyncRouter if engine == "eventloop" else LiveRouter
+    # Clients only answer heartbeats while they're pinging, so don't let the idle period time them out
+    LiveRouter.SESSION_TIMEOUT = sys.maxint
+    router = cls(stageaddress, UDP_PORT, TCP_PORT, False, False)
+    Log.set_log_network(False)
+    router.start()
+    print("ready")
+    sys.stdout.flush()
+
+    # The parent marks the start and end of each period
+    for line in iter(sys.stdin.readline, ""):
+        if line.strip() == "mark":
+            print("usage %d %d %f %d" % (usage() + (threading.active_count(),)))
+            sys.stdout.flush()
+        else:
+            break
+    router.stop()
+    router.close()
+
+
+# Parent process
+# --------------
+def connect(address):
+    sock = socket.create_connection(address)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    return sock
+
+
+class PingEndpoint(UDPEndpoint):
+    """UDPEndpoint that counts the heartbeat echoes it receives"""
+    def __init__(self):
+        self.echoes = 0
+        UDPEndpoint.__init__(self, 0, -1, True, None, False)
+
+    def event(self, event):
+        if event.subject == NetworkPrefixes.HEARTBEAT_ECHO:
+            self.echoes += 1
+        UDPEndpoint.event(self, event)
+
+
+class Client:
+    """Connects to the router like a bridge and pings its session's datagram endpoint"""
+    def __init__(self, index):
+        self.tcp = TCPEndpoint(-1, -1, True, False, connect(("127.0.0.1", TCP_PORT)))
+        self.udp = PingEndpoint()
+
+        self.tcp.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+        self.tcp.send_handshake({"udpport": self.udp.socket.getsockname()[1], "name": "bench%d" % index})
+        self.tcp.flush_mailbox()
+        while self.tcp.connectionStatus != NetworkEndpoint.HANDSHAKE_COMPLETE:
+            self.tcp.recv_msg()
+        self.udp.remoteAddr = ("127.0.0.1", self.tcp.peerHandshake["udpport"])
+
+    def ping(self):
+        """Round trip time in milliseconds of a heartbeat answered by the router"""
+        start = NetworkEndpoint.precise_milli_time()
+        expected = self.udp.echoes + 1
+        self.udp.send_msg(SimpleMessage(NetworkPrefixes.HEARTBEAT, {"id": None, "sent": start}), True)
+        while self.udp.echoes < expected:
+            self.udp.recv_msg()
+        return NetworkEndpoint.precise_milli_time() - start
+
+    def close(self):
+        self.tcp.close()
+        self.udp.close()
+
+
+def mark(child):
+    child.stdin.write("mark\n")
+    child.stdin.flush()
+    # Skip anything the router logged in the meantime
+    line = child.stdout.readline()
+    while not line.startswith("usage "):
+        line = child.stdout.readline()
+    voluntary, involuntary, cpu, threads = line.split()[1:]
+    return int(voluntary) + int(involuntary), float(cpu), int(threads)
+
+
+def run_engine(engine, clients, idleseconds, pings, stageaddress):
+    command = [sys.executable, os.path.abspath(__file__), "--child", engine]
+    if stageaddress:
+        command += ["--stage", stageaddress]
+    child = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    line = child.stdout.readline()
+    while line.strip() != "ready":
+        if not line:
+            raise RuntimeError("The %s router didn't start" % engine)
+        line = child.stdout.readline()
+
+    connected = [Client(i) for i in xrange(clients)]
+    switches0, cpu0, threads = mark(child)
+    threading.Event().wait(idleseconds)
+    switches1, cpu1, threads = mark(child)
+
+    rtt = Histogram()
+    for i in xrange(pings):
+        rtt.add(random.choice(connected).ping())
+    switches2, cpu2, threads = mark(child)
+
+    child.stdin.write("quit\n")
+    child.stdin.flush()
+    child.wait()
+    for client in connected:
+        client.close()
+
+    print("%-10s %8d %14.1f %10.2f %14.2f %10.4f %10.4f %10.4f" % (
+        engine, threads, (switches1 - switches0) / idleseconds, (cpu1 - cpu0) / idleseconds * 100.0,
+        float(switches2 - switches1) / max(pings, 1), rtt.percentile(50), rtt.percentile(99), rtt.maximum))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-c", "--clients", action="store", dest="clients", type="int", default=4,
+                      help="Number of connected clients.")
+    parser.add_option("-s", "--idle", action="store", dest="idle", type="float", default=5.0,
+                      help="Seconds to measure the idle engine for.")
+    parser.add_option("-n", "--pings", action="store", dest="pings", type="int", default=5000,
+                      help="Number of pings sent through the engine.")
+    parser.add_option("--stage", action="store", dest="stageaddress", type="string", default=None,
+                      help="Address of a running Showtime stage. An internal stage is created if not given.")
+    parser.add_option("--child", action="store", dest="child", type="choice", choices=ENGINES, default=None,
+                      help=None)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        run_child(options.child, options.stageaddress)
+        sys.exit(0)
+
+    if not resource:
+        print("Context switch counts aren't available on this platform")
+    random.seed(0)
+    Log.set_log_network(False)
+    print("%-10s %8s %14s %10s %14s %10s %10s %10s" % (
+        "engine", "threads", "idle csw/sec", "idle cpu%", "csw per ping", "rtt p50", "rtt p99", "rtt max"))
+    for engine in ENGINES:
+        run_engine(engine, options.clients, options.idle, options.pings, options.stageaddress)
@@ -0,0 +1,154 @@
+#!python
+"""Compares the loopback TCP/UDP transports with their Unix socket counterparts.
+
+Each transport is measured for round trip latency, with one message in flight at a time, and
+for throughput, with a receiving thread draining a stream of messages sent in tick sized batches.
+
+Usage: python benchmarks/transport_benchmark.py [-n messages] [-b batch]
+"""
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live", "Midi_Remote_Scripts"))
+from ShowtimeBridge.Logger import Log
+from ShowtimeBridge.Metrics import Histogram
+from ShowtimeBridge.NetworkEndpoint import NetworkEndpoint, SimpleMessage
+from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+from ShowtimeBridge.UDPEndpoint import UDPEndpoint
+from ShowtimeBridge.UnixEndpoint import UnixSockets, UnixStreamEndpoint, UnixDatagramEndpoint
+
+
+def param_update():
+    return SimpleMessage(0, {"value": random.random(), "id": "12d3p7"})
+
+
+def tcp_pair():
+    listener = TCPEndpoint(0, -1, True, True)
+    client = socket.create_connection(("127.0.0.1", listener.socket.getsockname()[1]))
+    server, address = listener.socket.accept()
+    listener.close()
+    return TCPEndpoint(-1, -1, True, False, client), TCPEndpoint(-1, -1, True, False, server)
+
+
+def unix_stream_pair():
+    path = UnixSockets.path("benchmark-%d" % os.getpid())
+    listener = UnixStreamEndpoint(path, True, True)
+    client = UnixStreamEndpoint(path, True, False)
+    client.connect()
+    server, address = listener.socket.accept()
+    listener.close()
+    return client, UnixStreamEndpoint(path, True, False, server)
+
+
+def udp_pair():
+    sender = UDPEndpoint(0, -1, True, None, False)
+    receiver = UDPEndpoint(0, -1, True, None, False)
+    sender.remoteAddr = ("127.0.0.1", receiver.socket.getsockname()[1])
+    receiver.remoteAddr = ("127.0.0.1", sender.socket.getsockname()[1])
+    return sender, receiver
+
+
+def unix_datagram_pair():
+    senderpath = UnixSockets.path("benchmark-%d-a" % os.getpid())
+    receiverpath = UnixSockets.path("benchmark-%d-b" % os.getpid())
+    return UnixDatagramEndpoint(senderpath, receiverpath, True, None, False), \
+        UnixDatagramEndpoint(receiverpath, senderpath, True, None, False)
+
+
+class Counter:
+    """Event callback that counts the messages an endpoint receives"""
+    def __init__(self, endpoint, echo=False):
+        self.count = 0
+        self.endpoint = endpoint
+        self.echo = echo
+        endpoint.add_event_callback(self)
+
+    def __call__(self, event):
+        self.count += 1
+        if self.echo:
+            self.endpoint.send_msg(event, True)
+
+    def wait_for(self, count):
+        """Read until the given number of messages has arrived. Returns False on a timeout"""
+        while self.count < count:
+            try:
+                self.endpoint.recv_msg()
+            except socket.timeout:
+                return False
+        return True
+
+
+def latency(pair, messages):
+    """Round trip times in milliseconds of messages echoed straight back by the peer"""
+    sender, receiver = pair
+    replies = Counter(sender)
+    echoes = Counter(receiver, True)
+    histogram = Histogram()
+    for i in xrange(messages):
+        start = NetworkEndpoint.precise_milli_time()
+        sender.send_msg(param_update(), True)
+        if not echoes.wait_for(i + 1) or not replies.wait_for(i + 1):
+            break
+        histogram.add(NetworkEndpoint.precise_milli_time() - start)
+    return histogram
+
+
+def throughput(pair, messages, batch, datagrams):
+    """Messages per second sent in batches the way a tick flushes them. Datagram transports can
+    drop messages, so the number that arrived is returned as well"""
+    sender, receiver = pair
+    received = Counter(receiver)
+    receiver.socket.settimeout(1)
+    reader = threading.Thread(target=received.wait_for, args=(messages,))
+    reader.start()
+
+    start = time.time()
+    for i in xrange(0, messages, batch):
+        for j in xrange(min(batch, messages - i)):
+            msg = param_update()
+            if datagrams:
+                sender.queue_msg(msg)
+            else:
+                sender.writer.append_message(msg, sender)
+        sender.flush_mailbox()
+    reader.join()
+    elapsed = time.time() - start
+    return received.count / elapsed, received.count
+
+
+def run(messages, batch):
+    transports = [("tcp", tcp_pair, False), ("udp", udp_pair, True)]
+    if UnixSockets.SUPPORTED:
+        transports += [("unix stream", unix_stream_pair, False), ("unix datagram", unix_datagram_pair, True)]
+    else:
+        print("Unix sockets aren't available on this platform")
+
+    print("%-14s %10s %10s %10s %14s %10s" % ("transport", "rtt p50", "rtt p99", "rtt max", "msgs/sec", "received"))
+    for name, pair, datagrams in transports:
+        endpoints = pair()
+        rtt = latency(endpoints, min(messages, 10000))
+        for endpoint in endpoints:
+            endpoint.close()
+        endpoints = pair()
+        rate, received = throughput(endpoints, messages, batch, datagrams)
+        for endpoint in endpoints:
+            endpoint.close()
+        print("%-14s %10.4f %10.4f %10.4f %14.0f %10d" % (
+            name, rtt.percentile(50), rtt.percentile(99), rtt.maximum, rate, received))
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-n", "--messages", action="store", dest="messages", type="int", default=100000,
+                      help="Number of messages to send through each transport.")
+    parser.add_option("-b", "--batch", action="store", dest="batch", type="int", default=64,
+                      help="Messages sent per flush, like the messages queued during one tick.")
+    (options, args) = parser.parse_args()
+    random.seed(0)
+    Log.set_log_network(False)
+    run(options.messages, options.batch)
@@ -0,0 +1,114 @@
+import collections
+import os
+import select
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from Showtime_Live.EventSelector import Waker
+
+
+class WakerTest(unittest.TestCase):
+    def setUp(self):
+        self.waker = Waker()
+
+    def tearDown(self):
+        self.waker.close()
+
+    def readable(self, timeout=0):
+        return bool(select.select([self.waker.reader], [], [], timeout)[0])
+
+    def test_wake_makes_reader_readable_until_drained(self):
+        self.assertFalse(self.readable())
+        self.waker.wake()
+        self.waker.wake()
+        self.assertTrue(self.readable())
+        self.waker.drain()
+        self.assertFalse(self.readable())
+        self.waker.wake()
+        self.assertTrue(self.readable())
+
+    def test_wake_during_drain_is_kept(self):
+        # Another thread wakes us while drain is reading the pipe. Its wakeup must still be
+        # readable once both are done
+        waker = self.waker
+        reader = waker.reader
+        woken = threading.Event()
+
+        class InterruptedReader:
+            def __init__(self):
+                self.interrupted = False
+
+            def recv(self, size):
+                if not self.interrupted:
+                    self.interrupted = True
+                    waking = threading.Thread(target=lambda: (waker.wake(), woken.set()))
+                    waking.start()
+                    # Give the wakeup a chance to land before the read, unless drain holds it off
+                    woken.wait(0.2)
+                return reader.recv(size)
+
+        waker.wake()
+        waker.reader = InterruptedReader()
+        try:
+            waker.drain()
+        finally:
+            waker.reader = reader
+        self.assertTrue(woken.wait(1.0))
+        self.assertTrue(self.readable())
+
+    def test_wakeups_survive_concurrent_drains(self):
+        # Producers queue work and wake a consumer that drains and handles it, like the router
+        # loop. A wakeup lost to a drain would leave work stranded until the select timed out
+        items = collections.deque()
+        handled = []
+        stop = threading.Event()
+
+        def consume():
+            while not stop.is_set():
+                if self.readable(1.0):
+                    self.waker.drain()
+                    while items:
+                        handled.append(items.popleft())
+
+        def produce(count):
+            for i in xrange(count):
+                items.append(i)
+                self.waker.wake()
+
+        # Switch threads as often as possible so wakeups land in the middle of drains
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        producers = [threading.Thread(target=produce, args=(5000,)) for i in xrange(4)]
+        try:
+            for producer in producers:
+                producer.start()
+            for producer in producers:
+                producer.join()
+            sys.setcheckinterval(interval)
+
+            # Every wakeup from here on has to get through straight away
+            deadline = time.time() + 0.5
+            while len(handled) < 20000 and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertEqual(len(handled), 20000)
+            for i in xrange(50):
+                items.append(i)
+                self.waker.wake()
+                deadline = time.time() + 0.5
+                while len(handled) < 20001 + i and time.time() < deadline:
+                    time.sleep(0.001)
+                self.assertEqual(len(handled), 20001 + i)
+        finally:
+            sys.setcheckinterval(interval)
+            stop.set()
+            self.waker.wake()
+            consumer.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
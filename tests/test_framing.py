@@ -0,0 +1,188 @@
+import errno
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.Framing import FrameReader, FrameWriter, DatagramPacker
+from ShowtimeBridge.Compression import Compression, Compressor, Decompressor
+
+
+def framed(payload):
+    return FrameReader.HEADER.pack(len(payload)) + payload
+
+
+class ChokedSocket:
+    """Stream socket that accepts a few bytes per send before it would block"""
+    def __init__(self, accepts):
+        self.accepts = list(accepts)
+        self.received = ""
+
+    def send(self, data):
+        if not self.accepts:
+            raise socket.error(errno.EAGAIN, "Resource temporarily unavailable")
+        count = min(self.accepts.pop(0), len(data))
+        self.received += data[:count].tobytes()
+        return count
+
+
+class FrameReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_reads_every_complete_frame_at_once(self):
+        reader = FrameReader()
+        self.sender.sendall("".join(framed(payload) for payload in ("one", "two", "three")))
+        reader.read_stream(self.receiver)
+        self.assertEqual(list(reader.frames()), ["one", "two", "three"])
+        self.assertEqual(reader.pending(), 0)
+
+    def test_keeps_unfinished_frame_until_the_rest_arrives(self):
+        reader = FrameReader()
+        frame = framed("split payload")
+        self.sender.sendall(frame[:6])
+        reader.read_stream(self.receiver)
+        self.assertEqual(list(reader.frames()), [])
+        self.assertEqual(reader.pending(), 6)
+        self.sender.sendall(frame[6:])
+        reader.read_stream(self.receiver)
+        self.assertEqual(list(reader.frames()), ["split payload"])
+
+    def test_grows_buffer_for_frames_bigger_than_it(self):
+        reader = FrameReader(16)
+        payload = "x" * 1000
+        self.sender.sendall(framed(payload))
+        while not reader.pending() or reader.pending() < len(payload) + FrameReader.HEADER_SIZE:
+            reader.read_stream(self.receiver)
+        self.assertEqual(list(reader.frames()), [payload])
+        self.assertTrue(len(reader.buffer) >= len(payload) + FrameReader.HEADER_SIZE)
+
+    def test_rejects_frames_over_the_size_limit(self):
+        reader = FrameReader()
+        self.sender.sendall(FrameReader.HEADER.pack(FrameReader.MAX_FRAME_SIZE))
+        reader.read_stream(self.receiver)
+        self.assertRaises(RuntimeError, reader.read_stream, self.receiver)
+
+    def test_broken_connection_raises(self):
+        reader = FrameReader()
+        self.sender.close()
+        self.assertRaises(RuntimeError, reader.read_stream, self.receiver)
+
+
+class FrameWriterTest(unittest.TestCase):
+    def test_flush_coalesces_frames(self):
+        writer = FrameWriter()
+        writer.append("one")
+        writer.append("two")
+        sock = ChokedSocket([1024])
+        self.assertTrue(writer.flush(sock))
+        self.assertEqual(sock.received, FrameWriter.frame("one") + FrameWriter.frame("two"))
+        self.assertEqual(writer.pending(), 0)
+
+    def test_keeps_what_a_blocked_socket_did_not_take(self):
+        writer = FrameWriter()
+        writer.append("first")
+        sock = ChokedSocket([3])
+        self.assertFalse(writer.flush(sock))
+        self.assertEqual(writer.pending(), len(FrameWriter.frame("first")) - 3)
+
+        # Frames queued while blocked go out after the unsent remainder
+        writer.append("second")
+        sock.accepts = [1024]
+        self.assertTrue(writer.flush(sock))
+        self.assertEqual(sock.received, FrameWriter.frame("first") + FrameWriter.frame("second"))
+        self.assertEqual(writer.pending(), 0)
+
+
+@unittest.skipUnless(Compression.supported(), "zlib isn't available")
+class CompressedFrameTest(unittest.TestCase):
+    LAYOUT = "".join('{"id": "track%d", "name": "Audio %d", "color": 16725558}' % (i, i) for i in xrange(40))
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_large_frames_round_trip_compressed(self):
+        writer = FrameWriter()
+        writer.compressor = Compressor(threshold=64)
+        sock = ChokedSocket([1 << 20])
+        for payload in ("small", self.LAYOUT, self.LAYOUT):
+            writer.append(payload)
+        writer.flush(sock)
+
+        # Only the large frames carry the flag, and later ones reuse the stream's dictionary
+        headers = []
+        offset = 0
+        while offset < len(sock.received):
+            header = FrameReader.HEADER.unpack_from(sock.received, offset)[0]
+            headers.append(header)
+            offset += FrameReader.HEADER_SIZE + (header & ~FrameReader.FLAG_COMPRESSED)
+        self.assertEqual([bool(header & FrameReader.FLAG_COMPRESSED) for header in headers], [False, True, True])
+        self.assertTrue(headers[2] & ~FrameReader.FLAG_COMPRESSED < headers[1] & ~FrameReader.FLAG_COMPRESSED)
+
+        reader = FrameReader()
+        reader.decompressor = Decompressor()
+        self.sender.sendall(sock.received)
+        reader.read_stream(self.receiver)
+        self.assertEqual(list(reader.frames()), ["small", self.LAYOUT, self.LAYOUT])
+        self.assertEqual(reader.decompressor.stats["frames"], 2)
+        self.assertTrue(writer.compressor.ratio() < 0.5)
+
+    def test_compressed_frame_without_negotiation_raises(self):
+        payload = Compressor().compress(self.LAYOUT)
+        self.sender.sendall(FrameReader.HEADER.pack(len(payload) | FrameReader.FLAG_COMPRESSED) + payload)
+        reader = FrameReader()
+        reader.read_stream(self.receiver)
+        self.assertRaises(RuntimeError, list, reader.frames())
+
+    def test_negotiation(self):
+        self.assertEqual(Compression.negotiate(["lz4", Compression.ZLIB]), Compression.ZLIB)
+        self.assertEqual(Compression.negotiate(["lz4"]), None)
+        self.assertEqual(Compression.negotiate(None), None)
+
+
+class DatagramPackerTest(unittest.TestCase):
+    def test_packs_frames_up_to_the_size_cap(self):
+        packer = DatagramPacker(20)
+        frames = [FrameWriter.frame("a" * 6) for i in xrange(5)]
+        for frame in frames:
+            packer.append_frame(frame)
+        datagrams = packer.pack()
+        self.assertEqual(datagrams, ["".join(frames[0:2]), "".join(frames[2:4]), frames[4]])
+        self.assertEqual(packer.pending(), 0)
+
+    def test_oversized_frame_goes_alone(self):
+        packer = DatagramPacker(20)
+        small = FrameWriter.frame("a")
+        big = FrameWriter.frame("b" * 40)
+        for frame in (small, big, small):
+            packer.append_frame(frame)
+        self.assertEqual(packer.pack(), [small, big, small])
+
+    def test_reader_splits_packed_datagram(self):
+        sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            packer = DatagramPacker()
+            for payload in ("one", "two", "three"):
+                packer.append_frame(FrameWriter.frame(payload))
+            for datagram in packer.pack():
+                sender.send(datagram)
+            reader = FrameReader()
+            reader.read_datagram(receiver)
+            self.assertEqual(list(reader.frames()), ["one", "two", "three"])
+        finally:
+            sender.close()
+            receiver.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.LayoutJournal import LayoutJournal
+
+
+class LayoutJournalTest(unittest.TestCase):
+    def test_record_numbers_diffs(self):
+        journal = LayoutJournal()
+        self.assertEqual(journal.record(["a"]), 1)
+        self.assertEqual(journal.record(["b"]), 2)
+        self.assertEqual(journal.stats(), {"version": 2, "entries": 2, "oldest": 1})
+
+    def test_since_returns_later_diffs_and_forgets_applied_ones(self):
+        journal = LayoutJournal()
+        for diff in ("a", "b", "c"):
+            journal.record([diff])
+        self.assertEqual(journal.since(1), [(2, ["b"]), (3, ["c"])])
+        self.assertEqual(journal.stats()["oldest"], 2)
+        self.assertEqual(journal.since(3), [])
+        self.assertEqual(journal.stats()["entries"], 0)
+
+    def test_since_a_version_the_journal_no_longer_reaches(self):
+        journal = LayoutJournal(capacity=2)
+        for diff in ("a", "b", "c"):
+            journal.record([diff])
+        self.assertEqual(journal.since(0), None)
+        self.assertEqual(journal.since(1), [(2, ["b"]), (3, ["c"])])
+
+    def test_since_a_version_from_the_future(self):
+        # A server that remembers more than we sent is talking about an older journal
+        journal = LayoutJournal()
+        journal.record(["a"])
+        self.assertEqual(journal.since(5), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.LiveNetworkEndpoint import LiveNetworkEndpoint
+from ShowtimeBridge.NetworkEndpoint import SimpleMessage
+from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+from ShowtimeBridge.Framing import FrameWriter
+
+
+def spin(seconds):
+    started = time.time()
+    while time.time() - started < seconds:
+        pass
+
+
+class SlowEndpoint:
+    """Readable endpoint that takes a while to read"""
+    def __init__(self, sock, seconds):
+        self.socket = sock
+        self.seconds = seconds
+
+    def recv_msg(self):
+        self.socket.recv(4096)
+        spin(self.seconds)
+
+
+class PollTest(unittest.TestCase):
+    def setUp(self):
+        self.endpoint = LiveNetworkEndpoint()
+        self.handled = []
+        self.endpoint.add_incoming_action("work", self.work)
+        self.subject = self.endpoint.method_id("work")
+        self.pairs = []
+
+    def tearDown(self):
+        self.endpoint.close()
+        for sock in self.pairs:
+            sock.close()
+
+    def work(self, args):
+        self.handled.append(args["n"])
+        spin(args.get("seconds", 0))
+
+    def queue(self, count, seconds=0):
+        for i in xrange(count):
+            self.endpoint.event_received(SimpleMessage(self.subject, {"n": len(self.handled) + i, "seconds": seconds}))
+
+    def socketpair(self):
+        pair = socket.socketpair()
+        self.pairs.extend(pair)
+        return pair
+
+    def test_budget_carries_messages_over_in_order(self):
+        self.endpoint.pollBudget = 5000
+        self.queue(20, 0.001)
+        self.endpoint.poll()
+        self.assertTrue(1 <= len(self.handled) < 20)
+        self.assertEqual(len(self.endpoint.incomingEvents), 20 - len(self.handled))
+
+        while self.endpoint.incomingEvents:
+            self.endpoint.poll()
+        self.assertEqual(self.handled, range(20))
+        stats = self.endpoint.poll_stats()
+        self.assertEqual(stats["messages"], 20)
+        self.assertTrue(stats["overBudget"] >= 1)
+        self.assertEqual(stats["carriedOver"], 0)
+
+    def test_tiny_budget_still_makes_progress(self):
+        self.endpoint.pollBudget = 0
+        self.queue(3)
+        for i in xrange(3):
+            self.endpoint.poll()
+            self.assertEqual(len(self.handled), i + 1)
+
+    def test_reading_counts_against_the_budget(self):
+        reader, writer = self.socketpair()
+        self.endpoint.inputSockets[reader] = SlowEndpoint(reader, 0.005)
+        writer.send("x")
+        self.endpoint.pollBudget = 2000
+        self.endpoint.poll()
+        stats = self.endpoint.poll_stats()
+        self.assertTrue(stats["tickMicros"]["max"] >= 5000)
+        self.assertEqual(stats["overBudget"], 1)
+
+    def test_full_carry_over_leaves_the_stream_unread(self):
+        reader, writer = self.socketpair()
+        stream = TCPEndpoint(-1, -1, False, False, reader)
+        stream.add_event_callback(self.endpoint.event_received)
+        self.endpoint.inputSockets[reader] = stream
+        self.endpoint.pollBudget = 0
+        self.queue(LiveNetworkEndpoint.MAX_CARRY_OVER + 1)
+        writer.sendall(FrameWriter.frame(stream.encode(SimpleMessage(self.subject, {"n": "streamed"}))))
+
+        # The backlog shrinks by one a poll without anything coming off the stream
+        self.endpoint.poll()
+        self.assertEqual(stream.reader.pending(), 0)
+        self.assertEqual(len(self.endpoint.incomingEvents), LiveNetworkEndpoint.MAX_CARRY_OVER)
+        self.endpoint.poll()
+        self.assertEqual(len(self.endpoint.incomingEvents), LiveNetworkEndpoint.MAX_CARRY_OVER - 1)
+        self.assertTrue(self.endpoint.poll_stats()["streamPaused"] >= 2)
+
+        # Once there's room again the stream is read, behind the messages already waiting
+        self.endpoint.poll()
+        self.assertEqual(len(self.endpoint.incomingEvents), LiveNetworkEndpoint.MAX_CARRY_OVER - 1)
+        self.assertEqual(self.endpoint.incomingEvents[-1].msg["n"], "streamed")
+
+    def test_full_carry_over_drops_datagrams(self):
+        self.queue(LiveNetworkEndpoint.MAX_CARRY_OVER)
+        self.endpoint.datagram_received(SimpleMessage(self.subject, {"n": "dropped"}))
+        self.assertEqual(len(self.endpoint.incomingEvents), LiveNetworkEndpoint.MAX_CARRY_OVER)
+        self.assertEqual(self.endpoint.poll_stats()["droppedDatagrams"], 1)
+
+
+class ManifestHashTest(unittest.TestCase):
+    METHODS = [("track_meter", "read", {"id": None}), ("fire_clip", "write", {"id": None, "launch": None})]
+
+    def test_order_of_the_table_does_not_matter(self):
+        self.assertEqual(LiveNetworkEndpoint.manifest_hash(self.METHODS),
+                         LiveNetworkEndpoint.manifest_hash(list(reversed(self.METHODS))))
+
+    def test_argument_values_do_not_matter(self):
+        methods = [("track_meter", "read", {"id": "t1"}), ("fire_clip", "write", {"id": 3, "launch": True})]
+        self.assertEqual(LiveNetworkEndpoint.manifest_hash(self.METHODS), LiveNetworkEndpoint.manifest_hash(methods))
+
+    def test_names_access_and_argument_names_change_the_hash(self):
+        original = LiveNetworkEndpoint.manifest_hash(self.METHODS)
+        for changed in ([("track_meters", "read", {"id": None})] + self.METHODS[1:],
+                        [("track_meter", "write", {"id": None})] + self.METHODS[1:],
+                        [("track_meter", "read", {"trackid": None})] + self.METHODS[1:],
+                        [("track_meter", "read", None)] + self.METHODS[1:],
+                        self.METHODS[:1]):
+            self.assertNotEqual(LiveNetworkEndpoint.manifest_hash(changed), original)
+
+
+if __name__ == "__main__":
+    unittest.main()
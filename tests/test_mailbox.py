@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.Mailbox import Mailbox, MessageClasses, MessagePriorities
+
+
+def classify(msg):
+    return msg[0]
+
+
+def prioritise(msg, messageclass):
+    return MessagePriorities.DEFAULTS[messageclass]
+
+
+def coalesce(msgs):
+    return (MessageClasses.LAYOUT_DIFF, sum((msg[1] for msg in msgs), []))
+
+
+class MailboxTest(unittest.TestCase):
+    def drain(self, mailbox):
+        msgs = []
+        while not mailbox.empty():
+            msgs.append(mailbox.pop()[1])
+        return msgs
+
+    def test_pops_by_priority_then_queue_order(self):
+        mailbox = Mailbox(classify, prioritise)
+        layout = (MessageClasses.LAYOUT, 1)
+        telemetry = (MessageClasses.TELEMETRY, 2)
+        response = (MessageClasses.RESPONSE, 3)
+        control = (MessageClasses.CONTROL, 4)
+        for msg in (layout, telemetry, response, control):
+            mailbox.put(0, msg)
+        self.assertEqual(len(mailbox), 4)
+        self.assertEqual(self.drain(mailbox), [control, telemetry, response, layout])
+        self.assertEqual(mailbox.pop(), None)
+
+    def test_measures_queue_latency(self):
+        mailbox = Mailbox(classify, prioritise)
+        mailbox.put(1.0, (MessageClasses.CONTROL, 1))
+        self.assertEqual(mailbox.pop(1.5), (1.0, (MessageClasses.CONTROL, 1)))
+        self.assertEqual(mailbox.stats()["latency"]["control"]["count"], 1)
+
+    def test_full_mailbox_keeps_control_messages(self):
+        mailbox = Mailbox(classify, prioritise, capacity=1)
+        self.assertTrue(mailbox.put(0, (MessageClasses.CONTROL, 1)))
+        self.assertTrue(mailbox.put(0, (MessageClasses.REGISTRATION, 2)))
+        self.assertEqual(len(mailbox), 2)
+        self.assertEqual(mailbox.stats()["highWaterMark"], 2)
+
+    def test_full_mailbox_drops_newest_response(self):
+        mailbox = Mailbox(classify, prioritise, capacity=1)
+        mailbox.put(0, (MessageClasses.RESPONSE, 1))
+        self.assertFalse(mailbox.put(1, (MessageClasses.RESPONSE, 2)))
+        self.assertEqual(self.drain(mailbox), [(MessageClasses.RESPONSE, 1)])
+        self.assertEqual(mailbox.stats()["dropped"][MessageClasses.RESPONSE], 1)
+
+    def test_full_mailbox_replaces_oldest_telemetry(self):
+        mailbox = Mailbox(classify, prioritise, capacity=2)
+        mailbox.put(0, (MessageClasses.TELEMETRY, 1))
+        mailbox.put(1, (MessageClasses.TELEMETRY, 2))
+        self.assertTrue(mailbox.put(2, (MessageClasses.TELEMETRY, 3)))
+        self.assertEqual(self.drain(mailbox), [(MessageClasses.TELEMETRY, 2), (MessageClasses.TELEMETRY, 3)])
+        self.assertEqual(mailbox.stats()["dropped"][MessageClasses.TELEMETRY], 1)
+
+    def test_full_mailbox_without_old_telemetry_drops_new(self):
+        mailbox = Mailbox(classify, prioritise, capacity=1)
+        mailbox.put(0, (MessageClasses.RESPONSE, 1))
+        self.assertFalse(mailbox.put(1, (MessageClasses.TELEMETRY, 2)))
+        self.assertEqual(len(mailbox), 1)
+
+    def test_full_mailbox_coalesces_layout_diffs(self):
+        mailbox = Mailbox(classify, prioritise, coalesce, capacity=2)
+        mailbox.put(0, (MessageClasses.LAYOUT_DIFF, ["a"]))
+        mailbox.put(1, (MessageClasses.CONTROL, None))
+        mailbox.put(2, (MessageClasses.LAYOUT_DIFF, ["b"]))
+        mailbox.put(3, (MessageClasses.LAYOUT_DIFF, ["c"]))
+        self.assertEqual(len(mailbox), 2)
+
+        # The merged diff keeps the queue time of its oldest part
+        self.assertEqual(mailbox.pop(), (1, (MessageClasses.CONTROL, None)))
+        self.assertEqual(mailbox.pop(), (0, (MessageClasses.LAYOUT_DIFF, ["a", "b", "c"])))
+        self.assertEqual(mailbox.stats()["coalesced"][MessageClasses.LAYOUT_DIFF], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.MessageCodecs import BinaryCodec, CodecError, Codecs, JSONCodec
+from ShowtimeBridge.NetworkEndpoint import NetworkEndpoint, SimpleMessage
+from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+from ShowtimeBridge.UnixEndpoint import UnixSockets, UnixStreamEndpoint
+
+MESSAGE = {"value": [1, -2, 3.5, None, True, False, "raw", u"caf\u00e9"], "id": "12d3p7", "nested": {"depth": [[]]}}
+
+
+def tcp_pair():
+    listener = TCPEndpoint(0, -1, True, True)
+    client = socket.create_connection(("127.0.0.1", listener.socket.getsockname()[1]))
+    server, address = listener.socket.accept()
+    listener.close()
+    return TCPEndpoint(-1, -1, True, False, client), TCPEndpoint(-1, -1, True, False, server)
+
+
+def unix_stream_pair():
+    path = UnixSockets.path("test-codecs-%d" % os.getpid())
+    listener = UnixStreamEndpoint(path, True, True)
+    client = UnixStreamEndpoint(path, True, False)
+    client.connect()
+    server, address = listener.socket.accept()
+    listener.close()
+    # The router wraps accepted Unix connections in a plain TCPEndpoint
+    return client, TCPEndpoint(-1, -1, True, False, server)
+
+
+class Received:
+    """Event callback that keeps every message an endpoint receives"""
+    def __init__(self, endpoint):
+        self.events = []
+        endpoint.add_event_callback(self)
+
+    def __call__(self, event):
+        self.events.append(event)
+
+
+class CodecTest(unittest.TestCase):
+    def test_round_trips(self):
+        for codec in (JSONCodec, BinaryCodec):
+            self.assertEqual(codec.decode(codec.encode("O_param", MESSAGE)), ("O_param", MESSAGE, None))
+            self.assertEqual(codec.decode(codec.encode(7, MESSAGE, 1234.5)), (7, MESSAGE, 1234.5))
+
+    def test_binary_keeps_types(self):
+        subject, msg, timestamp = BinaryCodec.decode(BinaryCodec.encode(7, {"value": (1, 2.0, "s")}))
+        self.assertEqual(type(msg["value"]), tuple)
+        self.assertEqual([type(value) for value in msg["value"]], [int, float, str])
+
+    def test_malformed_payloads_raise_codec_errors(self):
+        self.assertRaises(CodecError, JSONCodec.decode, "[1,")
+        self.assertRaises(CodecError, JSONCodec.decode, "[]")
+        self.assertRaises(CodecError, BinaryCodec.decode, JSONCodec.encode(7, MESSAGE))
+        self.assertRaises(CodecError, BinaryCodec.encode, 7, {"value": object()})
+
+    def test_binary_codec_is_only_offered_to_local_peers(self):
+        self.assertEqual(Codecs.supported(), [JSONCodec.NAME])
+        self.assertEqual(Codecs.supported(True), [BinaryCodec.NAME, JSONCodec.NAME])
+
+    def test_negotiation(self):
+        offered = Codecs.supported(True)
+        self.assertEqual(Codecs.negotiate(offered, True), BinaryCodec)
+        self.assertEqual(Codecs.negotiate(offered, False), JSONCodec)
+        self.assertEqual(Codecs.negotiate(["unknown"], True), JSONCodec)
+        self.assertEqual(Codecs.negotiate(None, True), JSONCodec)
+        self.assertEqual(Codecs.get(BinaryCodec.NAME, True), BinaryCodec)
+        self.assertEqual(Codecs.get(BinaryCodec.NAME, False), JSONCodec)
+
+
+class HandshakeTest(unittest.TestCase):
+    def handshake(self, pair):
+        client, server = pair
+        self.endpoints = pair
+        for endpoint in pair:
+            endpoint.connectionStatus = NetworkEndpoint.PIPE_CONNECTED
+        server.add_client_handshake_callback(server.send_handshake_ack)
+        client.send_handshake()
+        client.flush_mailbox()
+        server.recv_msg()
+        client.recv_msg()
+        self.assertEqual(client.connectionStatus, NetworkEndpoint.HANDSHAKE_COMPLETE)
+        self.assertEqual(client.codec, server.codec)
+        return client, server
+
+    def tearDown(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    def exchange(self, client, server):
+        received = Received(server)
+        client.send_msg(SimpleMessage("O_param", MESSAGE), True)
+        server.recv_msg()
+        self.assertEqual([(event.subject, event.msg) for event in received.events], [("O_param", MESSAGE)])
+
+        received = Received(client)
+        server.send_msg(SimpleMessage("I_param", MESSAGE), True)
+        client.recv_msg()
+        self.assertEqual([(event.subject, event.msg) for event in received.events], [("I_param", MESSAGE)])
+
+    def test_loopback_peers_negotiate_binary(self):
+        client, server = self.handshake(tcp_pair())
+        self.assertEqual(server.codec, BinaryCodec)
+        self.exchange(client, server)
+
+    def test_remote_peers_stay_on_json(self):
+        client, server = tcp_pair()
+        server.peer_is_local = lambda: False
+        client, server = self.handshake((client, server))
+        self.assertEqual(server.codec, JSONCodec)
+        self.exchange(client, server)
+
+    def test_client_refuses_binary_from_a_remote_server(self):
+        client, server = tcp_pair()
+        client.peer_is_local = lambda: False
+        server.peerCodecs = Codecs.supported(True)
+        self.endpoints = (client, server)
+        client.connectionStatus = NetworkEndpoint.HANDSHAKING
+        server.send_handshake_ack()
+        client.recv_msg()
+        self.assertEqual(client.codec, JSONCodec)
+
+    @unittest.skipUnless(UnixSockets.SUPPORTED, "Unix sockets aren't available on this platform")
+    def test_unix_peers_negotiate_binary(self):
+        client, server = self.handshake(unix_stream_pair())
+        self.assertEqual(server.codec, BinaryCodec)
+        self.exchange(client, server)
+
+
+if __name__ == "__main__":
+    unittest.main()
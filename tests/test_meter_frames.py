@@ -0,0 +1,58 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.MeterFrames import MeterDeltaEncoder, MeterDeltaDecoder
+
+
+class MeterFramesTest(unittest.TestCase):
+    def test_first_frame_is_a_keyframe(self):
+        encoder = MeterDeltaEncoder()
+        self.assertEqual(encoder.encode({"t1": 0.5, "t2": 0.1}), (True, {"t1": 0.5, "t2": 0.1}))
+
+    def test_only_moved_levels_are_sent(self):
+        encoder = MeterDeltaEncoder(epsilon=0.01)
+        encoder.encode({"t1": 0.5, "t2": 0.1})
+        self.assertEqual(encoder.encode({"t1": 0.505, "t2": 0.1}), None)
+        self.assertEqual(encoder.encode({"t1": 0.52, "t2": 0.1, "t3": 0.0}), (False, {"t1": 0.52, "t3": 0.0}))
+
+    def test_small_steps_add_up(self):
+        # Levels are compared against what was last sent, so a slow drift is still sent eventually
+        encoder = MeterDeltaEncoder(epsilon=0.01)
+        encoder.encode({"t1": 0.5})
+        self.assertEqual(encoder.encode({"t1": 0.506}), None)
+        self.assertEqual(encoder.encode({"t1": 0.512}), (False, {"t1": 0.512}))
+
+    def test_keyframes_repeat_on_interval_and_after_reset(self):
+        encoder = MeterDeltaEncoder(keyframeinterval=3)
+        levels = {"t1": 0.5}
+        keyframes = [frame is not None and frame[0] for frame in (encoder.encode(levels) for i in xrange(7))]
+        self.assertEqual(keyframes, [True, False, False, True, False, False, True])
+        encoder.reset()
+        self.assertEqual(encoder.encode(levels), (True, levels))
+
+    def test_decoder_converges_on_the_sent_levels(self):
+        encoder = MeterDeltaEncoder(epsilon=0.0, keyframeinterval=8)
+        decoder = MeterDeltaDecoder()
+        rng = random.Random(1)
+        levels = {}
+        for i in xrange(40):
+            levels = dict(("t%d" % track, rng.random()) for track in xrange(4))
+            frame = encoder.encode(levels)
+            if frame:
+                decoder.apply({"keyframe": frame[0], "levels": frame[1]})
+        self.assertEqual(decoder.levels, levels)
+
+    def test_keyframe_drops_tracks_that_went_away(self):
+        decoder = MeterDeltaDecoder()
+        decoder.apply({"keyframe": True, "levels": {"t1": 0.5, "t2": 0.2}})
+        decoder.apply({"keyframe": False, "levels": {"t2": 0.3}})
+        self.assertEqual(decoder.levels, {"t1": 0.5, "t2": 0.3})
+        self.assertEqual(decoder.apply({"keyframe": True, "levels": {"t2": 0.4}}), {"t2": 0.4})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.Metrics import ClockOffset, Histogram
+
+
+class ClockOffsetTest(unittest.TestCase):
+    def probe(self, clock, sent, outbound, inbound, peerahead, turnaround=1.0):
+        """Add a probe whose legs took the given milliseconds, with the peer's clock ahead of ours"""
+        received = sent + outbound + peerahead
+        replied = received + turnaround
+        clock.add_sample(sent, received, replied, replied - peerahead + inbound)
+
+    def test_symmetric_round_trip_finds_the_offset(self):
+        clock = ClockOffset()
+        self.assertFalse(clock.synced())
+        self.probe(clock, 1000.0, 5.0, 5.0, 250.0)
+        self.assertTrue(clock.synced())
+        self.assertEqual((clock.offset, clock.delay), (250.0, 10.0))
+        self.assertEqual(clock.to_local(1500.0), 1250.0)
+
+    def test_trusts_the_fastest_recent_round_trip(self):
+        clock = ClockOffset()
+        self.probe(clock, 1000.0, 2.0, 2.0, 100.0)
+        # A reply stuck in a queue makes the peer look further behind than it is
+        self.probe(clock, 2000.0, 2.0, 40.0, 100.0)
+        self.assertEqual((clock.offset, clock.delay), (100.0, 4.0))
+
+    def test_forgets_samples_outside_the_window(self):
+        clock = ClockOffset()
+        self.probe(clock, 0.0, 1.0, 1.0, 100.0)
+        for i in xrange(ClockOffset.SAMPLES):
+            self.probe(clock, 1000.0 * (i + 1), 5.0, 5.0, 300.0)
+        self.assertEqual(len(clock.samples), ClockOffset.SAMPLES)
+        self.assertEqual(clock.offset, 300.0)
+
+    def test_reset(self):
+        clock = ClockOffset()
+        self.probe(clock, 1000.0, 5.0, 5.0, 250.0)
+        clock.reset()
+        self.assertFalse(clock.synced())
+        self.assertEqual(clock.samples, [])
+
+
+class HistogramTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(Histogram().as_dict(), {"count": 0, "mean": 0.0, "p50": 0.0, "p99": 0.0, "max": 0.0})
+
+    def test_percentiles_keep_their_relative_precision(self):
+        histogram = Histogram(precision=0.05)
+        for value in xrange(1, 1001):
+            histogram.add(value / 10.0)
+        stats = histogram.as_dict()
+        self.assertEqual(stats["count"], 1000)
+        self.assertAlmostEqual(stats["mean"], 50.05)
+        self.assertTrue(50.0 <= stats["p50"] <= 50.0 * 1.05)
+        self.assertTrue(99.0 <= stats["p99"] <= 99.0 * 1.05)
+        self.assertEqual(stats["max"], 100.0)
+
+    def test_percentiles_never_pass_the_largest_value(self):
+        histogram = Histogram()
+        histogram.add(3.0)
+        self.assertEqual(histogram.percentile(50), 3.0)
+        self.assertEqual(histogram.percentile(100), 3.0)
+
+    def test_values_below_the_minimum_share_a_bucket(self):
+        histogram = Histogram(minimum=0.01)
+        histogram.add(0.0)
+        histogram.add(0.005)
+        self.assertEqual(histogram.buckets, {0: 2})
+        self.assertTrue(histogram.percentile(50) <= 0.01)
+
+    def test_reset(self):
+        histogram = Histogram()
+        histogram.add(5.0)
+        histogram.reset()
+        self.assertEqual((histogram.count, histogram.buckets, histogram.maximum), (0, {}, 0.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.NetworkEndpoint import Backoff, NetworkEndpoint
+from ShowtimeBridge.TCPEndpoint import TCPEndpoint
+
+
+class BackoffTest(unittest.TestCase):
+    def test_delays_double_up_to_the_maximum(self):
+        backoff = Backoff(0.5, 3.0, 0)
+        self.assertEqual([backoff.failed() for i in xrange(5)], [0.5, 1.0, 2.0, 3.0, 3.0])
+
+    def test_jitter_only_shortens_delays(self):
+        backoff = Backoff(1.0, 1.0, 0.5)
+        for i in xrange(100):
+            self.assertTrue(0.5 <= backoff.failed() <= 1.0)
+
+    def test_waits_until_the_next_attempt(self):
+        backoff = Backoff(60, 60)
+        self.assertTrue(backoff.ready())
+        backoff.failed()
+        self.assertFalse(backoff.ready())
+        backoff.reset()
+        self.assertTrue(backoff.ready())
+        self.assertEqual(backoff.failures, 0)
+
+
+class ConnectTest(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+        self.endpoint = None
+
+    def tearDown(self):
+        if self.endpoint:
+            self.endpoint.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def listen(self, backlog=8):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(backlog)
+        self.sockets.append(listener)
+        return listener.getsockname()[1]
+
+    def connect(self, port):
+        """Poll an unthreaded endpoint's connect the way Live's tick does until it settles"""
+        self.endpoint = TCPEndpoint(-1, port, False, False)
+        status = self.endpoint.connect()
+        started = time.time()
+        while self.endpoint.connecting() and time.time() - started < 2:
+            status = self.endpoint.connect()
+        return status
+
+    def test_connects_without_blocking(self):
+        self.assertEqual(self.connect(self.listen()), NetworkEndpoint.PIPE_CONNECTED)
+        self.assertFalse(self.endpoint.connecting())
+
+    def test_refused_connect_fails(self):
+        port = self.listen()
+        self.sockets.pop().close()
+        self.assertEqual(self.connect(port), NetworkEndpoint.PIPE_DISCONNECTED)
+        self.assertFalse(self.endpoint.connecting())
+
+    def test_stalled_connect_times_out(self):
+        # The listener's accept queue is full, so the endpoint's connect stays in progress
+        port = self.listen(0)
+        filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sockets.append(filler)
+        filler.setblocking(0)
+        filler.connect_ex(("127.0.0.1", port))
+        time.sleep(0.1)
+
+        self.endpoint = TCPEndpoint(-1, port, False, False)
+        self.endpoint.connect()
+        if not self.endpoint.connecting() or self.endpoint.check_connect() == NetworkEndpoint.PIPE_CONNECTED:
+            self.skipTest("This platform completed the connect anyway")
+        self.assertTrue(self.endpoint.connecting())
+
+        self.endpoint.connectStarted -= TCPEndpoint.CONNECT_TIMEOUT + 1
+        self.assertEqual(self.endpoint.connect(), NetworkEndpoint.PIPE_DISCONNECTED)
+        self.assertFalse(self.endpoint.connecting())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,217 @@
+import collections
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from Showtime_Live.EventSelector import Waker
+
+try:
+    from Showtime_Live.LiveRouter import LiveRouter, Registrar
+except ImportError:
+    # The router needs Showtime and pyzmq
+    LiveRouter = Registrar = None
+
+
+class StageNode:
+    """Showtime node that keeps the registrations and updates it was asked for"""
+    def __init__(self, failing=()):
+        self.failing = failing
+        self.methods = {}
+        self.requests = []
+        self.updates = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def request_register_method(self, method, mode, args=None, callback=None, nodesocket=None):
+        self.requests.append((method, nodesocket))
+        self.release.wait()
+        if method in self.failing:
+            raise RuntimeError("Stage refused %s" % method)
+        self.methods[method] = args
+
+    def update_local_method_by_name(self, methodname, methodvalue):
+        self.updates.append((methodname, methodvalue))
+
+
+class StageSocket:
+    def __init__(self, name):
+        self.name = name
+        self.socket = self
+        self.closed = False
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class Completions:
+    """Registrar completion callback that can be waited on"""
+    def __init__(self):
+        self.results = []
+        self.lock = threading.Condition()
+
+    def __call__(self, methodname, success):
+        with self.lock:
+            self.results.append((methodname, success))
+            self.lock.notify_all()
+
+    def wait(self, count):
+        with self.lock:
+            while len(self.results) < count:
+                self.lock.wait(5)
+        return self.results
+
+
+if Registrar:
+    class WorkerRegistrar(Registrar):
+        """Registrar whose workers don't need a running stage to connect to"""
+        def connect_stage(self, name):
+            return StageSocket(name)
+
+
+@unittest.skipIf(Registrar is None, "Showtime and pyzmq aren't installed")
+class RegistrarTest(unittest.TestCase):
+    def setUp(self):
+        self.node = StageNode(failing=("broken",))
+        self.completions = Completions()
+        self.registrar = None
+
+    def tearDown(self):
+        self.node.release.set()
+        if self.registrar:
+            self.registrar.stop()
+
+    def test_tracks_methods_until_they_complete(self):
+        self.node.release.clear()
+        self.registrar = WorkerRegistrar(self.node, self.completions, 2)
+        for name in ("one", "two", "three"):
+            self.registrar.add_registration_request(name, "read", None, None)
+        self.assertTrue(all(self.registrar.registering(name) for name in ("one", "two", "three")))
+        self.assertEqual(self.registrar.stats()["pending"], 3)
+
+        self.node.release.set()
+        self.completions.wait(3)
+        self.assertFalse(any(self.registrar.registering(name) for name in ("one", "two", "three")))
+        stats = self.registrar.stats()
+        self.assertEqual((stats["pending"], stats["registered"], stats["failed"]), (0, 3, 0))
+        self.assertEqual(stats["perMethod"]["count"], 3)
+        self.assertTrue(stats["lastBatchSeconds"] is not None)
+
+    def test_workers_register_on_their_own_stage_sockets(self):
+        self.registrar = WorkerRegistrar(self.node, self.completions, 2)
+        self.registrar.add_registration_request("one", "read", None, None)
+        self.assertEqual(self.completions.wait(1), [("one", True)])
+        self.assertTrue(self.node.requests[0][1].name in ("registrar0", "registrar1"))
+
+    def test_reports_failed_registrations(self):
+        self.registrar = Registrar(self.node, self.completions, 0)
+        self.registrar.add_registration_request("broken", "read", None, None)
+        self.registrar.add_registration_request("working", "read", None, None)
+        while not self.registrar.queued.empty():
+            self.registrar.register(self.registrar.queued.get())
+        self.assertEqual(self.completions.results, [("broken", False), ("working", True)])
+        stats = self.registrar.stats()
+        self.assertEqual((stats["registered"], stats["failed"]), (1, 1))
+
+    def test_stopped_workers_close_their_sockets(self):
+        self.registrar = WorkerRegistrar(self.node, self.completions, 1)
+        self.registrar.add_registration_request("one", "read", None, None)
+        self.completions.wait(1)
+        stagesocket = self.node.requests[0][1]
+        self.registrar.stop()
+        self.registrar.workers[0].join(5)
+        self.assertTrue(stagesocket.closed)
+
+
+@unittest.skipIf(LiveRouter is None, "Showtime and pyzmq aren't installed")
+class MethodHoldTest(unittest.TestCase):
+    def setUp(self):
+        # Only the parts of the router that registration touches
+        self.node = StageNode(failing=("broken",))
+        self.router = LiveRouter.__new__(LiveRouter)
+        self.router.node = self.node
+        self.router.registeredMethods = set()
+        self.router.registeredManifests = set()
+        self.router.pendingMessages = {}
+        self.router.pendingCalls = collections.deque()
+        self.router.waker = Waker()
+        self.router.registrar = Registrar(self.node, self.router.registration_completed, 0)
+
+    def tearDown(self):
+        self.router.waker.close()
+
+    def register_queued(self):
+        """Register what the router queued, the way a worker would, then run the completions on this thread"""
+        while not self.router.registrar.queued.empty():
+            self.router.registrar.register(self.router.registrar.queued.get())
+        self.router.wakeup_received(self.router.waker)
+
+    def test_methods_are_only_registered_once(self):
+        self.router.register_method("one", "read", None)
+        self.router.register_method("one", "read", None)
+        self.assertEqual(self.router.registrar.queued.qsize(), 1)
+        self.assertTrue(self.router.registrar.registering("one"))
+
+    def test_messages_sent_while_registering_are_replayed_in_order(self):
+        self.router.register_method("one", "read", None)
+        self.assertFalse(self.router.update_method("one", 1))
+        self.assertFalse(self.router.update_method("one", 2))
+        self.assertEqual(self.node.updates, [])
+
+        self.register_queued()
+        self.assertEqual(self.node.updates, [("one", 1), ("one", 2)])
+        self.assertFalse("one" in self.router.pendingMessages)
+
+        # With the hold gone updates go straight to Showtime
+        self.assertTrue(self.router.update_method("one", 3))
+        self.assertEqual(self.node.updates[-1], ("one", 3))
+
+    def test_completions_wait_for_the_router_thread(self):
+        self.router.register_method("one", "read", None)
+        self.router.update_method("one", 1)
+        self.router.registrar.register(self.router.registrar.queued.get())
+        self.assertEqual(self.node.updates, [])
+        self.assertEqual(len(self.router.pendingCalls), 1)
+
+        self.router.wakeup_received(self.router.waker)
+        self.assertEqual(self.node.updates, [("one", 1)])
+
+    def test_failed_registration_drops_its_hold_and_manifests(self):
+        self.router.register_manifest("abc", [{"name": "broken", "methodaccess": "read", "args": None}])
+        self.assertEqual(self.router.registeredManifests, set(["abc"]))
+        self.router.update_method("broken", 1)
+
+        self.register_queued()
+        self.assertEqual(self.node.updates, [])
+        self.assertFalse("broken" in self.router.pendingMessages)
+        self.assertFalse("broken" in self.router.registeredMethods)
+        self.assertEqual(self.router.registeredManifests, set())
+
+        # The next client to ask registers it again
+        self.router.register_method("broken", "read", None)
+        self.assertEqual(self.router.registrar.queued.qsize(), 1)
+
+    def test_known_manifests_are_skipped(self):
+        methods = [{"name": "one", "methodaccess": "read", "args": None},
+                   {"name": "two", "methodaccess": "write", "args": {"value": None}}]
+        self.router.register_manifest("abc", methods)
+        self.register_queued()
+        self.assertEqual(sorted(self.node.methods), ["one", "two"])
+
+        self.router.registeredMethods.clear()
+        self.router.register_manifest("abc", methods)
+        self.assertEqual(self.router.registrar.queued.qsize(), 0)
+
+        # Tables without a hash are registered method by method
+        self.router.register_manifest(None, methods)
+        self.assertEqual(self.router.registrar.queued.qsize(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
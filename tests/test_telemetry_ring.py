@@ -0,0 +1,127 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from ShowtimeBridge.LiveNetworkEndpoint import LiveNetworkEndpoint
+from ShowtimeBridge.LiveWrappers.LiveWrapper import LiveWrapper
+from ShowtimeBridge.LiveWrappers.LiveSong import LiveSong
+from ShowtimeBridge.LiveWrappers.LiveTrack import LiveTrack
+from ShowtimeBridge.LiveWrappers.LiveClip import LiveClip
+from ShowtimeBridge.MeterFrames import MeterDeltaEncoder
+from ShowtimeBridge.TelemetryRing import TelemetryRing
+
+METHOD_IDS = {LiveSong.SONG_METERS: 3, LiveClip.CLIP_PLAYING_POSITION: 4}
+
+
+class RingEndpoint(LiveNetworkEndpoint):
+    """Bridge endpoint that only has a telemetry ring to send through"""
+    def __init__(self, ring):
+        self.telemetry = ring
+        self.sentThroughRing = []
+
+    def send_to_showtime(self, message, args, responding=False):
+        self.sentThroughRing.append(self.send_telemetry(METHOD_IDS[message], args, 1.0))
+
+
+class FakeHandle:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class FakeTrack:
+    def __init__(self, trackid, left, right):
+        self.trackid = trackid
+        self.trackHandle = FakeHandle(has_midi_output=False, output_meter_left=left, output_meter_right=right)
+
+    def id(self):
+        return self.trackid
+
+    def handle(self):
+        return self.trackHandle
+
+    def tick(self):
+        pass
+
+
+class TelemetryRingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "telemetry")
+        self.producer = TelemetryRing(path, 16)
+        self.consumer = TelemetryRing(path)
+        self.endpoint = RingEndpoint(self.producer)
+        self.previousEndpoint = LiveWrapper._endpoint
+        LiveWrapper.set_endpoint(self.endpoint)
+
+    def tearDown(self):
+        LiveWrapper.set_endpoint(self.previousEndpoint)
+        self.consumer.close()
+        self.producer.close()
+        shutil.rmtree(self.directory)
+
+    def test_new_ring_file_is_private_and_exclusive(self):
+        self.assertEqual(os.stat(self.producer.path).st_mode & 0777, 0600)
+        self.assertRaises(OSError, TelemetryRing, self.producer.path, 16)
+
+    def test_song_meter_frame_goes_through_the_ring(self):
+        song = LiveSong.__new__(LiveSong)
+        song._id = "song"
+        song._handle = None
+        song.layoutPager = None
+        song.meterEncoder = MeterDeltaEncoder()
+        tracks = LiveTrack._instances
+        LiveTrack._instances = {"t1": FakeTrack("t1", 0.25, 0.75), "t2": FakeTrack("t2", 0.123456, 0.123456)}
+        try:
+            song.song_time_updated()
+        finally:
+            LiveTrack._instances = tracks
+        self.assertEqual(self.endpoint.sentThroughRing, [True])
+
+        self.producer.commit()
+        records = self.consumer.records()
+        self.assertEqual(records[0], (3, TelemetryRing.FLAG_FRAME | TelemetryRing.FLAG_KEYFRAME, "song", 2, 1.0))
+        self.assertEqual(sorted(records[1:]), [(3, 0, "t1", 0.5, 1.0), (3, 0, "t2", 0.1235, 1.0)])
+
+    def test_clip_playing_position_goes_through_the_ring(self):
+        clip = LiveClip.__new__(LiveClip)
+        clip._id = "clip1"
+        clip._handle = FakeHandle(playing_position=2.123456)
+        clip.playing_position()
+        self.assertEqual(self.endpoint.sentThroughRing, [True])
+
+        self.producer.commit()
+        self.assertEqual(self.consumer.records(), [(4, 0, "clip1", 2.1235, 1.0)])
+
+    def test_unrepresentable_values_are_left_for_the_socket(self):
+        self.assertFalse(self.producer.append(4, "clip1", "2.1235", 1.0))
+        self.assertFalse(self.producer.append(4, "x" * (TelemetryRing.MAX_ID_LENGTH + 1), 1.0, 1.0))
+        self.producer.commit()
+        self.assertEqual(self.consumer.records(), [])
+
+    def test_full_ring_drops_whole_frames(self):
+        self.assertTrue(self.producer.append_frame(3, "song", dict(("t%d" % i, 0.5) for i in xrange(10)), 1.0))
+        self.assertTrue(self.producer.append_frame(3, "song", dict(("t%d" % i, 0.5) for i in xrange(10)), 1.0))
+        self.producer.commit()
+        self.assertEqual(len(self.consumer.records()), 11)
+        self.assertEqual(self.consumer.dropped(), 11)
+
+    def test_records_not_visible_yet_wait_for_the_next_drain(self):
+        self.producer.append_frame(3, "song", {"t1": 0.5, "t2": 0.25}, 1.0)
+        self.producer.append(4, "clip1", 1.0, 1.0)
+        self.producer.commit()
+
+        # Blank the sequence number of the frame's last record, as if its write hadn't landed yet
+        offset = TelemetryRing.RECORDS_OFFSET + 3 * TelemetryRing.RECORD.size - 4
+        sequence = self.producer.map[offset:offset + 4]
+        self.producer.map[offset:offset + 4] = "\xff\xff\xff\xff"
+        self.assertEqual(self.consumer.records(), [])
+        self.producer.map[offset:offset + 4] = sequence
+        self.assertEqual(len(self.consumer.records()), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Showtime_Live",
+                                "Midi_Remote_Scripts"))
+from Showtime_Live.TimerWheel import TimerTask, TimerWheel, TimerThread
+
+
+def task(due, name=None):
+    return TimerTask(None, (), due, name=name)
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.wheel = TimerWheel(0.001, now=0.0)
+
+    def test_timers_come_due_in_their_tick(self):
+        early = task(0.005)
+        late = task(0.010)
+        self.wheel.add(late)
+        self.wheel.add(early)
+        self.assertEqual(len(self.wheel), 2)
+        self.assertEqual(self.wheel.advance(0.004), [])
+        self.assertEqual(self.wheel.advance(0.005), [early])
+        self.assertEqual(self.wheel.advance(0.020), [late])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_timers_cascade_down_from_upper_levels(self):
+        # One timer per level, plus one beyond the reach of every level
+        dues = (0.1, 10.0, 600.0, 3600.0, 70000.0)
+        tasks = [task(due) for due in dues]
+        for timer in tasks:
+            self.wheel.add(timer)
+        for due, timer in zip(dues, tasks):
+            self.assertEqual(self.wheel.advance(due - 0.002), [])
+            self.assertEqual(self.wheel.advance(due), [timer])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_next_wakeup_is_no_later_than_the_next_timer(self):
+        self.assertEqual(self.wheel.next_wakeup(), None)
+        timer = task(30.0)
+        self.wheel.add(timer)
+        due = []
+        while not due:
+            wakeup = self.wheel.next_wakeup()
+            self.assertTrue(wakeup <= 30.0 + 1e-9)
+            due = self.wheel.advance(wakeup)
+        self.assertEqual(due, [timer])
+
+    def test_past_timers_are_due_next_tick(self):
+        self.wheel.advance(1.0)
+        timer = task(0.5)
+        self.wheel.add(timer)
+        self.assertEqual(self.wheel.advance(self.wheel.time_of(self.wheel.currentTick + 1)), [timer])
+
+
+class TimerThreadTest(unittest.TestCase):
+    def setUp(self):
+        self.timers = TimerThread()
+        self.timers.start()
+
+    def tearDown(self):
+        self.timers.stop()
+        self.timers.join(1.0)
+
+    def test_runs_one_off_and_periodic_jobs(self):
+        once = threading.Event()
+        ticks = []
+        self.timers.call_later(0.01, once.set)
+        periodic = self.timers.call_every(0.005, lambda: ticks.append(time.time()), name="ticks")
+        self.assertTrue(once.wait(1.0))
+        deadline = time.time() + 1.0
+        while len(ticks) < 5 and time.time() < deadline:
+            time.sleep(0.005)
+        self.timers.cancel(periodic)
+        self.assertTrue(len(ticks) >= 5)
+        self.assertEqual(self.timers.stats(), {})
+
+    def test_cancel_waits_for_a_run_under_way(self):
+        started = threading.Event()
+        state = {"running": False, "ranAfterCancel": False, "cancelled": False}
+
+        def job():
+            if state["cancelled"]:
+                state["ranAfterCancel"] = True
+            state["running"] = True
+            started.set()
+            time.sleep(0.05)
+            state["running"] = False
+
+        periodic = self.timers.call_every(0.001, job)
+        self.assertTrue(started.wait(1.0))
+        self.timers.cancel(periodic)
+        state["cancelled"] = True
+        self.assertFalse(state["running"])
+        time.sleep(0.02)
+        self.assertFalse(state["ranAfterCancel"])
+
+
+if __name__ == "__main__":
+    unittest.main()